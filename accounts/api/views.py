@@ -17,6 +17,7 @@ authenticate as django_authenticate,
 )
 from ratelimit.decorators import ratelimit
 from accounts.models import UserProfile
+from accounts.services import UserService
 from utils.permissions import IsObjectOwner
 
 
@@ -39,6 +40,7 @@ class AccountViewSet(viewsets.ViewSet):
             'ip': request.META['REMOTE_ADDR']
         }
         if request.user.is_authenticated:
+            UserService.touch_last_active(request.user.id)
             data['user'] = UserSerializer(request.user).data
         return Response(data)
 
@@ -75,6 +77,7 @@ class AccountViewSet(viewsets.ViewSet):
                 "message":"Username and password does not match.",
             }, status=400)
         django_login(request, user)
+        UserService.touch_last_active(user.id)
         return Response({
             "success": True,
             "user": UserSerializer(instance=user).data
@@ -93,6 +96,7 @@ class AccountViewSet(viewsets.ViewSet):
 
         user = serializer.save()
         django_login(request, user)
+        UserService.touch_last_active(user.id)
         return Response({
             'success': True,
             'user': UserSerializer(user).data
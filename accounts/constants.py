@@ -0,0 +1,2 @@
+# 每个进程最多记住这么多个用户的最后 touch 时间，超过之后清空重新开始记
+USER_LAST_ACTIVE_TOUCH_CACHE_SIZE = 100000
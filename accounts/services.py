@@ -1,30 +1,192 @@
+import time
+
+from accounts.constants import USER_LAST_ACTIVE_TOUCH_CACHE_SIZE
 from accounts.models import UserProfile
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import caches
-from twitter.cache import USER_PROFILE_PATTERN
+from twitter.cache import USER_PROFILE_PATTERN, USER_LAST_ACTIVE_KEY
+from utils.cache_metrics import CacheMetrics
+from utils.cache_versions import ModelCacheVersion
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
 
 class UserService:
+    # {user_id: 这个进程最后一次更新 USER_LAST_ACTIVE_KEY 的时间}
+    _last_touched_at = {}
+
+    @classmethod
+    def get_profile_key(cls, user_id, version=None):
+        if version is None:
+            version = ModelCacheVersion.get_version(UserProfile)
+        return USER_PROFILE_PATTERN.format(version=version, user_id=user_id)
 
     @classmethod
     def get_profile_through_cache(cls, user_id):
-        key = USER_PROFILE_PATTERN.format(user_id=user_id)
+        key = cls.get_profile_key(user_id)
 
         # read from cache first
         profile = cache.get(key)
         # cache hit return
+        pattern = CacheMetrics.get_pattern(key)
+        if profile is not None:
+            CacheMetrics.record_hits(pattern)
+            return profile
+
+        # 滚动部署的时候先试试旧版本的 key
+        profile = MemcachedHelper.get_from_previous_versions(
+            UserProfile,
+            [user_id],
+            cls.get_profile_key,
+        ).get(user_id)
         if profile is not None:
+            CacheMetrics.record_hits(pattern)
             return profile
 
         # cache miss, read from db
+        CacheMetrics.record_misses(pattern)
+        started_at = time.time()
         profile, _ = UserProfile.objects.get_or_create(user_id=user_id)
         cache.set(key, profile)
+        CacheMetrics.record_fill(
+            pattern,
+            time.time() - started_at,
+            CacheMetrics.get_pickled_size([profile]),
+        )
         return profile
 
+    @classmethod
+    def get_profiles_through_cache(cls, user_ids):
+        # 一次 get_many 取出所有 users 的 profile，cache miss 的用一次 user_id__in 的 query 补上
+        # 返回 {user_id: profile}
+        keys = {
+            cls.get_profile_key(user_id): user_id
+            for user_id in user_ids
+        }
+        profiles = {
+            keys[key]: profile
+            for key, profile in cache.get_many(list(keys)).items()
+            if profile is not None
+        }
+        missing_ids = [
+            user_id
+            for user_id in keys.values()
+            if user_id not in profiles
+        ]
+        pattern = CacheMetrics.get_pattern(USER_PROFILE_PATTERN)
+        if not missing_ids:
+            CacheMetrics.record_hits(pattern, len(keys))
+            return profiles
+
+        profiles.update(MemcachedHelper.get_from_previous_versions(
+            UserProfile,
+            missing_ids,
+            cls.get_profile_key,
+        ))
+        missing_ids = [
+            user_id
+            for user_id in missing_ids
+            if user_id not in profiles
+        ]
+        CacheMetrics.record_hits(pattern, len(keys) - len(missing_ids))
+        if not missing_ids:
+            return profiles
+
+        CacheMetrics.record_misses(pattern, len(missing_ids))
+        started_at = time.time()
+        missing_profiles = {
+            profile.user_id: profile
+            for profile in UserProfile.objects.filter(user_id__in=missing_ids)
+        }
+        # 还没有 profile 的 user 很少，和 get_profile_through_cache 一样一个一个的创建
+        for user_id in missing_ids:
+            if user_id not in missing_profiles:
+                missing_profiles[user_id], _ = UserProfile.objects.get_or_create(user_id=user_id)
+        cache.set_many({
+            cls.get_profile_key(user_id): profile
+            for user_id, profile in missing_profiles.items()
+        })
+        CacheMetrics.record_fill(
+            pattern,
+            time.time() - started_at,
+            CacheMetrics.get_pickled_size(missing_profiles.values()),
+        )
+        profiles.update(missing_profiles)
+        return profiles
+
+    @classmethod
+    def prefetch_profiles(cls, users):
+        # 和 accounts.models.get_profile 一样把 profile 放在 user 的 _cached_user_profile 里
+        users = [
+            user
+            for user in users
+            if not hasattr(user, '_cached_user_profile')
+        ]
+        profiles = cls.get_profiles_through_cache(set(user.id for user in users))
+        for user in users:
+            if user.id in profiles:
+                user._cached_user_profile = profiles[user.id]
+
     @classmethod
     def invalidate_profile(cls, user_id):
-        key = USER_PROFILE_PATTERN.format(user_id=user_id)
-        cache.delete(key)
\ No newline at end of file
+        cache.delete_many([
+            cls.get_profile_key(user_id, version)
+            for version in ModelCacheVersion.get_all_versions(UserProfile)
+        ])
+
+    @classmethod
+    def touch_last_active(cls, user_id):
+        # 每个请求都会调用，同一个用户短时间内的多次请求只写一次 redis
+        now = time.time()
+        if now - cls._last_touched_at.get(user_id, 0) < settings.USER_LAST_ACTIVE_TOUCH_INTERVAL:
+            return
+        if len(cls._last_touched_at) >= USER_LAST_ACTIVE_TOUCH_CACHE_SIZE:
+            cls._last_touched_at = {}
+        cls._last_touched_at[user_id] = now
+        conn = RedisClient.get_connection()
+        conn.zadd(USER_LAST_ACTIVE_KEY, {user_id: now})
+
+    @classmethod
+    def trim_last_active(cls):
+        # 超过 REDIS_KEY_EXPIRE_TIME 没有活跃的用户已经不算活跃用户了，从 sorted set 里删掉
+        # 否则它会随着注册用户的数量一直增长。返回删掉的用户数量
+        conn = RedisClient.get_connection()
+        return conn.zremrangebyscore(
+            USER_LAST_ACTIVE_KEY,
+            '-inf',
+            cls._get_active_since(),
+        )
+
+    @classmethod
+    def get_recently_active_user_ids(cls, count):
+        # 最近活跃的 count 个用户，最近的排在前面
+        conn = RedisClient.get_connection()
+        return [
+            int(user_id)
+            for user_id in conn.zrevrange(USER_LAST_ACTIVE_KEY, 0, count - 1)
+        ]
+
+    @classmethod
+    def _get_active_since(cls):
+        # touch_last_active 有 USER_LAST_ACTIVE_TOUCH_INTERVAL 的延迟，多算一个间隔
+        return time.time() - settings.REDIS_KEY_EXPIRE_TIME - settings.USER_LAST_ACTIVE_TOUCH_INTERVAL
+
+    @classmethod
+    def get_active_user_ids(cls, user_ids):
+        # 超过 REDIS_KEY_EXPIRE_TIME 没有活跃的用户，newsfeeds 的 cache 基本上都已经过期了
+        # 一次 pipeline 查出所有 users 的最后活跃时间
+        if not user_ids:
+            return set()
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipeline.zscore(USER_LAST_ACTIVE_KEY, user_id)
+        active_since = cls._get_active_since()
+        return set(
+            user_id
+            for user_id, last_active in zip(user_ids, pipeline.execute())
+            if last_active is not None and last_active >= active_since
+        )
@@ -1,5 +1,11 @@
 from accounts.models import UserProfile
+from accounts.services import UserService
+from django.contrib.auth.models import User
+from django.test import override_settings
 from testing.testcase import TestCase
+from twitter.cache import USER_LAST_ACTIVE_KEY
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient
 
 
 class UserProfileTests(TestCase):
@@ -12,4 +18,41 @@ class UserProfileTests(TestCase):
         self.assertEqual(UserProfile.objects.count(), 0)
         p = alice.profile
         self.assertEqual(isinstance(p, UserProfile), True)
-        self.assertEqual(UserProfile.objects.count(), 1)
\ No newline at end of file
+        self.assertEqual(UserProfile.objects.count(), 1)
+
+    @override_settings(LOCAL_OBJECT_CACHE_ENABLED=True, LOCAL_OBJECT_CACHE_SYNC_INTERVAL=0)
+    def test_prefetch_profiles_after_profile_changed(self):
+        alice = self.create_user('alice')
+        tweets = [self.create_tweet(alice)]
+        users = MemcachedHelper.prefetch_objects_through_cache(tweets, User, 'user_id', '_cached_user')
+        UserService.prefetch_profiles(users)
+        self.assertIsNone(tweets[0].cached_user.profile.nickname)
+
+        # profile 改变之后，LRU 里的 user 上不能带着旧的 profile
+        profile = UserProfile.objects.get(user=alice)
+        profile.nickname = 'ali'
+        profile.save()
+        tweets = [self.create_tweet(alice)]
+        users = MemcachedHelper.prefetch_objects_through_cache(tweets, User, 'user_id', '_cached_user')
+        UserService.prefetch_profiles(users)
+        self.assertEqual(tweets[0].cached_user.profile.nickname, 'ali')
+
+    @override_settings(USER_LAST_ACTIVE_TOUCH_INTERVAL=60)
+    def test_touch_last_active(self):
+        alice = self.create_user('alice')
+        bob = self.create_user('bob')
+        UserService._last_touched_at = {}
+        conn = RedisClient.get_connection()
+        UserService.touch_last_active(alice.id)
+        last_active = conn.zscore(USER_LAST_ACTIVE_KEY, alice.id)
+        self.assertIsNotNone(last_active)
+
+        # 一分钟之内的请求不会再写 redis
+        UserService.touch_last_active(alice.id)
+        self.assertEqual(conn.zscore(USER_LAST_ACTIVE_KEY, alice.id), last_active)
+
+        # 很久没有活跃的用户被删掉
+        conn.zadd(USER_LAST_ACTIVE_KEY, {bob.id: 0})
+        self.assertEqual(UserService.trim_last_active(), 1)
+        self.assertIsNone(conn.zscore(USER_LAST_ACTIVE_KEY, bob.id))
+        self.assertEqual(UserService.get_recently_active_user_ids(10), [alice.id])
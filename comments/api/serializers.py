@@ -1,9 +1,13 @@
+from django.contrib.auth.models import User
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from accounts.api.serializers import UserSerializerForComment
+from accounts.services import UserService
 from comments.models import Comment
 from likes.services import LikeService
 from tweets.models import Tweet
+from utils.memcached_helper import MemcachedHelper
+from utils.serializers import PrefetchListSerializer
 
 
 class CommentSerializer(serializers.ModelSerializer):
@@ -23,10 +27,33 @@ class CommentSerializer(serializers.ModelSerializer):
             'likes_count',
             'has_liked',
         )
+        list_serializer_class = PrefetchListSerializer
+
+    @classmethod
+    def prefetch_for_page(cls, comments, context):
+        users = MemcachedHelper.prefetch_objects_through_cache(
+            comments,
+            User,
+            'user_id',
+            '_cached_user',
+        )
+        UserService.prefetch_profiles(users)
+        request = context.get('request')
+        if request is not None:
+            comment_ids = [comment.id for comment in comments]
+            liked_ids = LikeService.get_liked_object_ids(request.user, Comment, comment_ids)
+            context.setdefault('comment_has_liked', {}).update({
+                comment_id: comment_id in liked_ids
+                for comment_id in comment_ids
+            })
+
     def get_likes_count(self, obj):
         return obj.like_set.count()
 
     def get_has_liked(self, obj):
+        has_liked = self.context.get('comment_has_liked', {})
+        if obj.id in has_liked:
+            return has_liked[obj.id]
         return LikeService.has_liked(self.context['request'].user, obj)
 
 class CommentSerializerForCreate(serializers.ModelSerializer):
@@ -1,3 +1,4 @@
+from django.conf import settings
 from utils.listeners import invalidate_object_cache
 from utils.redis_helper import RedisHelper
 
@@ -10,6 +11,9 @@ def incr_comments_count(sender, instance, created, **kwargs):
         return
 
     # handle new comment
+    if settings.COUNTER_WRITE_BEHIND:
+        RedisHelper.record_count_delta(instance.tweet, 'comments_count', 1)
+        return
     Tweet.objects.filter(id=instance.tweet_id)\
         .update(comments_count=F('comments_count') + 1)
     invalidate_object_cache(sender=Tweet, instance=instance.tweet)
@@ -21,6 +25,9 @@ def decr_comments_count(sender, instance, **kwargs):
     from django.db.models import F
 
     # handle comment deletion
+    if settings.COUNTER_WRITE_BEHIND:
+        RedisHelper.record_count_delta(instance.tweet, 'comments_count', -1)
+        return
     Tweet.objects.filter(id=instance.tweet_id)\
         .update(comments_count=F('comments_count') - 1)
     invalidate_object_cache(sender=Tweet, instance=instance.tweet)
@@ -36,6 +36,9 @@ class Comment(models.Model):
 
     @property
     def cached_user(self):
+        # 一页的 users 会被批量的取出来放在 _cached_user 里
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
 
@@ -1,8 +1,12 @@
+from django.contrib.auth.models import User
 from rest_framework.exceptions import ValidationError
 from accounts.api.serializers import UserSerializerForFriendship
+from accounts.services import UserService
 from friendships.models import Friendship
 from rest_framework import serializers
 from friendships.services import FriendshipService
+from utils.memcached_helper import MemcachedHelper
+from utils.serializers import PrefetchListSerializer
 
 class FollowingUserIdSetMixin:
 
@@ -27,6 +31,17 @@ class FollowerSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
     class Meta:
         model = Friendship
         fields = ('user', 'created_at', 'has_followed')
+        list_serializer_class = PrefetchListSerializer
+
+    @classmethod
+    def prefetch_for_page(cls, friendships, context):
+        users = MemcachedHelper.prefetch_objects_through_cache(
+            friendships,
+            User,
+            'from_user_id',
+            '_cached_from_user',
+        )
+        UserService.prefetch_profiles(users)
 
     def get_has_followed(self, obj):
         return obj.from_user_id in self.following_user_id_set
@@ -38,6 +53,17 @@ class FollowingSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
     class Meta:
         model = Friendship
         fields = ('user', 'created_at', 'has_followed')
+        list_serializer_class = PrefetchListSerializer
+
+    @classmethod
+    def prefetch_for_page(cls, friendships, context):
+        users = MemcachedHelper.prefetch_objects_through_cache(
+            friendships,
+            User,
+            'to_user_id',
+            '_cached_to_user',
+        )
+        UserService.prefetch_profiles(users)
 
     def get_has_followed(self, obj):
         return obj.to_user_id in self.following_user_id_set
@@ -9,6 +9,7 @@ from friendships.api.serializers import (
 )
 from friendships.models import Friendship
 from friendships.services import FriendshipService
+from newsfeeds.services import NewsFeedService
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated, AllowAny
@@ -63,6 +64,7 @@ class FriendshipViewSet(viewsets.GenericViewSet):
             }, status=status.HTTP_400_BAD_REQUEST)
         serializer.save()
         FriendshipService.invalidate_following_cache(request.user.id)
+        NewsFeedService.backfill_newsfeeds(request.user.id, int(pk))
         return Response({'success': True}, status=status.HTTP_201_CREATED)
 
     @action(methods=['POST'], detail=True, permission_classes=[IsAuthenticated])
@@ -36,10 +36,15 @@ class Friendship(models.Model):
 
     @property
     def cached_from_user(self):
+        # 一页的 users 会被批量的取出来放在 _cached_from_user 和 _cached_to_user 里
+        if hasattr(self, '_cached_from_user'):
+            return self._cached_from_user
         return MemcachedHelper.get_object_through_cache(User, self.from_user_id)
 
     @property
     def cached_to_user(self):
+        if hasattr(self, '_cached_to_user'):
+            return self._cached_to_user
         return MemcachedHelper.get_object_through_cache(User, self.to_user_id)
 
 # hook up with listeners to invalidate cache
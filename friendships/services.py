@@ -1,7 +1,12 @@
+import time
+
 from django.conf import settings
 from django.core.cache import caches
+from django.db.models import Count, Q
 from friendships.models import Friendship
-from twitter.cache import FOLLOWINGS_PATTERN
+from twitter.cache import FOLLOWINGS_PATTERN, FOLLOWINGS_VERSION, FOLLOWER_COUNT_PATTERN
+from utils.cache_metrics import CacheMetrics
+from utils.time_constants import ONE_HOUR
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
@@ -41,22 +46,110 @@ class FriendshipService(object):
         friendships = Friendship.objects.filter(to_user_id=to_user_id)
         return [friendship.from_user_id for friendship in friendships]
 
+    @classmethod
+    def get_follower_id_batch(cls, to_user_id, batch_size, cursor=None):
+        # 用 (created_at, id) 做 keyset pagination，可以利用 (to_user_id, created_at)
+        # 的索引（innodb 的二级索引里自带主键 id），每一批都是一次索引上的 range scan，
+        # 不会像 OFFSET 一样越往后越慢。values_list 也不需要创建 Friendship 的 model 实例
+        # cursor 是上一批最后一条 friendship 的 (created_at, id)，返回这一批的 follower ids
+        # 以及下一批的 cursor
+        queryset = Friendship.objects.filter(to_user_id=to_user_id)
+        if cursor is not None:
+            last_created_at, last_id = cursor
+            queryset = queryset.filter(
+                Q(created_at__gt=last_created_at) |
+                Q(created_at=last_created_at, id__gt=last_id)
+            )
+        rows = list(
+            queryset.order_by('created_at', 'id')
+            .values_list('id', 'from_user_id', 'created_at')[:batch_size]
+        )
+        if not rows:
+            return [], cursor
+        last_id, _, last_created_at = rows[-1]
+        return [from_user_id for _, from_user_id, _ in rows], (last_created_at, last_id)
+
+    @classmethod
+    def iter_follower_id_batches(cls, to_user_id, batch_size, cursor=None):
+        # 一批一批地读取 follower ids，而不是一次把所有 Friendship 都 load 到内存里
+        # 每次 yield (follower_ids, next_cursor)，调用方可以记录 cursor 用于断点续传
+        while True:
+            follower_ids, cursor = cls.get_follower_id_batch(to_user_id, batch_size, cursor)
+            if not follower_ids:
+                return
+            yield follower_ids, cursor
+            if len(follower_ids) < batch_size:
+                return
+
+    @classmethod
+    def get_follower_count(cls, user_id):
+        return cls.get_follower_counts([user_id])[user_id]
+
+    @classmethod
+    def get_follower_counts(cls, user_ids):
+        # 粉丝数只用来区分是否是明星用户，不需要很精确，所以不在 follow/unfollow 的时候
+        # invalidate，只依赖过期时间。否则明星用户每被 follow 一次就要重新 count 一次
+        keys = {
+            FOLLOWER_COUNT_PATTERN.format(user_id=user_id): user_id
+            for user_id in user_ids
+        }
+        counts = {
+            keys[key]: count
+            for key, count in cache.get_many(list(keys)).items()
+        }
+        missing_user_ids = [
+            user_id
+            for user_id in user_ids
+            if user_id not in counts
+        ]
+        if not missing_user_ids:
+            return counts
+
+        # 用一条 GROUP BY 的 query 把所有 cache miss 的 count 一起查出来
+        missing_counts = dict.fromkeys(missing_user_ids, 0)
+        rows = Friendship.objects.filter(
+            to_user_id__in=missing_user_ids,
+        ).values('to_user_id').annotate(count=Count('id'))
+        for row in rows:
+            missing_counts[row['to_user_id']] = row['count']
+        cache.set_many({
+            FOLLOWER_COUNT_PATTERN.format(user_id=user_id): count
+            for user_id, count in missing_counts.items()
+        }, timeout=ONE_HOUR)
+        counts.update(missing_counts)
+        return counts
+
     @classmethod
     def get_following_user_id_set(cls, from_user_id):
-        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        key = FOLLOWINGS_PATTERN.format(
+            version=FOLLOWINGS_VERSION,
+            user_id=from_user_id,
+        )
         user_id_set = cache.get(key)
+        pattern = CacheMetrics.get_pattern(key)
         if user_id_set is not None:
+            CacheMetrics.record_hits(pattern)
             return user_id_set
 
+        CacheMetrics.record_misses(pattern)
+        started_at = time.time()
         friendships = Friendship.objects.filter(from_user_id=from_user_id)
         user_id_set = set([
             fs.to_user_id
             for fs in friendships
         ])
         cache.set(key, user_id_set)
+        CacheMetrics.record_fill(
+            pattern,
+            time.time() - started_at,
+            CacheMetrics.get_pickled_size([user_id_set]),
+        )
         return user_id_set
 
     @classmethod
     def invalidate_following_cache(cls, from_user_id):
-        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        key = FOLLOWINGS_PATTERN.format(
+            version=FOLLOWINGS_VERSION,
+            user_id=from_user_id,
+        )
         cache.delete(key)
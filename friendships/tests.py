@@ -23,4 +23,26 @@ class FriendshipServiceTests(TestCase):
         Friendship.objects.filter(from_user=self.alice, to_user=self.bob).delete()
         FriendshipService.invalidate_following_cache(self.alice.id)
         user_id_set = FriendshipService.get_following_user_id_set(self.alice.id)
-        self.assertSetEqual(user_id_set, {user1.id, user2.id})
\ No newline at end of file
+        self.assertSetEqual(user_id_set, {user1.id, user2.id})
+
+    def test_iter_follower_id_batches(self):
+        follower_ids = []
+        for i in range(5):
+            follower = self.create_user('follower{}'.format(i))
+            Friendship.objects.create(from_user=follower, to_user=self.alice)
+            follower_ids.append(follower.id)
+
+        batches = [
+            batch_ids
+            for batch_ids, _ in FriendshipService.iter_follower_id_batches(self.alice.id, 2)
+        ]
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual(sum(batches, []), follower_ids)
+
+        # resume from the cursor of the first batch
+        _, cursor = FriendshipService.get_follower_id_batch(self.alice.id, 2)
+        batch_ids, _ = FriendshipService.get_follower_id_batch(self.alice.id, 2, cursor)
+        self.assertEqual(batch_ids, follower_ids[2:4])
+
+        batches = list(FriendshipService.iter_follower_id_batches(self.bob.id, 2))
+        self.assertEqual(batches, [])
@@ -1,11 +1,15 @@
+from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
 from accounts.api.serializers import UserSerializerForLike
+from accounts.services import UserService
 from comments.models import Comment
 from likes.models import Like
 from tweets.models import Tweet
+from utils.memcached_helper import MemcachedHelper
+from utils.serializers import PrefetchListSerializer
 
 class LikeSerializer(serializers.ModelSerializer):
     user = UserSerializerForLike(source='cached_user')
@@ -13,6 +17,17 @@ class LikeSerializer(serializers.ModelSerializer):
     class Meta:
         model = Like
         fields = ('user', 'created_at')
+        list_serializer_class = PrefetchListSerializer
+
+    @classmethod
+    def prefetch_for_page(cls, likes, context):
+        users = MemcachedHelper.prefetch_objects_through_cache(
+            likes,
+            User,
+            'user_id',
+            '_cached_user',
+        )
+        UserService.prefetch_profiles(users)
 
 class LikeSerializerForCreateAndCancelBase(serializers.ModelSerializer):
     content_type = serializers.ChoiceField(choices=['comment', 'tweet'])
@@ -1,3 +1,4 @@
+from django.conf import settings
 from utils.redis_helper import RedisHelper
 
 
@@ -19,6 +20,11 @@ def incr_likes_count(sender, instance, created, **kwargs):
     # 因为这个操作不是原子操作， 必须使用 update 语句才是原子操作
     # SQL Query：UPDATE likes_count = likes_count + 1 FROM tweets_table WHERE id=<instance.object_id>
     # mysql provides row lock, 锁保证线性执行
+    # 热门的 tweet 会在这个 row lock 上排队，write behind 模式下只更新 redis，
+    # 由 flush_tweet_counts_task 定时批量的写回数据库
+    if settings.COUNTER_WRITE_BEHIND:
+        RedisHelper.record_count_delta(instance.content_object, 'likes_count', 1)
+        return
     # 方法 1
     Tweet.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') + 1)
 
@@ -38,5 +44,30 @@ def decr_likes_count(sender, instance, **kwargs):
 
     # handle tweet likes cancel
     tweet = instance.content_object
+    if settings.COUNTER_WRITE_BEHIND:
+        RedisHelper.record_count_delta(tweet, 'likes_count', -1)
+        return
     Tweet.objects.filter(id=tweet.id).update(likes_count=F('likes_count') - 1)
     RedisHelper.decr_count(instance.content_object, 'likes_count')
+
+
+def add_liked_object_to_cache(sender, instance, created, **kwargs):
+    from likes.services import LikeService
+    from django.db import transaction
+
+    # LIKES_CACHE_ENABLED 关掉的时候不更新，再打开之前需要运行 manage.py clear_likes_cache
+    if not created or not settings.LIKES_CACHE_ENABLED:
+        return
+    # commit 之后再更新 cache，rollback 的 like 不会留在 cache 里，
+    # 正在 load 的 LikeService._load_liked_object_ids 也一定能查到这个 like
+    transaction.on_commit(lambda: LikeService.add_liked_object_to_cache(instance))
+
+
+def remove_liked_object_from_cache(sender, instance, **kwargs):
+    from likes.services import LikeService
+    from django.db import transaction
+
+    if not settings.LIKES_CACHE_ENABLED:
+        return
+    # pre_delete 的时候还没有删掉，这时候从数据库 load 的话会把它重新加回 cache 里
+    transaction.on_commit(lambda: LikeService.remove_liked_object_from_cache(instance))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from likes.services import LikeService
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete the cached liked object ids of all users. Run it right before turning '
+        'LIKES_CACHE_ENABLED back on, the cache is not updated while it is off.'
+    )
+
+    def handle(self, *args, **options):
+        deleted = LikeService.clear_liked_object_ids_cache()
+        self.stdout.write('{} liked ids caches deleted'.format(deleted))
@@ -5,7 +5,12 @@ from django.contrib.auth.models import User
 from django.db.models.signals import pre_delete, post_save
 
 from accounts.services import UserService
-from likes.listeners import decr_likes_count, incr_likes_count
+from likes.listeners import (
+    add_liked_object_to_cache,
+    decr_likes_count,
+    incr_likes_count,
+    remove_liked_object_from_cache,
+)
 from utils.memcached_helper import MemcachedHelper
 
 
@@ -45,8 +50,13 @@ class Like(models.Model):
         )
     @property
     def cached_user(self):
+        # 一页的 users 会被批量的取出来放在 _cached_user 里
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
 
 pre_delete.connect(decr_likes_count, sender=Like)
-post_save.connect(incr_likes_count, sender=Like)
\ No newline at end of file
+post_save.connect(incr_likes_count, sender=Like)
+pre_delete.connect(remove_liked_object_from_cache, sender=Like)
+post_save.connect(add_liked_object_to_cache, sender=Like)
@@ -1,5 +1,17 @@
+import uuid
+
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from likes.models import Like
+from redis.exceptions import WatchError
+from twitter.cache import USER_LIKED_IDS_PATTERN
+from utils.redis_client import RedisClient
+
+# 每个用户的 liked ids 的 set 里的两个特殊的 member
+# LOADED 表示已经从数据库 load 过最近的 likes，COMPLETE 表示 load 的是这个用户所有的 likes
+LIKED_IDS_LOADED = 'loaded'
+LIKED_IDS_COMPLETE = 'complete'
+
 
 class LikeService(object):
 
@@ -12,3 +24,133 @@ class LikeService(object):
             object_id=target.id,
             user=user,
         ).exists()
+
+    @classmethod
+    def get_liked_object_ids(cls, user, model_class, object_ids):
+        # 一页 objects 里 user 点过赞的 object ids，只需要一次用到
+        # (user, content_type, object_id) 这个 unique index 的 query
+        # settings.LIKES_CACHE_ENABLED 打开的时候先查 redis 里这个用户最近点过赞的 ids
+        object_ids = list(set(object_ids))
+        if user.is_anonymous or not object_ids:
+            return set()
+        content_type = ContentType.objects.get_for_model(model_class)
+        if not settings.LIKES_CACHE_ENABLED:
+            return cls._get_liked_object_ids_from_db(user, content_type, object_ids)
+
+        liked_ids, is_complete = cls._get_cached_liked_object_ids(user, content_type, object_ids)
+        if is_complete:
+            return liked_ids
+        # cache 里只有最近的 likes，不在里面的 ids 还需要去数据库里查
+        unknown_ids = [
+            object_id
+            for object_id in object_ids
+            if object_id not in liked_ids
+        ]
+        return liked_ids | cls._get_liked_object_ids_from_db(user, content_type, unknown_ids)
+
+    @classmethod
+    def _get_liked_object_ids_from_db(cls, user, content_type, object_ids):
+        if not object_ids:
+            return set()
+        return set(Like.objects.filter(
+            user=user,
+            content_type=content_type,
+            object_id__in=object_ids,
+        ).values_list('object_id', flat=True))
+
+    @classmethod
+    def _get_liked_ids_key(cls, user_id, content_type):
+        return USER_LIKED_IDS_PATTERN.format(user_id=user_id, model=content_type.model)
+
+    @classmethod
+    def _get_cached_liked_object_ids(cls, user, content_type, object_ids):
+        # 返回 (cache 里 object_ids 中点过赞的 ids, cache 是否包含这个用户所有的 likes)
+        key = cls._get_liked_ids_key(user.id, content_type)
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.sismember(key, LIKED_IDS_LOADED)
+        pipeline.sismember(key, LIKED_IDS_COMPLETE)
+        for object_id in object_ids:
+            pipeline.sismember(key, object_id)
+        is_loaded, is_complete, *is_members = pipeline.execute()
+        if not is_loaded:
+            is_complete = cls._load_liked_object_ids(user, content_type)
+            if is_complete is None:
+                # load 的过程中有 like 或者 unlike，这一次直接用数据库的结果
+                return cls._get_liked_object_ids_from_db(user, content_type, object_ids), True
+            pipeline = conn.pipeline(transaction=False)
+            for object_id in object_ids:
+                pipeline.sismember(key, object_id)
+            is_members = pipeline.execute()
+        liked_ids = set(
+            object_id
+            for object_id, is_member in zip(object_ids, is_members)
+            if is_member
+        )
+        return liked_ids, bool(is_complete)
+
+    @classmethod
+    def _load_liked_object_ids(cls, user, content_type):
+        # 只 load 最近的 LIKES_CACHE_LIMIT 个 likes，这个用户的 likes 没有这么多的时候就是完整的
+        # 和 RedisHelper._rebuild_key 一样 WATCH 住 key 之后再查数据库，写到临时的 key 里再
+        # RENAME 过去。查询的过程中 listener 更新了 key 的话放弃这次 load 并返回 None，
+        # 否则查询之后才 commit 的 unlike 会被旧的数据库结果覆盖掉
+        limit = settings.LIKES_CACHE_LIMIT
+        key = cls._get_liked_ids_key(user.id, content_type)
+        conn = RedisClient.get_connection()
+        with conn.pipeline() as pipeline:
+            pipeline.watch(key)
+            object_ids = list(Like.objects.filter(
+                user=user,
+                content_type=content_type,
+            ).order_by('-created_at').values_list('object_id', flat=True)[:limit + 1])
+            is_complete = len(object_ids) <= limit
+            markers = [LIKED_IDS_LOADED, LIKED_IDS_COMPLETE] if is_complete else [LIKED_IDS_LOADED]
+            tmp_key = '{}:tmp:{}'.format(key, uuid.uuid4().hex)
+            pipeline.multi()
+            pipeline.sadd(tmp_key, *(object_ids[:limit] + markers))
+            pipeline.expire(tmp_key, settings.LIKES_CACHE_EXPIRE_TIME)
+            pipeline.rename(tmp_key, key)
+            try:
+                pipeline.execute()
+            except WatchError:
+                return None
+        return is_complete
+
+    @classmethod
+    def clear_liked_object_ids_cache(cls):
+        # LIKES_CACHE_ENABLED 关掉的时候 listener 不会更新 cache，再打开之前需要清空
+        # 关掉之前留下来的 sets，返回删掉的 key 的数量
+        conn = RedisClient.get_connection()
+        pattern = USER_LIKED_IDS_PATTERN.format(user_id='*', model='*')
+        deleted, keys = 0, []
+        for key in conn.scan_iter(match=pattern, count=1000):
+            keys.append(key)
+            if len(keys) >= 1000:
+                deleted += conn.delete(*keys)
+                keys = []
+        if keys:
+            deleted += conn.delete(*keys)
+        return deleted
+
+    @classmethod
+    def add_liked_object_to_cache(cls, like):
+        # key 不存在的时候也可以 SADD，没有 LOADED 的 set 在读取的时候会从数据库 load
+        key = cls._get_liked_ids_key(
+            like.user_id,
+            ContentType.objects.get_for_id(like.content_type_id),
+        )
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.sadd(key, like.object_id)
+        pipeline.expire(key, settings.LIKES_CACHE_EXPIRE_TIME)
+        pipeline.execute()
+
+    @classmethod
+    def remove_liked_object_from_cache(cls, like):
+        key = cls._get_liked_ids_key(
+            like.user_id,
+            ContentType.objects.get_for_id(like.content_type_id),
+        )
+        conn = RedisClient.get_connection()
+        conn.srem(key, like.object_id)
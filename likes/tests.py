@@ -1,3 +1,82 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.contenttypes.models import ContentType
+from django.test import override_settings
+from likes.models import Like
+from likes.services import LikeService
+from testing.testcase import TestCase
+from tweets.models import Tweet
+from utils.redis_client import RedisClient
+
+
+class LikeServiceTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+        self.tweets = [self.create_tweet(self.bob) for _ in range(3)]
+
+    def test_get_liked_object_ids(self):
+        self.create_like(self.alice, self.tweets[0])
+        self.create_like(self.alice, self.tweets[2])
+        tweet_ids = [tweet.id for tweet in self.tweets]
+
+        with self.assertNumQueries(1):
+            liked_ids = LikeService.get_liked_object_ids(self.alice, Tweet, tweet_ids)
+        self.assertEqual(liked_ids, {self.tweets[0].id, self.tweets[2].id})
+        self.assertEqual(LikeService.get_liked_object_ids(self.bob, Tweet, tweet_ids), set())
+
+    @override_settings(LIKES_CACHE_ENABLED=True)
+    def test_get_liked_object_ids_from_cache(self):
+        self.create_like(self.alice, self.tweets[0])
+        tweet_ids = [tweet.id for tweet in self.tweets]
+
+        LikeService.get_liked_object_ids(self.alice, Tweet, tweet_ids)
+        # 用户所有的 likes 都已经在 cache 里了，不需要再访问数据库
+        with self.assertNumQueries(0):
+            liked_ids = LikeService.get_liked_object_ids(self.alice, Tweet, tweet_ids)
+        self.assertEqual(liked_ids, {self.tweets[0].id})
+
+        # like 和 unlike 在 commit 之后更新 cache
+        with self.run_on_commit():
+            like = self.create_like(self.alice, self.tweets[1])
+        liked_ids = LikeService.get_liked_object_ids(self.alice, Tweet, tweet_ids)
+        self.assertEqual(liked_ids, {self.tweets[0].id, self.tweets[1].id})
+        with self.run_on_commit():
+            like.delete()
+        liked_ids = LikeService.get_liked_object_ids(self.alice, Tweet, tweet_ids)
+        self.assertEqual(liked_ids, {self.tweets[0].id})
+
+        # cache 关掉的时候不更新 cache，重新打开之前清空
+        with override_settings(LIKES_CACHE_ENABLED=False), self.run_on_commit():
+            like = self.create_like(self.alice, self.tweets[1])
+        self.assertEqual(LikeService.clear_liked_object_ids_cache(), 1)
+        liked_ids = LikeService.get_liked_object_ids(self.alice, Tweet, tweet_ids)
+        self.assertEqual(liked_ids, {self.tweets[0].id, self.tweets[1].id})
+        like.delete()
+
+        # 只 cache 了最近的 likes 的时候，不在 cache 里的 ids 还要查数据库
+        self.clear_cache()
+        with override_settings(LIKES_CACHE_LIMIT=0):
+            liked_ids = LikeService.get_liked_object_ids(self.alice, Tweet, tweet_ids)
+        self.assertEqual(liked_ids, {self.tweets[0].id})
+
+    @override_settings(LIKES_CACHE_ENABLED=True)
+    def test_load_liked_object_ids_with_concurrent_update(self):
+        self.create_like(self.alice, self.tweets[0])
+        tweet_ids = [tweet.id for tweet in self.tweets]
+        conn = RedisClient.get_connection()
+        key = LikeService._get_liked_ids_key(self.alice.id, ContentType.objects.get_for_model(Tweet))
+        original_filter = Like.objects.filter
+
+        def filter_with_concurrent_update(*args, **kwargs):
+            # 查询数据库的过程中另一个请求的 like commit 了，更新了 cache
+            conn.sadd(key, self.tweets[0].id)
+            return original_filter(*args, **kwargs)
+
+        with mock.patch.object(Like.objects, 'filter', side_effect=filter_with_concurrent_update):
+            liked_ids = LikeService.get_liked_object_ids(self.alice, Tweet, tweet_ids)
+        # 放弃这一次 load，直接用数据库的结果
+        self.assertEqual(liked_ids, {self.tweets[0].id})
+        self.assertFalse(conn.sismember(key, 'loaded'))
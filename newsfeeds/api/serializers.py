@@ -1,10 +1,20 @@
 from rest_framework import serializers
 from newsfeeds.models import NewsFeed
 from tweets.api.serializers import TweetSerializer
+from utils.serializers import PrefetchListSerializer
 
 class NewsFeedSerializer(serializers.ModelSerializer):
     tweet = TweetSerializer(source='cached_tweet')
 
     class Meta:
         model = NewsFeed
-        fields = ('id', 'created_at', 'user', 'tweet')
\ No newline at end of file
+        fields = ('id', 'created_at', 'user', 'tweet')
+        list_serializer_class = PrefetchListSerializer
+
+    @classmethod
+    def prefetch_for_page(cls, newsfeeds, context):
+        # newsfeeds 的 tweets 已经由 NewsFeedService.hydrate_tweets 批量取出来了
+        TweetSerializer.prefetch_for_page(
+            [newsfeed.cached_tweet for newsfeed in newsfeeds],
+            context,
+        )
\ No newline at end of file
@@ -1,6 +1,8 @@
 from django.conf import settings
+from django.test import override_settings
 from rest_framework.test import APIClient
 from friendships.models import Friendship
+from newsfeeds.constants import CELEBRITY_FOLLOWER_THRESHOLD
 from newsfeeds.models import NewsFeed
 from newsfeeds.services import NewsFeedService
 from testing.testcase import TestCase
@@ -58,6 +60,27 @@ class NewsFeedApiTests(TestCase):
         self.assertEqual(len(response.data['results']), 2)
         self.assertEqual(response.data['results'][0]['tweet']['id'], posted_tweet_id)
 
+    def test_backfill_after_follow(self):
+        followed_user = self.create_user('followed')
+        tweets = [
+            self.create_tweet(followed_user, 'tweet{}'.format(i))
+            for i in range(2)
+        ]
+        self.alice_client.post(POST_TWEETS_URL, {'content': 'Hello World'})
+        response = self.alice_client.get(NEWSFEEDS_URL)
+        self.assertEqual(len(response.data['results']), 1)
+
+        # friendship commit 之后才开始 backfill
+        with self.run_on_commit():
+            self.alice_client.post(FOLLOW_URL.format(followed_user.id))
+        response = self.alice_client.get(NEWSFEEDS_URL)
+        results = response.data['results']
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]['tweet']['content'], 'Hello World')
+        self.assertEqual(results[1]['tweet']['id'], tweets[1].id)
+        self.assertEqual(results[2]['tweet']['id'], tweets[0].id)
+        self.assertEqual(NewsFeed.objects.filter(user=self.alice).count(), 3)
+
     def test_pagination(self):
         page_size = EndlessPagination.page_size
         followed_user = self.create_user('followed')
@@ -114,6 +137,45 @@ class NewsFeedApiTests(TestCase):
         self.assertEqual(len(response.data['results']), 1)
         self.assertEqual(response.data['results'][0]['id'], new_newsfeed.id)
 
+    @override_settings(REDIS_SORTED_SET_TIMELINES=True)
+    def test_pagination_with_sorted_set_cache(self):
+        page_size = EndlessPagination.page_size
+        followed_user = self.create_user('followed')
+        newsfeeds = []
+        for i in range(page_size * 2):
+            tweet = self.create_tweet(followed_user)
+            newsfeeds.append(self.create_newsfeed(user=self.alice, tweet=tweet))
+        newsfeeds = newsfeeds[::-1]
+
+        response = self.alice_client.get(NEWSFEEDS_URL)
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(
+            [result['id'] for result in response.data['results']],
+            [newsfeed.id for newsfeed in newsfeeds[:page_size]],
+        )
+
+        response = self.alice_client.get(
+            NEWSFEEDS_URL,
+            {'created_at__lt': newsfeeds[page_size - 1].created_at},
+        )
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(
+            [result['id'] for result in response.data['results']],
+            [newsfeed.id for newsfeed in newsfeeds[page_size:]],
+        )
+
+        tweet = self.create_tweet(followed_user)
+        new_newsfeed = self.create_newsfeed(user=self.alice, tweet=tweet)
+        response = self.alice_client.get(
+            NEWSFEEDS_URL,
+            {'created_at__gt': newsfeeds[0].created_at},
+        )
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(
+            [result['id'] for result in response.data['results']],
+            [new_newsfeed.id],
+        )
+
     def test_user_cache(self):
         profile = self.bob.profile
         profile.nickname = 'bob123'
@@ -210,4 +272,52 @@ class NewsFeedApiTests(TestCase):
 
         # cache expired
         self.clear_cache()
-        _test_newsfeeds_after_new_feed_pushed()
\ No newline at end of file
+        _test_newsfeeds_after_new_feed_pushed()
+
+    def test_celebrity_tweets_beyond_cached_list(self):
+        list_limit = settings.REDIS_LIST_LENGTH_LIMIT
+        page_size = EndlessPagination.page_size
+        celebrity = self.create_user('celebrity')
+        self.create_friendship(self.alice, celebrity)
+        for i in range(CELEBRITY_FOLLOWER_THRESHOLD):
+            self.create_friendship(self.create_user('fan{}'.format(i)), celebrity)
+        self.assertTrue(NewsFeedService.is_celebrity(celebrity.id))
+
+        users = [self.create_user('user{}'.format(i)) for i in range(5)]
+        tweet_ids = []
+        for i in range(list_limit + page_size):
+            tweet = self.create_tweet(user=users[i % 5], content='feed{}'.format(i))
+            self.create_newsfeed(self.alice, tweet)
+            tweet_ids.append(tweet.id)
+            # 明星用户的 tweets 不 fanout，有一半比 cache 里最老的 newsfeed 还要老
+            if i % 10 == 0:
+                tweet_ids.append(self.create_tweet(celebrity).id)
+
+        results = self._paginate_to_get_newsfeeds(self.alice_client)
+        self.assertEqual([result['tweet']['id'] for result in results], tweet_ids[::-1])
+
+    def test_deleted_tweet_of_celebrity(self):
+        celebrity = self.create_user('celebrity')
+        self.create_friendship(self.alice, celebrity)
+        # 成为明星用户之前发的 tweet 已经 fanout 到 alice 的 newsfeeds 里了
+        old_tweet = self.create_tweet(celebrity, 'before celebrity')
+        self.create_newsfeed(self.alice, old_tweet)
+        tweet = self.create_tweet(celebrity)
+        newsfeed = self.create_newsfeed(self.alice, tweet)
+        response = self.alice_client.get(NEWSFEEDS_URL)
+        self.assertEqual(len(response.data['results']), 2)
+
+        for i in range(CELEBRITY_FOLLOWER_THRESHOLD):
+            self.create_friendship(self.create_user('fan{}'.format(i)), celebrity)
+        self.assertTrue(NewsFeedService.is_celebrity(celebrity.id))
+        # 明星用户删除 tweet 的时候不会 retract followers 的 newsfeeds
+        with self.run_on_commit():
+            old_tweet.delete()
+        self.assertTrue(NewsFeed.objects.filter(user=self.alice, tweet__isnull=True).exists())
+
+        # cache 里和数据库里的 newsfeeds 都不会返回已经被删掉的 tweet
+        for _ in range(2):
+            response = self.alice_client.get(NEWSFEEDS_URL)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([result['id'] for result in response.data['results']], [newsfeed.id])
+            self.clear_cache()
@@ -1,7 +1,9 @@
+from django.conf import settings
 from django.utils.decorators import method_decorator
 from rest_framework import viewsets, status
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from accounts.services import UserService
 from newsfeeds.api.serializers import NewsFeedSerializer
 from newsfeeds.models import NewsFeed
 from newsfeeds.services import NewsFeedService
@@ -21,12 +23,31 @@ class NewsFeedViewSet(viewsets.GenericViewSet):
 
     @method_decorator(ratelimit(key='user', rate='5/s', method='GET', block=True))
     def list(self, request):
-        cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(request.user.id)
-        page = self.paginator.paginate_cached_list(cached_newsfeeds, request)
+        UserService.touch_last_active(request.user.id)
+        if settings.REDIS_SORTED_SET_TIMELINES:
+            page = self.paginator.paginate_cached_sorted_set(
+                lambda max_score, min_score, count: NewsFeedService.get_cached_newsfeeds_by_score(
+                    request.user.id,
+                    max_score,
+                    min_score,
+                    count,
+                ),
+                request,
+            )
+        else:
+            cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(request.user.id)
+            page = self.paginator.paginate_cached_list(cached_newsfeeds, request)
         # page 是 None 代表现在请求的数据可能不再cache里， 需要直接去DB去获取
+        # 明星用户的 tweets 没有 fanout，需要和数据库里的 newsfeeds 一起 merge 之后再分页
         if page is None:
-            queryset = NewsFeed.objects.filter(user=request.user)
-            page = self.paginate_queryset(queryset)
+            newsfeeds = NewsFeedService.get_newsfeeds_from_db(
+                request.user.id,
+                request.query_params.get('created_at__lt'),
+                self.paginator.page_size + 1,
+            )
+            page = self.paginator.paginate_ordered_list(newsfeeds, request)
+        # tweet 已经被删掉了的 newsfeeds 不返回
+        page = NewsFeedService.hydrate_tweets(page)
         serializer = NewsFeedSerializer(
             page,
             context = {'request':request},
@@ -1,3 +1,37 @@
 from django.conf import settings
 
-FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
\ No newline at end of file
+FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
+
+# follow 一个用户之后，把他最近的多少条 tweets 加到自己的 newsfeeds 里
+NEWSFEED_BACKFILL_LIMIT = 20
+
+# 粉丝数超过这个值的用户（明星用户）发帖时不做 fanout（push），
+# 而是在粉丝读取 newsfeed 的时候从明星用户的 user_tweets cache 里 pull 过来
+CELEBRITY_FOLLOWER_THRESHOLD = getattr(
+    settings,
+    'CELEBRITY_FOLLOWER_THRESHOLD',
+    100000,
+) if not settings.TESTING else 5
+
+# 根据作者的粉丝数把 fanout 分成不同的 tier，不同的 tier 用不同的 queue 和 worker 处理
+# 这样明星用户的 fanout 不会阻塞普通用户的 fanout
+FANOUT_INLINE_FOLLOWER_LIMIT = 100 if not settings.TESTING else 2
+FANOUT_LARGE_FOLLOWER_THRESHOLD = 10000 if not settings.TESTING else 4
+
+
+class FanoutTier:
+    # 粉丝很少，直接在 main task 里完成 fanout，不用再创建 batch 任务
+    SMALL = 'small'
+    MEDIUM = 'medium'
+    LARGE = 'large'
+    # 不做 fanout，读取的时候 pull，参见 CELEBRITY_FOLLOWER_THRESHOLD
+    CELEBRITY = 'celebrity'
+
+
+# 每个 tier 的 (main task 的 queue, batch task 的 queue)
+FANOUT_TIER_QUEUES = {
+    FanoutTier.SMALL: ('default', None),
+    FanoutTier.MEDIUM: ('default', 'newsfeeds'),
+    FanoutTier.LARGE: ('newsfeeds_large', 'newsfeeds_large'),
+    FanoutTier.CELEBRITY: ('default', None),
+}
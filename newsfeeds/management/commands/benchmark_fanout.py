@@ -0,0 +1,248 @@
+import json
+import multiprocessing
+import subprocess
+import time
+
+import redis
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+
+from friendships.models import Friendship
+from friendships.services import FriendshipService
+from newsfeeds.constants import FANOUT_BATCH_SIZE
+from newsfeeds.models import NewsFeed
+from newsfeeds.services import NewsFeedService
+from newsfeeds.tasks import fanout_newsfeeds_batch_task, fanout_newsfeeds_main_task
+from tweets.models import Tweet
+from twitter.cache import USER_LAST_ACTIVE_KEY
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+
+SEED_BATCH_SIZE = 5000
+
+
+def _init_worker():
+    # fork 出来的子进程不能和父进程共用数据库和 redis 的连接
+    connections.close_all()
+    RedisClient.reset()
+
+
+def _run_batch(args):
+    tweet_id, follower_ids = args
+    fanout_newsfeeds_batch_task(tweet_id, follower_ids)
+    return len(follower_ids)
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark newsfeed fanout against synthetic follower graphs. '
+        'Prints one JSON object per (followers, mode) run. '
+        'Run with --settings=twitter.benchmark_settings to use sqlite and a local redis.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--followers',
+            default='1000,100000,1000000',
+            help='comma separated follower counts to benchmark',
+        )
+        parser.add_argument(
+            '--mode',
+            choices=['eager', 'multiprocess', 'both'],
+            default='eager',
+            help='eager runs fanout_newsfeeds_main_task inline, multiprocess runs '
+                 'fanout_newsfeeds_batch_task in a process pool',
+        )
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument(
+            '--active-ratio',
+            type=float,
+            default=0.2,
+            help='fraction of followers that are active and have a cached newsfeed',
+        )
+        parser.add_argument(
+            '--fakeredis',
+            action='store_true',
+            help='use an in-process fakeredis instead of a redis server (eager mode only)',
+        )
+
+    def handle(self, *args, **options):
+        if options['fakeredis']:
+            if options['mode'] != 'eager':
+                raise CommandError('--fakeredis only works with --mode=eager')
+            try:
+                import fakeredis
+            except ImportError:
+                raise CommandError('fakeredis is not installed, pip install fakeredis')
+            conn = fakeredis.FakeRedis()
+            for name in (RedisClient.CACHE, RedisClient.COUNTERS, RedisClient.BROKER):
+                RedisClient.set_connection(conn, name)
+
+        modes = ['eager', 'multiprocess'] if options['mode'] == 'both' else [options['mode']]
+        commit = self._get_commit()
+        for follower_count in [int(n) for n in options['followers'].split(',')]:
+            author, follower_ids = self._seed(follower_count)
+            for mode in modes:
+                result = self._benchmark(
+                    author,
+                    follower_ids,
+                    mode,
+                    options['workers'],
+                    options['active_ratio'],
+                )
+                result.update({
+                    'commit': commit,
+                    'database': settings.DATABASES['default']['ENGINE'],
+                    'fanout_batch_size': FANOUT_BATCH_SIZE,
+                    'followers': follower_count,
+                    'mode': mode,
+                })
+                self.stdout.write(json.dumps(result, sort_keys=True))
+
+    def _get_commit(self):
+        try:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'],
+                cwd=str(settings.BASE_DIR),
+                stderr=subprocess.DEVNULL,
+            ).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def _seed(self, follower_count):
+        # 每个规模的 follower graph 只需要创建一次，之后的运行直接复用
+        prefix = 'bench{}_'.format(follower_count)
+        author, created = User.objects.get_or_create(username=prefix + 'author')
+        existing_count = User.objects.filter(username__startswith=prefix + 'f').count()
+        for start in range(existing_count, follower_count, SEED_BATCH_SIZE):
+            end = min(start + SEED_BATCH_SIZE, follower_count)
+            # 用 '!' 作为 password 表示不可用的密码，省掉 hash 的开销
+            User.objects.bulk_create([
+                User(username='{}f{}'.format(prefix, i), password='!')
+                for i in range(start, end)
+            ])
+            self.stderr.write('seeded {}/{} followers'.format(end, follower_count))
+
+        follower_ids = list(
+            User.objects.filter(username__startswith=prefix + 'f')
+            .order_by('id')
+            .values_list('id', flat=True)
+        )
+        followed_ids = set(
+            Friendship.objects.filter(to_user_id=author.id)
+            .values_list('from_user_id', flat=True)
+        )
+        unfollowed_ids = [
+            follower_id
+            for follower_id in follower_ids
+            if follower_id not in followed_ids
+        ]
+        for start in range(0, len(unfollowed_ids), SEED_BATCH_SIZE):
+            Friendship.objects.bulk_create([
+                Friendship(from_user_id=follower_id, to_user_id=author.id)
+                for follower_id in unfollowed_ids[start:start + SEED_BATCH_SIZE]
+            ])
+        return author, follower_ids
+
+    def _warm_active_followers(self, author, active_follower_ids):
+        # 活跃的 followers 在 redis 里有 newsfeeds 的 cache，fanout 的时候需要 push
+        tweet = Tweet.objects.create(user=author, content='benchmark warm up tweet')
+        NewsFeed.objects.bulk_create([
+            NewsFeed(user_id=follower_id, tweet_id=tweet.id)
+            for follower_id in active_follower_ids
+        ])
+        serializer = NewsFeedService._get_cache_serializer()
+        conn = RedisClient.get_connection()
+        for start in range(0, len(active_follower_ids), SEED_BATCH_SIZE):
+            pipeline = conn.pipeline(transaction=False)
+            for follower_id in active_follower_ids[start:start + SEED_BATCH_SIZE]:
+                key = NewsFeedService._get_cache_key(follower_id)
+                newsfeed = NewsFeed(user_id=follower_id, tweet_id=tweet.id, created_at=tweet.created_at)
+                pipeline.delete(key)
+                if settings.REDIS_SORTED_SET_TIMELINES:
+                    pipeline.zadd(key, {
+                        serializer.serialize(newsfeed): RedisHelper.get_created_at_score(newsfeed),
+                    })
+                else:
+                    pipeline.rpush(key, serializer.serialize(newsfeed))
+                pipeline.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+                # 和 UserService.touch_last_active 一样，只是放在 pipeline 里批量执行
+                pipeline.zadd(USER_LAST_ACTIVE_KEY, {follower_id: time.time()})
+            pipeline.execute()
+
+    def _get_redis_command_count(self):
+        # fakeredis 不支持 INFO，这种情况下 redis_ops_per_newsfeed 输出 null
+        # 不能用 RedisClient.get_stats()，它只统计当前进程，--mode multiprocess 的时候 fanout 在子进程里
+        try:
+            info = RedisClient.get_connection().info('stats')
+        except redis.ResponseError:
+            return None
+        return info.get('total_commands_processed')
+
+    def _benchmark(self, author, follower_ids, mode, workers, active_ratio):
+        active_follower_ids = follower_ids[:int(len(follower_ids) * active_ratio)]
+        self._warm_active_followers(author, active_follower_ids)
+        tweet = Tweet.objects.create(user=author, content='benchmark tweet')
+
+        commands_before = self._get_redis_command_count()
+        started_at = timezone.now()
+        start = time.time()
+        if mode == 'eager':
+            fanout_newsfeeds_main_task(tweet.id, author.id)
+        else:
+            self._fanout_in_process_pool(tweet, author, workers)
+        seconds = time.time() - start
+        commands_after = self._get_redis_command_count()
+
+        # newsfeed 的 created_at 是插入数据库的时间，也就是 follower 能看到这条 tweet 的时间
+        latencies = sorted(
+            (created_at - started_at).total_seconds() * 1000
+            for created_at in NewsFeed.objects.filter(tweet_id=tweet.id)
+            .exclude(user_id=author.id)
+            .values_list('created_at', flat=True)
+        )
+        redis_ops_per_newsfeed = None
+        if commands_before is not None and commands_after is not None and follower_ids:
+            # 减掉 benchmark 自己执行的一次 INFO
+            redis_ops_per_newsfeed = (commands_after - commands_before - 1) / len(follower_ids)
+        return {
+            'active_followers': len(active_follower_ids),
+            'newsfeeds_created': len(latencies),
+            'seconds': round(seconds, 3),
+            'rows_per_second': round(len(latencies) / seconds, 1) if seconds else None,
+            'redis_ops_per_newsfeed': redis_ops_per_newsfeed,
+            'visibility_latency_ms': {
+                'p50': self._percentile(latencies, 0.5),
+                'p99': self._percentile(latencies, 0.99),
+                'max': latencies[-1] if latencies else None,
+            },
+            'workers': workers if mode == 'multiprocess' else 1,
+        }
+
+    def _fanout_in_process_pool(self, tweet, author, workers):
+        # 模拟多个 celery worker 并发的执行 batch 任务
+        NewsFeed.objects.create(user_id=author.id, tweet_id=tweet.id)
+        connections.close_all()
+        pool = multiprocessing.Pool(workers, initializer=_init_worker)
+        try:
+            batches = (
+                (tweet.id, batch_ids)
+                for batch_ids, _ in FriendshipService.iter_follower_id_batches(
+                    author.id,
+                    FANOUT_BATCH_SIZE,
+                )
+            )
+            for _ in pool.imap_unordered(_run_batch, batches):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+
+    def _percentile(self, values, percentile):
+        if not values:
+            return None
+        index = min(len(values) - 1, int(len(values) * percentile))
+        return round(values[index], 3)
@@ -0,0 +1,76 @@
+import json
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from newsfeeds.models import NewsFeed
+from newsfeeds.redis_serializers import NewsFeedCompactSerializer
+from tweets.models import Tweet
+from utils.redis_serializer import CompactModelSerializer, DjangoModelSerializer
+from utils.time_helpers import utc_now
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark encoding and decoding of the objects cached in redis lists. '
+        'Prints one JSON object per (model, serializer). No database rows are created.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--objects', type=int, default=200)
+        parser.add_argument('--rounds', type=int, default=50)
+
+    def handle(self, *args, **options):
+        # 和 cache 里一样的 objects，只在内存里创建
+        now = utc_now()
+        user = User(id=1, username='benchmark')
+        tweets = [
+            Tweet(id=i + 1, user=user, content='benchmark tweet {} '.format(i) * 5, created_at=now)
+            for i in range(options['objects'])
+        ]
+        newsfeeds = [
+            NewsFeed(id=i + 1, user_id=user.id, tweet_id=tweet.id, created_at=now)
+            for i, tweet in enumerate(tweets)
+        ]
+        runs = [
+            ('tweet', tweets, DjangoModelSerializer),
+            ('tweet', tweets, CompactModelSerializer),
+            ('newsfeed', newsfeeds, DjangoModelSerializer),
+            ('newsfeed', newsfeeds, CompactModelSerializer),
+            ('newsfeed', newsfeeds, NewsFeedCompactSerializer),
+        ]
+        for model_name, objects, serializer in runs:
+            result = self._benchmark(objects, serializer, options['rounds'])
+            result.update({
+                'model': model_name,
+                'serializer': serializer.__name__,
+            })
+            self.stdout.write(json.dumps(result, sort_keys=True))
+
+    def _benchmark(self, objects, serializer, rounds):
+        # 先跑一次，让 CompactModelSerializer 把 schema 准备好
+        serialized_list = [serializer.serialize(obj) for obj in objects]
+
+        start = time.time()
+        for _ in range(rounds):
+            serialized_list = [serializer.serialize(obj) for obj in objects]
+        encode_seconds = time.time() - start
+
+        start = time.time()
+        for _ in range(rounds):
+            for serialized_data in serialized_list:
+                serializer.deserialize(serialized_data)
+        decode_seconds = time.time() - start
+
+        operations = rounds * len(objects)
+        return {
+            'objects': len(objects),
+            'rounds': rounds,
+            'avg_bytes': round(
+                sum(len(serialized_data) for serialized_data in serialized_list) / len(objects),
+                1,
+            ) if objects else None,
+            'encode_us': round(encode_seconds * 10 ** 6 / operations, 2) if operations else None,
+            'decode_us': round(decode_seconds * 10 ** 6 / operations, 2) if operations else None,
+        }
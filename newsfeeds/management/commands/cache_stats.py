@@ -0,0 +1,30 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from utils.cache_metrics import CacheMetrics
+from utils.redis_client import RedisClient
+
+
+class Command(BaseCommand):
+    help = (
+        'Print per key pattern cache hits, misses, tombstone hits, fill latency, fill bytes '
+        'and database fallbacks aggregated from all processes, as one JSON object.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset',
+            action='store_true',
+            help='clear the aggregated metrics after printing them',
+        )
+
+    def handle(self, *args, **options):
+        CacheMetrics.flush()
+        self.stdout.write(json.dumps({
+            'patterns': CacheMetrics.get_global_stats(),
+            # 只是这个进程自己的 redis 连接池和命令统计
+            'redis': RedisClient.get_stats(),
+        }, sort_keys=True, indent=2))
+        if options['reset']:
+            CacheMetrics.reset_global_stats()
@@ -0,0 +1,27 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from utils.redis_memory import RedisMemoryBudget
+
+
+class Command(BaseCommand):
+    help = (
+        'Print sampled redis memory usage per key pattern and the projected memory per '
+        'active user as one JSON object. With --evict, evict cold timelines first.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--samples', type=int, default=1000, help='number of random keys to sample')
+        parser.add_argument(
+            '--evict',
+            action='store_true',
+            help='evict idle timelines, and the coldest ones while over REDIS_MEMORY_BUDGET',
+        )
+
+    def handle(self, *args, **options):
+        if options['evict']:
+            evicted = RedisMemoryBudget.evict_cold_timelines()
+            self.stderr.write('{} cold timelines evicted'.format(evicted))
+        report = RedisMemoryBudget.get_report(options['samples'])
+        self.stdout.write(json.dumps(report, sort_keys=True, indent=2))
@@ -0,0 +1,128 @@
+import json
+import multiprocessing
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from accounts.services import UserService
+from friendships.services import FriendshipService
+from newsfeeds.services import NewsFeedService
+from tweets.services import TweetService
+from utils.memcached_helper import MemcachedHelper
+from utils.paginations import EndlessPagination
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+
+
+def _init_worker():
+    # fork 出来的子进程不能和父进程共用数据库和 redis 的连接
+    connections.close_all()
+    RedisClient.reset()
+
+
+def _warm_users(args):
+    # 重建一批用户第一页需要的所有 cache，返回 (warmed 的用户数, errors)
+    user_ids, page_size = args
+    errors = []
+    MemcachedHelper.get_objects_through_cache(User, user_ids)
+    UserService.get_profiles_through_cache(user_ids)
+
+    tweets = []
+    warmed = 0
+    for user_id in user_ids:
+        try:
+            FriendshipService.get_following_user_id_set(user_id)
+            # timeline 的 rebuild 本身就是用 pipeline 写入 redis 的
+            newsfeeds = NewsFeedService.get_cached_newsfeeds(user_id)[:page_size]
+            # 已经被删掉的 tweet 不会被 hydrate
+            newsfeeds = NewsFeedService.hydrate_tweets(newsfeeds)
+            tweets.extend(newsfeed.cached_tweet for newsfeed in newsfeeds)
+            tweets.extend(TweetService.get_cached_tweets(user_id)[:page_size])
+            warmed += 1
+        except Exception as e:
+            errors.append('user {}: {!r}'.format(user_id, e))
+
+    # 第一页上所有 tweets 的计数、作者和作者的 profile，每一批只需要固定次数的 round trip
+    tweets = list({tweet.id: tweet for tweet in tweets if tweet is not None}.values())
+    try:
+        RedisHelper.get_counts(tweets, ['likes_count', 'comments_count'])
+        authors = MemcachedHelper.prefetch_objects_through_cache(
+            tweets,
+            User,
+            'user_id',
+            '_cached_user',
+        )
+        UserService.prefetch_profiles(authors)
+    except Exception as e:
+        errors.append('tweets of users {}-{}: {!r}'.format(user_ids[0], user_ids[-1], e))
+    return warmed, errors
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the redis and memcached caches of the most recently active users '
+        '(timelines, tweet counters, profiles and following sets) before letting '
+        'traffic back in after a cache restart. Prints a JSON summary when done.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000, help='number of users to warm')
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help='number of worker processes, each holds at most one database connection',
+        )
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument(
+            '--page-size',
+            type=int,
+            default=EndlessPagination.page_size,
+            help='number of timeline items per user whose counters and authors are warmed',
+        )
+
+    def handle(self, *args, **options):
+        user_ids = UserService.get_recently_active_user_ids(options['users'])
+        batch_size = options['batch_size']
+        batches = [
+            (user_ids[start:start + batch_size], options['page_size'])
+            for start in range(0, len(user_ids), batch_size)
+        ]
+        self.stderr.write('warming caches of {} users with {} workers'.format(
+            len(user_ids),
+            options['workers'],
+        ))
+
+        start = time.time()
+        done, warmed, errors = 0, 0, []
+        # 父进程的连接不能被子进程继承
+        connections.close_all()
+        RedisClient.reset()
+        with multiprocessing.Pool(options['workers'], initializer=_init_worker) as pool:
+            # 最活跃的用户排在前面，先被 warm
+            for (batch_user_ids, _), (batch_warmed, batch_errors) in zip(
+                batches,
+                pool.imap(_warm_users, batches),
+            ):
+                done += len(batch_user_ids)
+                warmed += batch_warmed
+                errors.extend(batch_errors)
+                for error in batch_errors:
+                    self.stderr.write(error)
+                elapsed = time.time() - start
+                self.stderr.write('warmed {}/{} users, {:.1f} users/s, {} errors'.format(
+                    done,
+                    len(user_ids),
+                    done / elapsed if elapsed else 0,
+                    len(errors),
+                ))
+
+        self.stdout.write(json.dumps({
+            'users': len(user_ids),
+            'warmed': warmed,
+            'errors': len(errors),
+            'seconds': round(time.time() - start, 3),
+            'workers': options['workers'],
+        }, sort_keys=True))
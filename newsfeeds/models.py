@@ -20,6 +20,9 @@ class NewsFeed(models.Model):
 
     @property
     def cached_tweet(self):
+        # 批量取出来的 tweet 会放在 _cached_tweet 里，避免一个一个的去 memcached 里取
+        if hasattr(self, '_cached_tweet'):
+            return self._cached_tweet
         return MemcachedHelper.get_object_through_cache(Tweet, self.tweet_id)
 
 post_save.connect(push_newsfeed_to_cache, sender=NewsFeed)
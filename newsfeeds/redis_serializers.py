@@ -0,0 +1,29 @@
+import struct
+
+from newsfeeds.models import NewsFeed
+from utils.time_helpers import datetime_to_microseconds, microseconds_to_datetime
+
+
+class NewsFeedCompactSerializer:
+    # 只存 (newsfeed_id, tweet_id, created_at) 三个 64 位整数，一共 24 bytes
+    # DjangoModelSerializer 序列化出来的 json 需要 150 bytes 以上，反序列化也慢很多
+    # user_id 就是 cache key 里的 user_id，不需要存。tweet 在读取之后再批量的从 memcached 里取
+    # bulk_create 出来的 newsfeed 在 MySQL 里拿不到 id，用 0 表示
+    packer = struct.Struct('>QQq')
+
+    @classmethod
+    def serialize(cls, newsfeed):
+        return cls.packer.pack(
+            newsfeed.id or 0,
+            newsfeed.tweet_id or 0,
+            datetime_to_microseconds(newsfeed.created_at),
+        )
+
+    @classmethod
+    def deserialize(cls, serialized_data):
+        newsfeed_id, tweet_id, created_at = cls.packer.unpack(serialized_data)
+        return NewsFeed(
+            id=newsfeed_id or None,
+            tweet_id=tweet_id or None,
+            created_at=microseconds_to_datetime(created_at),
+        )
@@ -1,8 +1,39 @@
+import json
+
+from dateutil import parser
+from django.conf import settings
+from django.db import transaction
 from friendships.services import FriendshipService
+from newsfeeds.constants import (
+    CELEBRITY_FOLLOWER_THRESHOLD,
+    FANOUT_INLINE_FOLLOWER_LIMIT,
+    FANOUT_LARGE_FOLLOWER_THRESHOLD,
+    FANOUT_TIER_QUEUES,
+    FanoutTier,
+)
 from newsfeeds.models import NewsFeed
-from twitter.cache import USER_NEWSFEEDS_PATTERN
+from newsfeeds.redis_serializers import NewsFeedCompactSerializer
+from tweets.models import Tweet
+from tweets.services import TweetService
+from twitter.cache import (
+    USER_NEWSFEEDS_PATTERN,
+    USER_NEWSFEED_IDS_PATTERN,
+    USER_NEWSFEEDS_ZSET_PATTERN,
+    USER_NEWSFEED_IDS_ZSET_PATTERN,
+    FANOUT_STATE_PATTERN,
+    FANOUT_STARTED_BATCHES_PATTERN,
+    FANOUT_DONE_BATCHES_PATTERN,
+)
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient
 from utils.redis_helper import RedisHelper
-from newsfeeds.tasks import fanout_newsfeeds_main_task
+from utils.time_constants import ONE_DAY
+from utils.time_helpers import microseconds_to_datetime
+from newsfeeds.tasks import (
+    backfill_newsfeeds_task,
+    fanout_newsfeeds_main_task,
+    retract_newsfeeds_main_task,
+)
 
 
 class NewsFeedService(object):
@@ -23,16 +54,384 @@ class NewsFeedService(object):
         # fanout_newsfeeds_task(tweet.id)
         # 在执行test的时候， delay会被去掉
         print("send task to fanout main task")
-        fanout_newsfeeds_main_task.delay(tweet.id, tweet.user_id)
+        # 粉丝很多的用户的 fanout 放到单独的 queue 里，不影响普通用户的 fanout
+        main_queue, _ = FANOUT_TIER_QUEUES[cls.get_fanout_tier(tweet.user_id)]
+        fanout_newsfeeds_main_task.apply_async(
+            args=(tweet.id, tweet.user_id),
+            queue=main_queue,
+            routing_key=main_queue,
+        )
+
+    @classmethod
+    def retract_from_followers(cls, tweet):
+        # fanout 的逆操作，tweet 被删除之后异步的把它从所有 followers 的 newsfeeds 里删掉
+        # commit 之后再创建任务，否则 worker 可能在删除 commit 之前就执行了，或者删除被
+        # rollback 之后 tweet 还在，newsfeeds 却已经被删掉了
+        tweet_id, tweet_user_id = tweet.id, tweet.user_id
+        transaction.on_commit(lambda: retract_newsfeeds_main_task.delay(tweet_id, tweet_user_id))
+
+    @classmethod
+    def backfill_newsfeeds(cls, user_id, followee_id):
+        # follow 之后马上异步的把被 follow 的用户最近的 tweets 加到 newsfeeds 里
+        # 和 retract_from_followers 一样等 friendship commit 之后再创建任务
+        transaction.on_commit(lambda: backfill_newsfeeds_task.delay(user_id, followee_id))
+
+    @classmethod
+    def get_fanout_tier(cls, user_id):
+        follower_count = FriendshipService.get_follower_count(user_id)
+        if follower_count > CELEBRITY_FOLLOWER_THRESHOLD:
+            return FanoutTier.CELEBRITY
+        if follower_count > FANOUT_LARGE_FOLLOWER_THRESHOLD:
+            return FanoutTier.LARGE
+        if follower_count > FANOUT_INLINE_FOLLOWER_LIMIT:
+            return FanoutTier.MEDIUM
+        return FanoutTier.SMALL
+
+    @classmethod
+    def is_celebrity(cls, user_id):
+        follower_count = FriendshipService.get_follower_count(user_id)
+        return follower_count > CELEBRITY_FOLLOWER_THRESHOLD
+
+    @classmethod
+    def get_followed_celebrity_ids(cls, user_id):
+        following_user_ids = list(FriendshipService.get_following_user_id_set(user_id))
+        if not following_user_ids:
+            return []
+        follower_counts = FriendshipService.get_follower_counts(following_user_ids)
+        return [
+            following_user_id
+            for following_user_id, count in follower_counts.items()
+            if count > CELEBRITY_FOLLOWER_THRESHOLD
+        ]
+
+    @classmethod
+    def _get_cache_key(cls, user_id):
+        if settings.REDIS_SORTED_SET_TIMELINES:
+            if settings.REDIS_COMPACT_NEWSFEEDS:
+                return USER_NEWSFEED_IDS_ZSET_PATTERN.format(user_id=user_id)
+            return USER_NEWSFEEDS_ZSET_PATTERN.format(user_id=user_id)
+        if settings.REDIS_COMPACT_NEWSFEEDS:
+            return USER_NEWSFEED_IDS_PATTERN.format(user_id=user_id)
+        return USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
+
+    @classmethod
+    def _get_cache_serializer(cls):
+        if settings.REDIS_COMPACT_NEWSFEEDS:
+            return NewsFeedCompactSerializer
+        return RedisHelper.get_serializer()
+
+    @classmethod
+    def _get_newsfeeds_queryset(cls, user_id):
+        # tweet 被删除之后 newsfeed.tweet 会被设置成 NULL，明星用户的 tweet 被删除的时候
+        # 不会去 retract 成为明星用户之前 fanout 出去的 newsfeeds，这些 newsfeeds 不能返回
+        return NewsFeed.objects.filter(user_id=user_id, tweet_id__isnull=False)
 
     @classmethod
     def get_cached_newsfeeds(cls, user_id):
-        queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at')
-        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, queryset)
+        queryset = cls._get_newsfeeds_queryset(user_id).order_by('-created_at')
+        key = cls._get_cache_key(user_id)
+        if settings.REDIS_SORTED_SET_TIMELINES:
+            newsfeeds, _ = RedisHelper.load_objects_by_score(
+                key,
+                queryset,
+                serializer=cls._get_cache_serializer(),
+            )
+        else:
+            newsfeeds = RedisHelper.load_objects(key, queryset, cls._get_cache_serializer())
+        # compact 格式里没有存 user_id
+        for newsfeed in newsfeeds:
+            newsfeed.user_id = user_id
+        newsfeeds = [newsfeed for newsfeed in newsfeeds if newsfeed.tweet_id is not None]
+
+        # 明星用户的 tweet 没有 fanout 到粉丝的 newsfeed 里，读的时候再 pull 过来
+        celebrity_ids = cls.get_followed_celebrity_ids(user_id)
+        if not celebrity_ids:
+            return newsfeeds
+        # 如果 cache 里的 newsfeeds 已经存满了，比最后一条更早的 tweet 没有办法和数据库里
+        # 没有被 cache 的 newsfeeds 排序，所以只 merge 比最后一条更新的 tweet
+        oldest_created_at = None
+        if len(newsfeeds) >= settings.REDIS_LIST_LENGTH_LIMIT:
+            oldest_created_at = newsfeeds[-1].created_at
+        celebrity_tweet_lists = [
+            TweetService.get_cached_tweets(celebrity_id)
+            for celebrity_id in celebrity_ids
+        ]
+        return cls._merge_celebrity_tweets(
+            user_id,
+            newsfeeds,
+            celebrity_tweet_lists,
+            oldest_created_at,
+        )
+
+    @classmethod
+    def get_cached_newsfeeds_by_score(cls, user_id, max_score='+inf', min_score='-inf', count=None):
+        # 只在 settings.REDIS_SORTED_SET_TIMELINES 打开的时候使用，参见
+        # RedisHelper.load_objects_by_score，返回 (newsfeeds, oldest_score)
+        queryset = cls._get_newsfeeds_queryset(user_id).order_by('-created_at')
+        newsfeeds, oldest_score = RedisHelper.load_objects_by_score(
+            cls._get_cache_key(user_id),
+            queryset,
+            max_score,
+            min_score,
+            count,
+            cls._get_cache_serializer(),
+        )
+        for newsfeed in newsfeeds:
+            newsfeed.user_id = user_id
+        newsfeeds = [newsfeed for newsfeed in newsfeeds if newsfeed.tweet_id is not None]
+
+        celebrity_ids = cls.get_followed_celebrity_ids(user_id)
+        if not celebrity_ids:
+            return newsfeeds, oldest_score
+        # 每个明星用户也只需要取同一个 score 范围里的前 count 条
+        celebrity_tweet_lists = [
+            TweetService.get_cached_tweets_by_score(celebrity_id, max_score, min_score, count)[0]
+            for celebrity_id in celebrity_ids
+        ]
+        oldest_created_at = None
+        if oldest_score is not None:
+            oldest_created_at = microseconds_to_datetime(int(oldest_score))
+        newsfeeds = cls._merge_celebrity_tweets(
+            user_id,
+            newsfeeds,
+            celebrity_tweet_lists,
+            oldest_created_at,
+        )
+        if count is not None:
+            newsfeeds = newsfeeds[:count]
+        return newsfeeds, oldest_score
+
+    @classmethod
+    def get_newsfeeds_from_db(cls, user_id, created_at__lt=None, count=None):
+        # cache 里的数据不够一页的时候直接去数据库分页，返回 created_at < created_at__lt 的
+        # 最多 count 个 newsfeeds。cache 里只 merge 了比最后一条更新的明星用户的 tweets，
+        # 更老的在这里从数据库 pull 过来，每个明星用户同样只需要取 count 条
+        queryset = cls._get_newsfeeds_queryset(user_id)
+        if created_at__lt is not None:
+            queryset = queryset.filter(created_at__lt=created_at__lt)
+        newsfeeds = list(queryset.order_by('-created_at')[:count])
+
+        celebrity_ids = cls.get_followed_celebrity_ids(user_id)
+        if not celebrity_ids:
+            return newsfeeds
+        celebrity_tweet_lists = []
+        for celebrity_id in celebrity_ids:
+            tweets = Tweet.objects.filter(user_id=celebrity_id)
+            if created_at__lt is not None:
+                tweets = tweets.filter(created_at__lt=created_at__lt)
+            celebrity_tweet_lists.append(list(tweets.order_by('-created_at')[:count]))
+        newsfeeds = cls._merge_celebrity_tweets(user_id, newsfeeds, celebrity_tweet_lists, None)
+        if count is not None:
+            newsfeeds = newsfeeds[:count]
+        return newsfeeds
+
+    @classmethod
+    def _merge_celebrity_tweets(cls, user_id, newsfeeds, celebrity_tweet_lists, oldest_created_at):
+        # 只 merge 比 oldest_created_at 更新的 tweet，oldest_created_at 为 None 表示 cache 里
+        # 已经是所有的 newsfeeds 了
+        # 成为明星用户之前发的 tweet 可能已经被 fanout 过了，需要去重
+        pushed_tweet_ids = set(newsfeed.tweet_id for newsfeed in newsfeeds)
+        pulled_newsfeeds = []
+        for tweets in celebrity_tweet_lists:
+            for tweet in tweets:
+                if tweet.id in pushed_tweet_ids:
+                    continue
+                if oldest_created_at and tweet.created_at <= oldest_created_at:
+                    break
+                # pull 过来的 newsfeed 并没有存在数据库里，所以没有 id
+                newsfeed = NewsFeed(
+                    user_id=user_id,
+                    tweet_id=tweet.id,
+                    created_at=tweet.created_at,
+                )
+                newsfeed._cached_tweet = tweet
+                pulled_newsfeeds.append(newsfeed)
+
+        return sorted(
+            newsfeeds + pulled_newsfeeds,
+            key=lambda newsfeed: newsfeed.created_at,
+            reverse=True,
+        )
+
+    @classmethod
+    def hydrate_tweets(cls, newsfeeds):
+        # 用一次 memcached 的 get_many 取出一页 newsfeeds 的所有 tweets
+        # 返回 tweet 还存在的 newsfeeds，cache 里可能还有 tweet 已经被删掉了的 newsfeeds
+        unhydrated_newsfeeds = [
+            newsfeed
+            for newsfeed in newsfeeds
+            if not hasattr(newsfeed, '_cached_tweet')
+        ]
+        tweets = MemcachedHelper.get_objects_through_cache(
+            Tweet,
+            [newsfeed.tweet_id for newsfeed in unhydrated_newsfeeds],
+        )
+        for newsfeed in unhydrated_newsfeeds:
+            newsfeed._cached_tweet = tweets.get(newsfeed.tweet_id)
+        return [
+            newsfeed
+            for newsfeed in newsfeeds
+            if newsfeed._cached_tweet is not None
+        ]
 
     @classmethod
     def push_newsfeed_to_cache(cls, newsfeed):
-        queryset = NewsFeed.objects.filter(user_id=newsfeed.user_id).order_by('-created_at')
-        key = USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id)
-        return RedisHelper.push_object(key, newsfeed, queryset)
+        queryset = cls._get_newsfeeds_queryset(newsfeed.user_id).order_by('-created_at')
+        key = cls._get_cache_key(newsfeed.user_id)
+        if settings.REDIS_SORTED_SET_TIMELINES:
+            return RedisHelper.push_object_to_sorted_set(
+                key,
+                newsfeed,
+                queryset,
+                cls._get_cache_serializer(),
+            )
+        return RedisHelper.push_object(key, newsfeed, queryset, cls._get_cache_serializer())
+
+    @classmethod
+    def push_newsfeeds_to_cache(cls, newsfeeds):
+        key_to_newsfeed = {
+            cls._get_cache_key(newsfeed.user_id): newsfeed
+            for newsfeed in newsfeeds
+        }
+        if settings.REDIS_SORTED_SET_TIMELINES:
+            RedisHelper.push_objects_to_sorted_sets_bulk(key_to_newsfeed, cls._get_cache_serializer())
+            return
+        RedisHelper.push_objects_bulk(key_to_newsfeed, cls._get_cache_serializer())
+
+    @classmethod
+    def merge_newsfeeds_to_cache(cls, user_id, newsfeeds):
+        if settings.REDIS_SORTED_SET_TIMELINES:
+            RedisHelper.merge_objects_to_sorted_set(
+                cls._get_cache_key(user_id),
+                newsfeeds,
+                unique_key=lambda newsfeed: newsfeed.tweet_id,
+                serializer=cls._get_cache_serializer(),
+            )
+            return
+        RedisHelper.merge_objects(
+            cls._get_cache_key(user_id),
+            newsfeeds,
+            sort_key=lambda newsfeed: newsfeed.created_at,
+            unique_key=lambda newsfeed: newsfeed.tweet_id,
+            serializer=cls._get_cache_serializer(),
+        )
+
+    @classmethod
+    def invalidate_cached_newsfeeds(cls, user_ids):
+        RedisHelper.invalidate_keys([
+            cls._get_cache_key(user_id)
+            for user_id in user_ids
+        ])
+
+    @classmethod
+    def remove_tweet_from_cached_newsfeeds(cls, tweet_id, user_ids):
+        keys = [
+            cls._get_cache_key(user_id)
+            for user_id in user_ids
+        ]
+        # 删除 tweet 的时候 newsfeed.tweet 会被 SET_NULL，所以 tweet_id 为 None 的也要删掉
+        remove_objects_bulk = RedisHelper.remove_objects_bulk
+        if settings.REDIS_SORTED_SET_TIMELINES:
+            remove_objects_bulk = RedisHelper.remove_objects_from_sorted_sets_bulk
+        remove_objects_bulk(
+            keys,
+            lambda newsfeed: newsfeed.tweet_id in (tweet_id, None),
+            cls._get_cache_serializer(),
+        )
+
+
+class FanoutStateService(object):
+    # 记录每条 tweet 的 fanout 进度，worker 挂掉或者任务被重复投递的时候可以断点续传
+    # fanout_state:{tweet_id} 是一个 hash:
+    #   cursor: 下一个 batch 开始读 followers 的 cursor
+    #   next_batch_id: 下一个 batch 的 id
+    #   finished: main task 已经把所有的 batch 都创建完了
+    #   batch:{batch_id}: 这个 batch 开始读 followers 的 cursor，用于重新执行这个 batch
+    # fanout_started:{tweet_id} 和 fanout_done:{tweet_id} 是已经开始/完成的 batch id 的 set
+
+    @classmethod
+    def _serialize_cursor(cls, cursor):
+        if cursor is None:
+            return ''
+        created_at, friendship_id = cursor
+        return json.dumps([created_at.isoformat(), friendship_id])
+
+    @classmethod
+    def _deserialize_cursor(cls, data):
+        if not data:
+            return None
+        created_at, friendship_id = json.loads(data)
+        return parser.isoparse(created_at), friendship_id
+
+    @classmethod
+    def get_state(cls, tweet_id):
+        conn = RedisClient.get_connection(RedisClient.BROKER)
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.hgetall(FANOUT_STATE_PATTERN.format(tweet_id=tweet_id))
+        pipeline.smembers(FANOUT_DONE_BATCHES_PATTERN.format(tweet_id=tweet_id))
+        state, done_batch_ids = pipeline.execute()
+        if not state:
+            return None
+
+        batches = {}
+        for field, value in state.items():
+            field = field.decode()
+            if field.startswith('batch:'):
+                batch_id = int(field[len('batch:'):])
+                batches[batch_id] = cls._deserialize_cursor(value.decode())
+        return {
+            'cursor': cls._deserialize_cursor(state[b'cursor'].decode()),
+            'next_batch_id': int(state[b'next_batch_id']),
+            'finished': state.get(b'finished') == b'1',
+            'batches': batches,
+            'done_batch_ids': set(int(batch_id) for batch_id in done_batch_ids),
+        }
+
+    @classmethod
+    def init_state(cls, tweet_id):
+        conn = RedisClient.get_connection(RedisClient.BROKER)
+        key = FANOUT_STATE_PATTERN.format(tweet_id=tweet_id)
+        pipeline = conn.pipeline()
+        pipeline.hsetnx(key, 'cursor', '')
+        pipeline.hsetnx(key, 'next_batch_id', 0)
+        pipeline.expire(key, ONE_DAY)
+        pipeline.execute()
+
+    @classmethod
+    def record_batch(cls, tweet_id, batch_id, cursor, next_cursor):
+        # 必须在 batch 任务创建之前记录，这样即使创建任务之前挂掉了，续传的时候也能
+        # 发现这个 batch 没有完成，从而重新执行
+        conn = RedisClient.get_connection(RedisClient.BROKER)
+        key = FANOUT_STATE_PATTERN.format(tweet_id=tweet_id)
+        conn.hset(key, mapping={
+            'batch:{}'.format(batch_id): cls._serialize_cursor(cursor),
+            'cursor': cls._serialize_cursor(next_cursor),
+            'next_batch_id': batch_id + 1,
+        })
+
+    @classmethod
+    def mark_finished(cls, tweet_id):
+        conn = RedisClient.get_connection(RedisClient.BROKER)
+        conn.hset(FANOUT_STATE_PATTERN.format(tweet_id=tweet_id), 'finished', 1)
+
+    @classmethod
+    def start_batch(cls, tweet_id, batch_id):
+        # 返回 (是否已经完成, 是否之前已经开始过)
+        conn = RedisClient.get_connection(RedisClient.BROKER)
+        started_key = FANOUT_STARTED_BATCHES_PATTERN.format(tweet_id=tweet_id)
+        done_key = FANOUT_DONE_BATCHES_PATTERN.format(tweet_id=tweet_id)
+        pipeline = conn.pipeline()
+        pipeline.sismember(done_key, batch_id)
+        pipeline.sadd(started_key, batch_id)
+        pipeline.expire(started_key, ONE_DAY)
+        is_done, added, _ = pipeline.execute()
+        return bool(is_done), not added
+
+    @classmethod
+    def finish_batch(cls, tweet_id, batch_id):
+        conn = RedisClient.get_connection(RedisClient.BROKER)
+        done_key = FANOUT_DONE_BATCHES_PATTERN.format(tweet_id=tweet_id)
+        pipeline = conn.pipeline()
+        pipeline.sadd(done_key, batch_id)
+        pipeline.expire(done_key, ONE_DAY)
+        pipeline.execute()
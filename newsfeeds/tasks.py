@@ -1,15 +1,30 @@
 from celery import shared_task
+from django.db.models import Case, DateTimeField, Q, Value, When
+from accounts.services import UserService
 from friendships.services import FriendshipService
-from newsfeeds.constants import FANOUT_BATCH_SIZE
+from newsfeeds.constants import (
+    FANOUT_BATCH_SIZE,
+    FANOUT_TIER_QUEUES,
+    NEWSFEED_BACKFILL_LIMIT,
+    FanoutTier,
+)
 from newsfeeds.models import NewsFeed
 from tweets.models import Tweet
 from utils.time_constants import ONE_HOUR
 
 
-@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
-def fanout_newsfeeds_batch_task(tweet_id, follower_ids):
+@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR, acks_late=True)
+def fanout_newsfeeds_batch_task(tweet_id, follower_ids, batch_id=None):
     # import 写在里面避免循环依赖
-    from newsfeeds.services import NewsFeedService
+    from newsfeeds.services import NewsFeedService, FanoutStateService
+
+    # 任务可能会被重复投递（比如 worker 挂掉之后 acks_late 的任务会被重新执行）
+    # 已经完成的 batch 直接跳过
+    is_retry = False
+    if batch_id is not None:
+        is_done, is_retry = FanoutStateService.start_batch(tweet_id, batch_id)
+        if is_done:
+            return 'batch {} of tweet {} already done'.format(batch_id, tweet_id)
 
     # 错误的方法
     # 不可以将数据库操作放在 for 循环里面，效率会非常低
@@ -28,26 +43,217 @@ def fanout_newsfeeds_batch_task(tweet_id, follower_ids):
         NewsFeed(user_id=follower_id, tweet_id=tweet_id)
         for follower_id in follower_ids
     ]
-    NewsFeed.objects.bulk_create(newsfeeds)
+    # 重新执行的时候，之前已经插入的 newsfeeds 会违反 (user, tweet) 的 unique 约束
+    # ignore_conflicts 会跳过这些数据而不是让整个 bulk_create 失败
+    NewsFeed.objects.bulk_create(newsfeeds, ignore_conflicts=True)
 
-    # bulk create 不会触发 post_save 的 signal，所以需要手动 push 到 cache 里
-    for newsfeed in newsfeeds:
-        NewsFeedService.push_newsfeed_to_cache(newsfeed)
+    if is_retry:
+        # 上一次执行可能已经 push 过其中一部分 cache 了，再 push 会出现重复的数据
+        # 所以直接删掉这些 followers 的 cache，下次读取的时候从数据库里重新 load
+        NewsFeedService.invalidate_cached_newsfeeds(follower_ids)
+    else:
+        # bulk create 不会触发 post_save 的 signal，所以需要手动 push 到 cache 里
+        # 整个 batch 用一次 pipeline push，而不是每个 newsfeed 都访问三次 redis
+        # 很久没有活跃的 followers 只写数据库，不 push 到 cache 里。push 会刷新 key 的过期时间，
+        # 他们的 cache 可能还没有过期，为了不丢数据直接删掉，下次读取的时候再从数据库里 load
+        # 整个 batch 的 key 用一条 DELETE 删掉
+        active_user_ids = UserService.get_active_user_ids(follower_ids)
+        NewsFeedService.push_newsfeeds_to_cache([
+            newsfeed
+            for newsfeed in newsfeeds
+            if newsfeed.user_id in active_user_ids
+        ])
+        NewsFeedService.invalidate_cached_newsfeeds([
+            follower_id
+            for follower_id in follower_ids
+            if follower_id not in active_user_ids
+        ])
 
+    if batch_id is not None:
+        FanoutStateService.finish_batch(tweet_id, batch_id)
     return "{} newsfeeds created".format(len(newsfeeds))
 
-@shared_task(routing_key='default', time_limit=ONE_HOUR)
+
+def _dispatch_fanout_batch(tweet_id, batch_ids, batch_id, tier):
+    _, batch_queue = FANOUT_TIER_QUEUES[tier]
+    if batch_queue is None:
+        # 粉丝很少的时候直接在当前任务里执行，省掉 message queue 的开销
+        fanout_newsfeeds_batch_task(tweet_id, batch_ids, batch_id)
+        return
+    fanout_newsfeeds_batch_task.apply_async(
+        args=(tweet_id, batch_ids, batch_id),
+        queue=batch_queue,
+        routing_key=batch_queue,
+    )
+
+
+def _fanout_newsfeeds(tweet_id, tweet_user_id, tier):
+    from newsfeeds.services import FanoutStateService
+
+    # 如果这条 tweet 之前已经 fanout 过一部分了，先把创建了但是没有完成的 batch 重新执行
+    # 然后从上次的 cursor 开始继续 fanout，已经完成的 batch 不会重复执行
+    state = FanoutStateService.get_state(tweet_id)
+    if state is None:
+        FanoutStateService.init_state(tweet_id)
+        state = {
+            'cursor': None,
+            'next_batch_id': 0,
+            'finished': False,
+            'batches': {},
+            'done_batch_ids': set(),
+        }
+
+    follower_count, batch_count = 0, 0
+    for batch_id, cursor in sorted(state['batches'].items()):
+        if batch_id in state['done_batch_ids']:
+            continue
+        batch_ids, _ = FriendshipService.get_follower_id_batch(
+            tweet_user_id,
+            FANOUT_BATCH_SIZE,
+            cursor,
+        )
+        _dispatch_fanout_batch(tweet_id, batch_ids, batch_id, tier)
+        follower_count += len(batch_ids)
+        batch_count += 1
+
+    if state['finished']:
+        return follower_count, batch_count
+
+    # 每读到一批 follower ids 就马上创建一个 batch 任务，不需要等所有 followers 读完
+    # main task 的内存占用也不会随着 followers 数量增长
+    cursor, batch_id = state['cursor'], state['next_batch_id']
+    for batch_ids, next_cursor in FriendshipService.iter_follower_id_batches(
+        tweet_user_id,
+        FANOUT_BATCH_SIZE,
+        cursor,
+    ):
+        FanoutStateService.record_batch(tweet_id, batch_id, cursor, next_cursor)
+        _dispatch_fanout_batch(tweet_id, batch_ids, batch_id, tier)
+        follower_count += len(batch_ids)
+        batch_count += 1
+        cursor, batch_id = next_cursor, batch_id + 1
+    FanoutStateService.mark_finished(tweet_id)
+    return follower_count, batch_count
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR, acks_late=True)
 def fanout_newsfeeds_main_task(tweet_id, tweet_user_id):
-    NewsFeed.objects.create(user_id=tweet_user_id, tweet_id=tweet_id)
+    from newsfeeds.services import NewsFeedService
+
+    # 任务可能被重复执行，用 get_or_create 避免违反 unique 约束
+    NewsFeed.objects.get_or_create(user_id=tweet_user_id, tweet_id=tweet_id)
 
-    follower_ids = FriendshipService.get_follower_ids(tweet_user_id)
-    index = 0
-    while index < len(follower_ids):
-        batch_ids = follower_ids[index:index+FANOUT_BATCH_SIZE]
-        fanout_newsfeeds_batch_task.delay(tweet_id, batch_ids)
-        index += FANOUT_BATCH_SIZE
+    # 明星用户的粉丝太多，fanout 会写入海量的 newsfeeds，改为粉丝读取的时候去 pull
+    tier = NewsFeedService.get_fanout_tier(tweet_user_id)
+    if tier == FanoutTier.CELEBRITY:
+        return 'fanout skipped for celebrity user {}.'.format(tweet_user_id)
 
+    follower_count, batch_count = _fanout_newsfeeds(tweet_id, tweet_user_id, tier)
     return '{} newsfeeds going to fanout, {} batches created.'.format(
-        len(follower_ids),
-        (len(follower_ids) - 1) // FANOUT_BATCH_SIZE + 1,
+        follower_count,
+        batch_count,
+    )
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def resume_fanout_newsfeeds_task(tweet_id, tweet_user_id):
+    from newsfeeds.services import NewsFeedService
+
+    # 用于 fanout 执行到一半失败（比如超过了 time_limit）之后手动继续 fanout
+    # 已经开始 fanout 的 tweet 就算作者后来变成了明星用户也要继续完成
+    tier = NewsFeedService.get_fanout_tier(tweet_user_id)
+    if tier == FanoutTier.CELEBRITY:
+        tier = FanoutTier.LARGE
+    follower_count, batch_count = _fanout_newsfeeds(tweet_id, tweet_user_id, tier)
+    return '{} newsfeeds resumed to fanout, {} batches created.'.format(
+        follower_count,
+        batch_count,
     )
+
+
+@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
+def retract_newsfeeds_batch_task(tweet_id, user_ids):
+    from newsfeeds.services import NewsFeedService
+
+    # tweet 被删除的时候 newsfeed.tweet 会被设置成 NULL，这些 newsfeeds 已经没有用了，
+    # 也一起删掉。用 user_id__in 可以走 (user, created_at) 的索引，一条 DELETE 删掉整个 batch
+    deleted, _ = NewsFeed.objects.filter(
+        Q(tweet_id=tweet_id) | Q(tweet_id__isnull=True),
+        user_id__in=user_ids,
+    ).delete()
+    NewsFeedService.remove_tweet_from_cached_newsfeeds(tweet_id, user_ids)
+    return '{} newsfeeds retracted'.format(deleted)
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def retract_newsfeeds_main_task(tweet_id, tweet_user_id):
+    from newsfeeds.services import NewsFeedService
+    from tweets.services import TweetService
+
+    TweetService.remove_tweet_from_cache(tweet_id, tweet_user_id)
+    retract_newsfeeds_batch_task.delay(tweet_id, [tweet_user_id])
+
+    # 和 fanout_newsfeeds_main_task 一样，明星用户的 tweets 没有 fanout 到 followers，
+    # 不需要遍历所有的 followers。成为明星用户之前 fanout 出去的 newsfeeds 的 tweet 已经
+    # 被设置成 NULL 了，读取的时候会被跳过，之后 retract 别的 tweet 的时候顺便删掉
+    if NewsFeedService.get_fanout_tier(tweet_user_id) == FanoutTier.CELEBRITY:
+        return 'retract skipped for celebrity user {}.'.format(tweet_user_id)
+
+    follower_count, batch_count = 0, 0
+    for batch_ids, _ in FriendshipService.iter_follower_id_batches(
+        tweet_user_id,
+        FANOUT_BATCH_SIZE,
+    ):
+        retract_newsfeeds_batch_task.delay(tweet_id, batch_ids)
+        follower_count += len(batch_ids)
+        batch_count += 1
+
+    return '{} newsfeeds going to retract, {} batches created.'.format(
+        follower_count,
+        batch_count,
+    )
+
+
+@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
+def backfill_newsfeeds_task(user_id, followee_id):
+    from newsfeeds.services import NewsFeedService
+    from tweets.services import TweetService
+
+    # 明星用户的 tweets 在读取 newsfeeds 的时候会被 pull 过来，不需要 backfill
+    if NewsFeedService.is_celebrity(followee_id):
+        return 'no backfill for celebrity user {}.'.format(followee_id)
+
+    tweets = TweetService.get_cached_tweets(followee_id)[:NEWSFEED_BACKFILL_LIMIT]
+    if not tweets:
+        return '0 newsfeeds backfilled'
+
+    NewsFeed.objects.bulk_create([
+        NewsFeed(user_id=user_id, tweet_id=tweet.id)
+        for tweet in tweets
+    ], ignore_conflicts=True)
+    # created_at 是 auto_now_add，bulk_create 的时候会被设置成当前时间
+    # 用一条 UPDATE 语句改成 tweet 的创建时间，这样才能排在 newsfeeds 里正确的位置上
+    queryset = NewsFeed.objects.filter(
+        user_id=user_id,
+        tweet_id__in=[tweet.id for tweet in tweets],
+    )
+    queryset.update(created_at=Case(
+        *[When(tweet_id=tweet.id, then=Value(tweet.created_at)) for tweet in tweets],
+        output_field=DateTimeField(),
+    ))
+
+    # 重新查一次拿到 id（MySQL 的 bulk_create 不会返回 id），再一次性合并到 cache 里
+    newsfeeds = list(queryset)
+    NewsFeedService.merge_newsfeeds_to_cache(user_id, newsfeeds)
+    return '{} newsfeeds backfilled'.format(len(newsfeeds))
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def evict_cold_timelines_task():
+    # 由 celery beat 每 REDIS_EVICTION_INTERVAL 秒执行一次
+    # 顺便把不再活跃的用户从 USER_LAST_ACTIVE_KEY 里删掉
+    from utils.redis_memory import RedisMemoryBudget
+
+    evicted = RedisMemoryBudget.evict_cold_timelines()
+    trimmed = UserService.trim_last_active()
+    return '{} cold timelines evicted, {} inactive users trimmed.'.format(evicted, trimmed)
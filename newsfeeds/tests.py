@@ -1,8 +1,22 @@
+from django.test import override_settings
+from accounts.services import UserService
+from friendships.services import FriendshipService
+from newsfeeds.constants import (
+    CELEBRITY_FOLLOWER_THRESHOLD,
+    FANOUT_BATCH_SIZE,
+    FANOUT_LARGE_FOLLOWER_THRESHOLD,
+    FanoutTier,
+)
 from newsfeeds.models import NewsFeed
-from newsfeeds.services import NewsFeedService
-from newsfeeds.tasks import fanout_newsfeeds_main_task
+from newsfeeds.services import NewsFeedService, FanoutStateService
+from newsfeeds.tasks import (
+    fanout_newsfeeds_batch_task,
+    fanout_newsfeeds_main_task,
+    resume_fanout_newsfeeds_task,
+    retract_newsfeeds_main_task,
+)
 from testing.testcase import TestCase
-from twitter.cache import USER_NEWSFEEDS_PATTERN
+from twitter.cache import USER_NEWSFEEDS_PATTERN, USER_NEWSFEED_IDS_PATTERN
 from utils.redis_client import RedisClient
 
 
@@ -50,6 +64,28 @@ class NewsFeedServiceTests(TestCase):
         feeds = NewsFeedService.get_cached_newsfeeds(self.alice.id)
         self.assertEqual([f.id for f in feeds], [feed2.id, feed1.id])
         
+    @override_settings(REDIS_COMPACT_NEWSFEEDS=True)
+    def test_compact_cached_newsfeeds(self):
+        newsfeeds = []
+        for i in range(3):
+            tweet = self.create_tweet(self.bob, 'tweet {}'.format(i))
+            newsfeeds.append(self.create_newsfeed(self.alice, tweet))
+        newsfeeds = newsfeeds[::-1]
+
+        conn = RedisClient.get_connection()
+        key = USER_NEWSFEED_IDS_PATTERN.format(user_id=self.alice.id)
+        # cache miss and cache hit
+        for _ in range(2):
+            cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(self.alice.id)
+            self.assertEqual(conn.exists(key), True)
+            self.assertEqual(
+                [(f.id, f.user_id, f.tweet_id, f.created_at) for f in cached_newsfeeds],
+                [(f.id, f.user_id, f.tweet_id, f.created_at) for f in newsfeeds],
+            )
+
+        NewsFeedService.hydrate_tweets(cached_newsfeeds)
+        self.assertEqual(cached_newsfeeds[0].cached_tweet.content, 'tweet 2')
+
 class NewsFeedTaskTests(TestCase):
 
     def setUp(self):
@@ -85,4 +121,123 @@ class NewsFeedTaskTests(TestCase):
         cached_list = NewsFeedService.get_cached_newsfeeds(self.alice.id)
         self.assertEqual(len(cached_list), 3)
         cached_list = NewsFeedService.get_cached_newsfeeds(self.bob.id)
-        self.assertEqual(len(cached_list), 3)
\ No newline at end of file
+        self.assertEqual(len(cached_list), 3)
+
+    def test_fanout_skipped_for_celebrity(self):
+        followers = []
+        for i in range(CELEBRITY_FOLLOWER_THRESHOLD + 1):
+            follower = self.create_user('follower{}'.format(i))
+            self.create_friendship(follower, self.alice)
+            followers.append(follower)
+
+        tweet = self.create_tweet(self.alice, 'celebrity tweet')
+        msg = fanout_newsfeeds_main_task(tweet.id, self.alice.id)
+        self.assertEqual(msg, 'fanout skipped for celebrity user {}.'.format(self.alice.id))
+        # only alice's own newsfeed is created
+        self.assertEqual(NewsFeed.objects.count(), 1)
+
+        # followers pull the tweet when reading their newsfeeds
+        bob_tweet = self.create_tweet(self.bob)
+        newsfeed = self.create_newsfeed(followers[0], bob_tweet)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(followers[0].id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [bob_tweet.id, tweet.id])
+        self.assertEqual(newsfeeds[0].id, newsfeed.id)
+
+        # 删除的时候也不需要遍历 followers
+        msg = retract_newsfeeds_main_task(tweet.id, self.alice.id)
+        self.assertEqual(msg, 'retract skipped for celebrity user {}.'.format(self.alice.id))
+
+    def test_resume_fanout(self):
+        for i in range(FANOUT_BATCH_SIZE + 1):
+            follower = self.create_user('follower{}'.format(i))
+            self.create_friendship(follower, self.alice)
+        tweet = self.create_tweet(self.alice)
+
+        # simulate a main task that died after the first batch was done
+        FanoutStateService.init_state(tweet.id)
+        batch_ids, cursor = FriendshipService.get_follower_id_batch(
+            self.alice.id,
+            FANOUT_BATCH_SIZE,
+        )
+        FanoutStateService.record_batch(tweet.id, 0, None, cursor)
+        fanout_newsfeeds_batch_task(tweet.id, batch_ids, 0)
+        self.assertEqual(NewsFeed.objects.count(), FANOUT_BATCH_SIZE)
+
+        msg = resume_fanout_newsfeeds_task(tweet.id, self.alice.id)
+        self.assertEqual(msg, '1 newsfeeds resumed to fanout, 1 batches created.')
+        self.assertEqual(NewsFeed.objects.count(), FANOUT_BATCH_SIZE + 1)
+
+        # a redelivered batch is skipped
+        msg = fanout_newsfeeds_batch_task(tweet.id, batch_ids, 0)
+        self.assertEqual(msg, 'batch 0 of tweet {} already done'.format(tweet.id))
+
+        # inserting existing newsfeeds again does not fail
+        fanout_newsfeeds_batch_task(tweet.id, batch_ids)
+        self.assertEqual(NewsFeed.objects.count(), FANOUT_BATCH_SIZE + 1)
+
+        # nothing left to resume
+        msg = resume_fanout_newsfeeds_task(tweet.id, self.alice.id)
+        self.assertEqual(msg, '0 newsfeeds resumed to fanout, 0 batches created.')
+
+    def test_retract_newsfeeds_when_tweet_deleted(self):
+        self.create_friendship(self.bob, self.alice)
+        tweet = self.create_tweet(self.alice)
+        fanout_newsfeeds_main_task(tweet.id, self.alice.id)
+        other_tweet = self.create_tweet(self.alice)
+        fanout_newsfeeds_main_task(other_tweet.id, self.alice.id)
+        self.assertEqual(NewsFeed.objects.count(), 4)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.bob.id)
+        self.assertEqual(len(newsfeeds), 2)
+
+        # 删除 commit 之后才开始 retract
+        with self.run_on_commit():
+            tweet.delete()
+        self.assertEqual(NewsFeed.objects.count(), 2)
+        for user in [self.alice, self.bob]:
+            newsfeeds = NewsFeedService.get_cached_newsfeeds(user.id)
+            self.assertEqual([f.tweet_id for f in newsfeeds], [other_tweet.id])
+
+    def test_fanout_skips_inactive_followers_cache(self):
+        self.create_friendship(self.bob, self.alice)
+        charlie = self.create_user('charlie')
+        self.create_friendship(charlie, self.alice)
+        self.create_newsfeed(self.bob, self.create_tweet(self.alice))
+        self.create_newsfeed(charlie, self.create_tweet(self.alice))
+        UserService.touch_last_active(self.bob.id)
+        self.assertEqual(
+            UserService.get_active_user_ids([self.bob.id, charlie.id]),
+            {self.bob.id},
+        )
+        # charlie 的 cache 还没有过期
+        NewsFeedService.get_cached_newsfeeds(charlie.id)
+
+        tweet = self.create_tweet(self.alice)
+        fanout_newsfeeds_main_task(tweet.id, self.alice.id)
+        conn = RedisClient.get_connection()
+        # active follower gets the newsfeed pushed into the cache
+        bob_key = USER_NEWSFEEDS_PATTERN.format(user_id=self.bob.id)
+        self.assertEqual(conn.llen(bob_key), 2)
+        # inactive follower's cache is dropped and rebuilt on the next read
+        charlie_key = USER_NEWSFEEDS_PATTERN.format(user_id=charlie.id)
+        self.assertEqual(conn.exists(charlie_key), False)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(charlie.id)
+        self.assertEqual(newsfeeds[0].tweet_id, tweet.id)
+
+    def test_get_fanout_tier(self):
+        self.assertEqual(NewsFeedService.get_fanout_tier(self.bob.id), FanoutTier.SMALL)
+
+        for i in range(FANOUT_LARGE_FOLLOWER_THRESHOLD):
+            follower = self.create_user('follower{}'.format(i))
+            self.create_friendship(follower, self.alice)
+        self.assertEqual(NewsFeedService.get_fanout_tier(self.alice.id), FanoutTier.MEDIUM)
+
+        charlie = self.create_user('charlie')
+        for i in range(FANOUT_LARGE_FOLLOWER_THRESHOLD + 1):
+            follower = self.create_user('charlie_follower{}'.format(i))
+            self.create_friendship(follower, charlie)
+        self.assertEqual(NewsFeedService.get_fanout_tier(charlie.id), FanoutTier.LARGE)
+
+        # large fanouts are still done through batches
+        tweet = self.create_tweet(charlie)
+        msg = fanout_newsfeeds_main_task(tweet.id, charlie.id)
+        self.assertEqual(msg, '5 newsfeeds going to fanout, 2 batches created.')
@@ -1,3 +1,5 @@
+from unittest import mock
+
 from django.contrib.contenttypes.models import ContentType
 from django.core.cache import caches
 from django.test import TestCase as DjangoTestCase
@@ -8,6 +10,9 @@ from friendships.models import Friendship
 from likes.models import Like
 from newsfeeds.models import NewsFeed
 from tweets.models import Tweet
+from utils.cache_metrics import CacheMetrics
+from utils.cache_versions import ModelCacheVersion
+from utils.local_cache import LocalObjectCache
 from utils.redis_client import RedisClient
 
 
@@ -16,6 +21,14 @@ class TestCase(DjangoTestCase):
     def clear_cache(self):
         caches['testing'].clear()
         RedisClient.clear()
+        LocalObjectCache.clear()
+        ModelCacheVersion.clear()
+        CacheMetrics.reset()
+
+    def run_on_commit(self):
+        # django 3.1 的 TestCase 不会 commit，transaction.on_commit 的 callback 永远不会执行
+        # 在这个 context manager 里改成立即执行
+        return mock.patch('django.db.transaction.on_commit', side_effect=lambda func, using=None: func())
 
     @property
     def anonymous_client(self):
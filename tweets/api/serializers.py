@@ -1,3 +1,4 @@
+from django.contrib.auth.models import User
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from comments.api.serializers import CommentSerializer
@@ -6,8 +7,11 @@ from likes.services import LikeService
 from tweets.constants import TWEET_PHOTOS_UPLOAD_LIMIT
 from tweets.models import Tweet
 from accounts.api.serializers import UserSerializerForTweet
+from accounts.services import UserService
 from tweets.services import TweetService
+from utils.memcached_helper import MemcachedHelper
 from utils.redis_helper import RedisHelper
+from utils.serializers import PrefetchListSerializer
 
 
 class TweetSerializer(serializers.ModelSerializer):
@@ -30,17 +34,54 @@ class TweetSerializer(serializers.ModelSerializer):
             'has_liked',
             'photo_urls',
         )
+        list_serializer_class = PrefetchListSerializer
+
+    @classmethod
+    def prefetch_for_page(cls, tweets, context):
+        # 序列化一页 tweets 之前，把每个 tweet 都需要的数据批量的取出来
+        # many=True 的时候由 PrefetchListSerializer 调用，嵌套在其他 serializer 里的时候
+        # 由外层 serializer 的 prefetch_for_page 调用
+        context.setdefault('tweet_counts', {}).update(
+            RedisHelper.get_counts(tweets, ['likes_count', 'comments_count']),
+        )
+        users = MemcachedHelper.prefetch_objects_through_cache(
+            tweets,
+            User,
+            'user_id',
+            '_cached_user',
+        )
+        UserService.prefetch_profiles(users)
+        # 一页 tweets 的 has_liked 用一次 query 查出来
+        request = context.get('request')
+        if request is not None:
+            tweet_ids = [tweet.id for tweet in tweets if tweet is not None]
+            liked_ids = LikeService.get_liked_object_ids(request.user, Tweet, tweet_ids)
+            context.setdefault('tweet_has_liked', {}).update({
+                tweet_id: tweet_id in liked_ids
+                for tweet_id in tweet_ids
+            })
+
+    def _get_count(self, obj, attr):
+        counts = self.context.get('tweet_counts', {}).get(obj.id, {})
+        if attr in counts:
+            return counts[attr]
+        return RedisHelper.get_count(obj, attr)
 
     def get_likes_count(self, obj):
         # select count(*) -> redis get
         # N + 1 Queries
         # N 如果是 db queries -> 不可接受的
         # N 如果是 redis/memcached queries -> 可以接受的
-        return RedisHelper.get_count(obj, 'likes_count')
+        # 一页的 tweets 的计数由 prefetch_for_page 一次取出来
+        return self._get_count(obj, 'likes_count')
 
     def get_comments_count(self, obj):
-        return RedisHelper.get_count(obj, 'comments_count')
+        return self._get_count(obj, 'comments_count')
+
     def get_has_liked(self, obj):
+        has_liked = self.context.get('tweet_has_liked', {})
+        if obj.id in has_liked:
+            return has_liked[obj.id]
         return LikeService.has_liked(self.context['request'].user, obj)
 
     def get_photo_urls(self, obj):
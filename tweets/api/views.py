@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.utils.decorators import method_decorator
 from rest_framework import viewsets
 from rest_framework.permissions import IsAuthenticated, AllowAny
@@ -24,8 +25,19 @@ class TweetViewSet(viewsets.GenericViewSet):
     @required_params(params=['user_id'])
     def list(self, request):
         user_id = request.query_params['user_id']
-        cached_tweets = TweetService.get_cached_tweets(user_id)
-        page = self.paginator.paginate_cached_list(cached_tweets, request)
+        if settings.REDIS_SORTED_SET_TIMELINES:
+            page = self.paginator.paginate_cached_sorted_set(
+                lambda max_score, min_score, count: TweetService.get_cached_tweets_by_score(
+                    user_id,
+                    max_score,
+                    min_score,
+                    count,
+                ),
+                request,
+            )
+        else:
+            cached_tweets = TweetService.get_cached_tweets(user_id)
+            page = self.paginator.paginate_cached_list(cached_tweets, request)
         if page is None:
             queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
             page = self.paginate_queryset(queryset)
@@ -1,3 +1,6 @@
+from utils.time_constants import ONE_HOUR
+
+
 class TweetPhotoStatus:
     PENDING = 0
     APPROVED = 1
@@ -10,4 +13,11 @@ TWEET_PHOTO_STATUS_CHOICES = (
     (TweetPhotoStatus.REJECTED, 'Rejected'),
 )
 
-TWEET_PHOTOS_UPLOAD_LIMIT = 9
\ No newline at end of file
+TWEET_PHOTOS_UPLOAD_LIMIT = 9
+
+# write behind 模式下每次 flush 到数据库的 tweet 数量
+COUNTER_FLUSH_BATCH_SIZE = 500
+# 每次 flush 任务最多执行的 batch 数量，剩下的留给下一次任务
+COUNTER_FLUSH_MAX_BATCHES = 20
+# 开始 flush 之后超过这个时间还没有 commit 的 delta 会被重新 flush，要大于任务的 time_limit
+COUNTER_FLUSH_RECOVER_TIMEOUT = 2 * ONE_HOUR
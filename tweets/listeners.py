@@ -2,4 +2,9 @@ def push_tweet_to_cache(sender, instance, created, **kwargs):
     if not created:
         return
     from tweets.services import TweetService
-    TweetService.push_tweet_to_cache(instance)
\ No newline at end of file
+    TweetService.push_tweet_to_cache(instance)
+
+
+def retract_tweet_from_newsfeeds(sender, instance, **kwargs):
+    from newsfeeds.services import NewsFeedService
+    NewsFeedService.retract_from_followers(instance)
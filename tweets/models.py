@@ -1,12 +1,12 @@
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_delete, post_save, pre_delete
 
 from accounts.services import UserService
 from likes.models import Like
 from tweets.constants import TweetPhotoStatus, TWEET_PHOTO_STATUS_CHOICES
-from tweets.listeners import push_tweet_to_cache
+from tweets.listeners import push_tweet_to_cache, retract_tweet_from_newsfeeds
 from utils.listeners import invalidate_object_cache
 from utils.memcached_helper import MemcachedHelper
 from utils.time_helpers import utc_now
@@ -50,6 +50,9 @@ class Tweet(models.Model):
 
     @property
     def cached_user(self):
+        # 一页的 users 会被批量的取出来放在 _cached_user 里
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
     def __str__(self):
@@ -97,4 +100,5 @@ class TweetPhoto(models.Model):
 
 post_save.connect(invalidate_object_cache, sender=Tweet)
 pre_delete.connect(invalidate_object_cache, sender=Tweet)
-post_save.connect(push_tweet_to_cache, sender=Tweet)
\ No newline at end of file
+post_save.connect(push_tweet_to_cache, sender=Tweet)
+post_delete.connect(retract_tweet_from_newsfeeds, sender=Tweet)
@@ -1,5 +1,6 @@
+from django.conf import settings
 from tweets.models import TweetPhoto, Tweet
-from twitter.cache import USER_TWEETS_PATTERN
+from twitter.cache import USER_TWEETS_PATTERN, USER_TWEETS_ZSET_PATTERN
 from utils.redis_helper import RedisHelper
 
 
@@ -18,16 +19,48 @@ class TweetService(object):
             photos.append(photo)
         TweetPhoto.objects.bulk_create(photos)
 
+    @classmethod
+    def _get_cache_key(cls, user_id):
+        if settings.REDIS_SORTED_SET_TIMELINES:
+            return USER_TWEETS_ZSET_PATTERN.format(user_id=user_id)
+        return USER_TWEETS_PATTERN.format(user_id=user_id)
+
     @classmethod
     def get_cached_tweets(cls, user_id):
         # Queryset is lazy loading
         queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
-        key = USER_TWEETS_PATTERN.format(user_id=user_id)
+        key = cls._get_cache_key(user_id)
+        if settings.REDIS_SORTED_SET_TIMELINES:
+            tweets, _ = RedisHelper.load_objects_by_score(key, queryset)
+            return tweets
         return RedisHelper.load_objects(key, queryset)
 
+    @classmethod
+    def get_cached_tweets_by_score(cls, user_id, max_score='+inf', min_score='-inf', count=None):
+        # 只在 settings.REDIS_SORTED_SET_TIMELINES 打开的时候使用
+        queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
+        return RedisHelper.load_objects_by_score(
+            cls._get_cache_key(user_id),
+            queryset,
+            max_score,
+            min_score,
+            count,
+        )
+
     @classmethod
     def push_tweet_to_cache(cls, tweet):
         # Queryset is lazy laoding
         queryset = Tweet.objects.filter(user_id=tweet.user_id).order_by('-created_at')
-        key = USER_TWEETS_PATTERN.format(user_id=tweet.user_id)
+        key = cls._get_cache_key(tweet.user_id)
+        if settings.REDIS_SORTED_SET_TIMELINES:
+            RedisHelper.push_object_to_sorted_set(key, tweet, queryset)
+            return
         RedisHelper.push_object(key, tweet, queryset)
+
+    @classmethod
+    def remove_tweet_from_cache(cls, tweet_id, user_id):
+        key = cls._get_cache_key(user_id)
+        if settings.REDIS_SORTED_SET_TIMELINES:
+            RedisHelper.remove_objects_from_sorted_sets_bulk([key], lambda tweet: tweet.id == tweet_id)
+            return
+        RedisHelper.remove_objects_bulk([key], lambda tweet: tweet.id == tweet_id)
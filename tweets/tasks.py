@@ -0,0 +1,24 @@
+from celery import shared_task
+from tweets.constants import (
+    COUNTER_FLUSH_BATCH_SIZE,
+    COUNTER_FLUSH_MAX_BATCHES,
+    COUNTER_FLUSH_RECOVER_TIMEOUT,
+)
+from tweets.models import Tweet
+from utils.redis_helper import RedisHelper
+from utils.time_constants import ONE_HOUR
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def flush_tweet_counts_task():
+    # settings.COUNTER_WRITE_BEHIND 打开的时候由 celery beat 定时执行
+    # 把 redis 里累计的 likes_count 和 comments_count 的变化批量的写回数据库
+    attrs = ['likes_count', 'comments_count']
+    RedisHelper.recover_count_deltas(Tweet, attrs, COUNTER_FLUSH_RECOVER_TIMEOUT)
+    flushed_count = 0
+    for _ in range(COUNTER_FLUSH_MAX_BATCHES):
+        count = RedisHelper.flush_count_deltas(Tweet, attrs, COUNTER_FLUSH_BATCH_SIZE)
+        if not count:
+            break
+        flushed_count += count
+    return '{} tweets counts flushed.'.format(flushed_count)
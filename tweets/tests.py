@@ -1,13 +1,17 @@
 from django.contrib.auth.models import User
+from django.test import override_settings
 from testing.testcase import TestCase
 from tweets.constants import TweetPhotoStatus
 from tweets.models import Tweet, TweetPhoto
 from datetime import timedelta
+from unittest import mock
 
 from tweets.services import TweetService
+from tweets.tasks import flush_tweet_counts_task
 from twitter.cache import USER_TWEETS_PATTERN
 from utils.redis_client import RedisClient
-from utils.redis_serializer import DjangoModelSerializer
+from utils.redis_helper import RedisHelper
+from utils.redis_serializer import CompactModelSerializer, DjangoModelSerializer
 from utils.time_helpers import utc_now
 
 
@@ -58,6 +62,96 @@ class TweetTests(TestCase):
         # assertEqual will compare content, even their in memory addresses are different
         self.assertEqual(tweet, cached_tweet)
 
+    def test_compact_model_serializer(self):
+        tweet = self.create_tweet(self.alice, '中文 tweet')
+        serialized_data = CompactModelSerializer.serialize(tweet)
+        self.assertEqual(CompactModelSerializer.is_compact(serialized_data), True)
+        self.assertLess(len(serialized_data), len(DjangoModelSerializer.serialize(tweet)))
+
+        cached_tweet = CompactModelSerializer.deserialize(serialized_data)
+        self.assertEqual(tweet, cached_tweet)
+        self.assertEqual(cached_tweet.user_id, self.alice.id)
+        self.assertEqual(cached_tweet.content, '中文 tweet')
+        self.assertEqual(cached_tweet.created_at, tweet.created_at)
+
+        # 两种格式可以互相解码，切换 serializer 的时候不需要清空 redis
+        legacy_data = DjangoModelSerializer.serialize(tweet)
+        self.assertEqual(CompactModelSerializer.deserialize(legacy_data), tweet)
+        self.assertEqual(DjangoModelSerializer.deserialize(serialized_data), tweet)
+
+    @override_settings(COUNTER_WRITE_BEHIND=True)
+    def test_write_behind_counts(self):
+        bob = self.create_user('bob')
+        self.create_like(self.alice, self.tweet)
+        like = self.create_like(bob, self.tweet)
+        self.create_comment(bob, self.tweet)
+
+        # 数据库里的值还没有更新，从 redis 里读到的是最新的值
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 0)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 2)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'comments_count'), 1)
+
+        like.delete()
+        # redis 里的计数丢失之后，从数据库加上还没有 flush 的 delta 恢复
+        RedisClient.get_connection(RedisClient.COUNTERS).delete(
+            RedisHelper.get_count_key(self.tweet, 'likes_count'),
+        )
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 1)
+
+        flush_tweet_counts_task()
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 1)
+        self.assertEqual(self.tweet.comments_count, 1)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 1)
+
+    @override_settings(COUNTER_WRITE_BEHIND=True)
+    def test_inflight_count_deltas(self):
+        self.create_like(self.alice, self.tweet)
+        conn = RedisClient.get_connection(RedisClient.COUNTERS)
+        attrs = ['likes_count', 'comments_count']
+
+        def update(*args, **kwargs):
+            # 还没有 commit 的时候 redis 里的计数丢失了，rebuild 的时候要加上 inflight 的 delta
+            conn.delete(RedisHelper.get_count_key(self.tweet, 'likes_count'))
+            self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 1)
+            # flush 的进程在 commit 之前挂掉了
+            raise SystemExit()
+
+        with mock.patch('django.db.models.query.QuerySet.update', side_effect=update):
+            with self.assertRaises(SystemExit):
+                RedisHelper.flush_count_deltas(Tweet, attrs, 10)
+        self.assertEqual(RedisHelper.flush_count_deltas(Tweet, attrs, 10), 0)
+        conn.delete(RedisHelper.get_count_key(self.tweet, 'likes_count'))
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 1)
+
+        # 没有超时的 inflight delta 不会被还回去，超时之后重新 flush
+        self.assertEqual(RedisHelper.recover_count_deltas(Tweet, attrs, 60), 0)
+        self.assertEqual(RedisHelper.recover_count_deltas(Tweet, attrs, -1), 1)
+        self.assertEqual(RedisHelper.flush_count_deltas(Tweet, attrs, 10), 1)
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 1)
+        # commit 之后 inflight 的 delta 被清掉，不会被重复计算
+        conn.delete(RedisHelper.get_count_key(self.tweet, 'likes_count'))
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 1)
+        self.assertEqual(RedisHelper.recover_count_deltas(Tweet, attrs, -1), 0)
+
+    def test_get_counts(self):
+        tweet = self.create_tweet(self.alice)
+        self.create_like(self.alice, self.tweet)
+        self.create_comment(self.alice, tweet)
+        RedisClient.clear()
+
+        counts = RedisHelper.get_counts([self.tweet, tweet], ['likes_count', 'comments_count'])
+        self.assertEqual(counts, {
+            self.tweet.id: {'likes_count': 1, 'comments_count': 0},
+            tweet.id: {'likes_count': 0, 'comments_count': 1},
+        })
+        # cache 里没有的计数会被写回 redis
+        conn = RedisClient.get_connection(RedisClient.COUNTERS)
+        self.assertEqual(conn.get(RedisHelper.get_count_key(tweet, 'comments_count')), b'1')
+
+
 class TweetServiceTests(TestCase):
 
     def setUp(self):
@@ -0,0 +1,40 @@
+# 用于在本地跑 benchmark 的配置，使用 sqlite 和本地的 redis，不需要 mysql 和 memcached
+#   python manage.py migrate --settings=twitter.benchmark_settings
+#   python manage.py benchmark_fanout --settings=twitter.benchmark_settings
+# 多进程模式下 sqlite 的写操作会互相等待锁，需要对比多进程的数据的时候请改用本地的 mysql
+from .settings import *  # noqa
+
+# DEBUG 模式下 django 会把所有执行过的 sql 记录在内存里
+DEBUG = False
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'benchmark.sqlite3',
+        'OPTIONS': {'timeout': 60},
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'TIMEOUT': 86400,
+    },
+    'testing': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'TIMEOUT': 86400,
+        'KEY_PREFIX': 'testing',
+    },
+    'ratelimit': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'TIMEOUT': 86400 * 7,
+        'KEY_PREFIX': 'rl',
+    },
+}
+
+# 和开发环境的数据分开
+REDIS_DB = 3
+CELERY_TASK_ALWAYS_EAGER = True
+
+# 让大号也走 fanout，这样才能测出 fanout 的吞吐量
+CELEBRITY_FOLLOWER_THRESHOLD = 10 ** 9
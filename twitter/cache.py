@@ -1,7 +1,44 @@
 #memcached
-FOLLOWINGS_PATTERN = 'followings:{user_id}'
-USER_PROFILE_PATTERN = 'userprofile:{user_id}'
+# pickle 的数据的 key 里都带上 version，格式改变之后新旧版本的进程使用不同的 key
+# followings 是 user id 的 set，格式改变的时候手动增加 FOLLOWINGS_VERSION
+# userprofile 的 version 是 UserProfile 的 schema version，参见 utils.cache_versions
+FOLLOWINGS_VERSION = 1
+FOLLOWINGS_PATTERN = 'followings:v{version}:{user_id}'
+USER_PROFILE_PATTERN = 'userprofile:v{version}:{user_id}'
+FOLLOWER_COUNT_PATTERN = 'followercount:{user_id}'
 
 # redis
 USER_TWEETS_PATTERN = 'user_tweets:{user_id}'
-USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
\ No newline at end of file
+USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
+USER_NEWSFEED_IDS_PATTERN = 'user_newsfeed_ids:{user_id}'
+# settings.REDIS_SORTED_SET_TIMELINES 打开的时候使用的 sorted set
+USER_TWEETS_ZSET_PATTERN = 'user_tweets_zset:{user_id}'
+USER_NEWSFEEDS_ZSET_PATTERN = 'user_newsfeeds_zset:{user_id}'
+USER_NEWSFEED_IDS_ZSET_PATTERN = 'user_newsfeed_ids_zset:{user_id}'
+# sorted set, member 是 user_id, score 是最后一次活跃的 timestamp
+USER_LAST_ACTIVE_KEY = 'user_last_active'
+# set, 用户最近点过赞的 object ids，参见 likes.services.LikeService
+USER_LIKED_IDS_PATTERN = 'user_liked_ids:{user_id}:{model}'
+# sorted set, member 是 timeline 的 key, score 是最后一次读取的 timestamp
+# 参见 utils.redis_memory.RedisMemoryBudget
+TIMELINE_LAST_READ_KEY = 'timeline_last_read'
+# settings.COUNTER_WRITE_BEHIND 打开的时候，还没有 flush 到数据库的计数
+# dirty_counts 是 object id 的 set，count_deltas 是 {object id: delta} 的 hash
+DIRTY_COUNTS_PATTERN = 'dirty_counts:{model}'
+COUNT_DELTAS_PATTERN = 'count_deltas:{model}.{attr}'
+# 正在 flush 的 delta 在数据库 commit 之前先挪到 inflight 的 hash 里，commit 之后再删掉
+# inflight_counts 是 sorted set, member 是 object id, score 是开始 flush 的 timestamp
+INFLIGHT_COUNT_DELTAS_PATTERN = 'inflight_count_deltas:{model}.{attr}'
+INFLIGHT_COUNTS_PATTERN = 'inflight_counts:{model}'
+# 每个进程里的 LocalObjectCache 通过这两个 key 同步 invalidation
+# seq 是最新的序号，invalidations 是 sorted set, member 是 '{seq}:{cache key}', score 是 seq
+LOCAL_CACHE_INVALIDATION_SEQ_KEY = 'local_cache_invalidation_seq'
+LOCAL_CACHE_INVALIDATIONS_KEY = 'local_cache_invalidations'
+# hash, {schema version: json 格式的 fields}，参见 utils.cache_versions.ModelCacheVersion
+CACHE_VERSIONS_PATTERN = 'cache_versions:{model}'
+# utils.cache_metrics.CacheMetrics, 每个 key pattern 一个 hash, patterns 是所有 pattern 的 set
+CACHE_METRICS_PATTERN = 'cache_metrics:{pattern}'
+CACHE_METRICS_PATTERNS_KEY = 'cache_metrics_patterns'
+FANOUT_STATE_PATTERN = 'fanout_state:{tweet_id}'
+FANOUT_STARTED_BATCHES_PATTERN = 'fanout_started:{tweet_id}'
+FANOUT_DONE_BATCHES_PATTERN = 'fanout_done:{tweet_id}'
@@ -185,25 +185,114 @@ CACHES = {
     }
 }
 
+# 不存在的 object 的 tombstone 在 memcached 里保存的时间，参见 utils.memcached_helper
+MEMCACHED_TOMBSTONE_TIMEOUT = 60  # in seconds
+# memcached 里的 key 带 model 的 schema version，每个进程最多每隔这么久去 redis 里
+# 读一次其他进程使用的 versions，参见 utils.cache_versions.ModelCacheVersion
+CACHE_VERSION_REFRESH_INTERVAL = 60  # in seconds
+
+# 每个进程里放在 memcached 前面的 LRU cache，参见 utils.local_cache.LocalObjectCache
+LOCAL_OBJECT_CACHE_ENABLED = False
+LOCAL_OBJECT_CACHE_SIZE = 10000
+LOCAL_OBJECT_CACHE_TTL = 60  # in seconds
+# 其他进程的 invalidation 最多延迟这么久才会生效
+LOCAL_OBJECT_CACHE_SYNC_INTERVAL = 1  # in seconds
+LOCAL_OBJECT_CACHE_INVALIDATION_LOG_SIZE = 10000
+
+# 每个进程按照 key pattern 统计 cache 的命中率和 fill 的耗时，每隔这么久汇总到 redis 一次
+# 用 manage.py cache_stats 查看，参见 utils.cache_metrics.CacheMetrics
+CACHE_METRICS_ENABLED = True
+CACHE_METRICS_FLUSH_INTERVAL = 10  # in seconds
+
 # Redis
 # 安装方法: sudo apt-get install redis
 # 然后安装 redis 的 python 客户端： pip install redis
 REDIS_HOST = '127.0.0.1'
 REDIS_PORT = 6379
 REDIS_DB = 0 if TESTING else 1
+# 连接池的大小，连接用完之后最多等待 REDIS_POOL_TIMEOUT 秒
+REDIS_MAX_CONNECTIONS = 50
+REDIS_POOL_TIMEOUT = 1  # in seconds
+REDIS_SOCKET_CONNECT_TIMEOUT = 0.5  # in seconds
+REDIS_SOCKET_TIMEOUT = 1  # in seconds
+REDIS_HEALTH_CHECK_INTERVAL = 30  # in seconds
+# 使用 sentinel 的时候配置成 [('host', 26379), ...]，REDIS_HOST 和 REDIS_PORT 会被忽略
+REDIS_SENTINELS = None
+REDIS_SENTINEL_SERVICE_NAME = 'mymaster'
+# 每个 logical client 可以覆盖上面的配置，比如 {'counters': {'DB': 4}}
+# 也可以配置 'REPLICA_HOST' 和 'REPLICA_PORT'，用于 get_connection(name, read_only=True)
+REDIS_CLIENTS = {
+    'cache': {},
+    'counters': {},
+    'broker': {},
+}
 REDIS_KEY_EXPIRE_TIME = 7 * 86400  # in seconds
+# 每个进程对同一个用户最多每 USER_LAST_ACTIVE_TOUCH_INTERVAL 秒更新一次最后活跃时间
+USER_LAST_ACTIVE_TOUCH_INTERVAL = 60 if not TESTING else 0  # in seconds
+# likes_count 等计数的 key 的过期时间，过期之后从数据库重新 load
+REDIS_COUNTER_EXPIRE_TIME = 2 * 86400  # in seconds
+# 超过 REDIS_TIMELINE_IDLE_TIME 没有被读过的 timeline 由 evict_cold_timelines_task 删掉
+# REDIS_MEMORY_BUDGET 不为 None 的时候，超过这么多字节会继续删最久没有被读过的 timelines
+# 参见 utils.redis_memory.RedisMemoryBudget，用 manage.py redis_memory 查看内存的使用情况
+REDIS_TIMELINE_IDLE_TIME = 2 * 86400  # in seconds
+REDIS_MEMORY_BUDGET = None  # in bytes
+REDIS_EVICTION_INTERVAL = 600  # in seconds
 REDIS_LIST_LENGTH_LIMIT = 200 if not TESTING else 20
+# cache miss 的时候只有一个进程去数据库 rebuild，其他进程最多等 REDIS_REBUILD_WAIT_TIME 秒
+REDIS_REBUILD_LOCK_TIMEOUT = 10  # in seconds
+REDIS_REBUILD_WAIT_TIME = 0.5  # in seconds
+# 剩余时间少于 REDIS_STALE_REFRESH_TIME 的 key 在被读到的时候提前 rebuild
+REDIS_STALE_REFRESH_TIME = 3600  # in seconds
+# redis list cache 里 model object 的编码方式，可以和 DjangoModelSerializer 互相切换
+# 两种格式都能被解码，切换的时候不需要清空 redis
+REDIS_SERIALIZER = 'utils.redis_serializer.CompactModelSerializer'
+# newsfeeds 的 cache 只存 (newsfeed_id, tweet_id, created_at)，读取的时候再批量取 tweets
+# 两种格式使用不同的 key，切换之后旧格式的 key 不会再被更新，切换回来之前需要等它们过期
+REDIS_COMPACT_NEWSFEEDS = False
+# user_tweets 和 user_newsfeeds 的 cache 使用以 created_at 为 score 的 sorted set 而不是 list
+# 翻页的时候只需要取出一页的数据。和 list 使用不同的 key，切换的时候不需要清空 redis
+REDIS_SORTED_SET_TIMELINES = False
+# tweet 的 likes_count 和 comments_count 只更新 redis，不在请求里更新数据库
+# 由 flush_tweet_counts_task 每 COUNTER_FLUSH_INTERVAL 秒批量的写回数据库
+# 需要同时运行 celery beat:
+#   celery -A twitter beat -l INFO
+COUNTER_WRITE_BEHIND = False
+COUNTER_FLUSH_INTERVAL = 10  # in seconds
+# 列表页的 has_liked 先查 redis 里每个用户最近点过赞的 LIKES_CACHE_LIMIT 个 object ids
+# 用户的 likes 比这个多的时候，不在 set 里的 ids 还需要查一次数据库
+# 关掉的时候 like 和 unlike 不会更新 cache，重新打开之前需要运行 manage.py clear_likes_cache
+LIKES_CACHE_ENABLED = False
+LIKES_CACHE_LIMIT = 1000
+LIKES_CACHE_EXPIRE_TIME = 86400  # in seconds
 
 # Celery Configuration Options
 # 使用如下命令把 worker 进程（只执行异步任务的进程，可以在不同的机器上）单独跑起来
 #   celery -A twitter worker -l INFO
 CELERY_BROKER_URL = 'redis://127.0.0.1:6379/2' if not TESTING else 'redis://127.0.0.1:6379/0'
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'socket_connect_timeout': REDIS_SOCKET_CONNECT_TIMEOUT,
+    'socket_timeout': REDIS_SOCKET_TIMEOUT,
+    'health_check_interval': REDIS_HEALTH_CHECK_INTERVAL,
+}
 CELERY_TIMEZONE = "UTC"
 CELERY_TASK_ALWAYS_EAGER = TESTING
 CELERY_QUEUES = (
     Queue('default', routing_key='default'),
     Queue('newsfeeds', routing_key='newsfeeds'),
+    # 粉丝数很多的用户的 fanout 单独用一个 queue，由单独的 worker 处理，参见 FanoutTier
+    #   celery -A twitter worker -Q newsfeeds_large -l INFO
+    Queue('newsfeeds_large', routing_key='newsfeeds_large'),
 )
+CELERY_BEAT_SCHEDULE = {
+    'flush-tweet-counts': {
+        'task': 'tweets.tasks.flush_tweet_counts_task',
+        'schedule': COUNTER_FLUSH_INTERVAL,
+    },
+    'evict-cold-timelines': {
+        'task': 'newsfeeds.tasks.evict_cold_timelines_task',
+        'schedule': REDIS_EVICTION_INTERVAL,
+    },
+}
 
 # 如果有100台机器，如何配置90台专门处理newsfeed的任务， 另外10台处理其他任务
 # import os
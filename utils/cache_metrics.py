@@ -0,0 +1,132 @@
+import pickle
+import threading
+import time
+
+import redis
+from django.conf import settings
+from twitter.cache import CACHE_METRICS_PATTERN, CACHE_METRICS_PATTERNS_KEY
+from utils.redis_client import RedisClient
+
+
+class CacheMetrics:
+    # 每个进程里按照 key pattern（key 里第一个 ':' 之前的部分，比如 user_tweets, followings,
+    # userprofile, 以及 MemcachedHelper 的 model 名字 User, Tweet）统计:
+    #   hits, misses: cache 命中和没有命中的次数
+    #   tombstone_hits: 读到了不存在的 object 的 tombstone 的次数，不算在 hits 里
+    #   fills, fill_ms, fill_bytes: cache miss 之后从数据库 load 并写回 cache 的次数、耗时和写入的大小
+    #   db_fallbacks: 没有写回 cache，直接用数据库的结果返回的次数
+    # 每 CACHE_METRICS_FLUSH_INTERVAL 秒用一次 pipeline 把增量累加到 redis 的 hash 里，
+    # 所有进程的数据汇总在一起，用 manage.py cache_stats 查看
+    FIELDS = ('hits', 'misses', 'tombstone_hits', 'fills', 'fill_ms', 'fill_bytes', 'db_fallbacks')
+
+    _lock = threading.Lock()
+    _stats = {}
+    _last_flushed_at = 0
+
+    @classmethod
+    def get_pattern(cls, key):
+        return key.split(':', 1)[0]
+
+    @classmethod
+    def get_pickled_size(cls, values):
+        # memcached 里存的是 pickle 之后的数据，只在 fill 的时候计算，不影响 cache hit 的路径
+        if not settings.CACHE_METRICS_ENABLED:
+            return 0
+        return sum(len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) for value in values)
+
+    @classmethod
+    def record_hits(cls, pattern, count=1):
+        cls._incr(pattern, hits=count)
+
+    @classmethod
+    def record_misses(cls, pattern, count=1):
+        cls._incr(pattern, misses=count)
+
+    @classmethod
+    def record_tombstone_hits(cls, pattern, count=1):
+        cls._incr(pattern, tombstone_hits=count)
+
+    @classmethod
+    def record_fill(cls, pattern, seconds, payload_bytes=0):
+        cls._incr(pattern, fills=1, fill_ms=seconds * 1000, fill_bytes=payload_bytes)
+
+    @classmethod
+    def record_db_fallback(cls, pattern):
+        cls._incr(pattern, db_fallbacks=1)
+
+    @classmethod
+    def _incr(cls, pattern, **values):
+        if not settings.CACHE_METRICS_ENABLED:
+            return
+        with cls._lock:
+            stats = cls._stats.setdefault(pattern, dict.fromkeys(cls.FIELDS, 0))
+            for field, value in values.items():
+                stats[field] += value
+        if time.time() - cls._last_flushed_at >= settings.CACHE_METRICS_FLUSH_INTERVAL:
+            cls.flush()
+
+    @classmethod
+    def get_stats(cls):
+        # 这个进程里还没有 flush 的数据
+        with cls._lock:
+            return {pattern: dict(stats) for pattern, stats in cls._stats.items()}
+
+    @classmethod
+    def flush(cls):
+        with cls._lock:
+            stats, cls._stats = cls._stats, {}
+            cls._last_flushed_at = time.time()
+        if not stats:
+            return
+        conn = RedisClient.get_connection(RedisClient.COUNTERS)
+        pipeline = conn.pipeline(transaction=False)
+        for pattern, values in stats.items():
+            key = CACHE_METRICS_PATTERN.format(pattern=pattern)
+            pipeline.sadd(CACHE_METRICS_PATTERNS_KEY, pattern)
+            for field, value in values.items():
+                if not value:
+                    continue
+                if isinstance(value, float):
+                    pipeline.hincrbyfloat(key, field, value)
+                else:
+                    pipeline.hincrby(key, field, value)
+        try:
+            pipeline.execute()
+        except redis.RedisError:
+            # 统计数据不能影响正常的请求，redis 出问题的时候丢掉这一次的数据
+            pass
+
+    @classmethod
+    def get_global_stats(cls):
+        # 所有进程已经 flush 到 redis 里的数据
+        conn = RedisClient.get_connection(RedisClient.COUNTERS)
+        patterns = sorted(pattern.decode() for pattern in conn.smembers(CACHE_METRICS_PATTERNS_KEY))
+        pipeline = conn.pipeline(transaction=False)
+        for pattern in patterns:
+            pipeline.hgetall(CACHE_METRICS_PATTERN.format(pattern=pattern))
+        results = {}
+        for pattern, values in zip(patterns, pipeline.execute()):
+            stats = dict.fromkeys(cls.FIELDS, 0)
+            for field, value in values.items():
+                stats[field.decode()] = float(value) if field == b'fill_ms' else int(value)
+            # 读到 tombstone 也是一次 lookup，但没有拿到 object，不能算作命中
+            lookups = stats['hits'] + stats['misses'] + stats['tombstone_hits']
+            stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else None
+            stats['avg_fill_ms'] = round(stats['fill_ms'] / stats['fills'], 3) if stats['fills'] else None
+            results[pattern] = stats
+        return results
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._stats = {}
+            cls._last_flushed_at = 0
+
+    @classmethod
+    def reset_global_stats(cls):
+        conn = RedisClient.get_connection(RedisClient.COUNTERS)
+        patterns = conn.smembers(CACHE_METRICS_PATTERNS_KEY)
+        conn.delete(CACHE_METRICS_PATTERNS_KEY, *[
+            CACHE_METRICS_PATTERN.format(pattern=pattern.decode())
+            for pattern in patterns
+        ])
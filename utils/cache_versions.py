@@ -0,0 +1,91 @@
+import json
+import time
+
+from django.conf import settings
+from twitter.cache import CACHE_VERSIONS_PATTERN
+from utils.redis_client import RedisClient
+from utils.redis_serializer import ModelSchema
+
+
+class ModelCacheVersion:
+    # memcached 里 pickle 的 model object 的 key 里带上 model 的 schema version
+    # model 的 fields 改变之后 version 也会改变，新旧两个版本的进程在滚动部署的时候
+    # 读写不同的 key，不会读到对方 pickle 的 object，部署的时候不需要清空 memcached
+    # 每个 model 出现过的 version 以及它们的 fields 记在 redis 的 hash 里:
+    #   - cache miss 的时候，可以从 fields 兼容的旧版本的 key 里读出来转成当前版本
+    #   - invalidate 的时候，删掉所有版本的 key
+    _versions = {}
+    # {model_class: (loaded_at, {version: [field, ...]})}
+    _known_versions = {}
+
+    @classmethod
+    def get_fields(cls, model_class):
+        return [
+            '{}:{}'.format(field.attname, field.get_internal_type())
+            for field in model_class._meta.concrete_fields
+        ]
+
+    @classmethod
+    def get_version(cls, model_class):
+        version = cls._versions.get(model_class)
+        if version is None:
+            version = ModelSchema(model_class).version
+            cls._versions[model_class] = version
+        return version
+
+    @classmethod
+    def get_known_versions(cls, model_class, refresh=False):
+        # 每个进程最多每 CACHE_VERSION_REFRESH_INTERVAL 秒去 redis 里读一次
+        # 同时把自己的版本记进去，redis 被清空之后也会重新记上
+        loaded_at, versions = cls._known_versions.get(model_class, (0, None))
+        if not refresh and time.time() - loaded_at < settings.CACHE_VERSION_REFRESH_INTERVAL:
+            return versions
+
+        key = CACHE_VERSIONS_PATTERN.format(model=model_class._meta.label_lower)
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.hsetnx(key, cls.get_version(model_class), json.dumps(cls.get_fields(model_class)))
+        pipeline.hgetall(key)
+        _, raw_versions = pipeline.execute()
+        versions = {
+            version.decode(): json.loads(fields)
+            for version, fields in raw_versions.items()
+        }
+        cls._known_versions[model_class] = (time.time(), versions)
+        return versions
+
+    @classmethod
+    def get_all_versions(cls, model_class):
+        # invalidate 的时候用，每次都重新读，刚刚部署的新版本的 key 也能被删掉
+        return list(cls.get_known_versions(model_class, refresh=True))
+
+    @classmethod
+    def get_compatible_versions(cls, model_class):
+        # 包含当前版本所有 fields（名字和类型都相同）的旧版本，它们 pickle 的 object
+        # 去掉多出来的 fields 之后就是一个完整的当前版本的 object
+        current_version = cls.get_version(model_class)
+        current_fields = set(cls.get_fields(model_class))
+        return [
+            version
+            for version, fields in cls.get_known_versions(model_class).items()
+            if version != current_version and current_fields.issubset(fields)
+        ]
+
+    @classmethod
+    def upgrade(cls, model_class, obj):
+        # 把旧版本的 object 转成当前版本，不兼容的返回 None
+        if not isinstance(obj, model_class):
+            return None
+        attnames = set(field.attname for field in model_class._meta.concrete_fields)
+        if not attnames.issubset(obj.__dict__):
+            return None
+        for version_fields in cls.get_known_versions(model_class).values():
+            for field in version_fields:
+                attname = field.split(':', 1)[0]
+                if attname not in attnames:
+                    obj.__dict__.pop(attname, None)
+        return obj
+
+    @classmethod
+    def clear(cls):
+        cls._known_versions = {}
@@ -0,0 +1,151 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from twitter.cache import LOCAL_CACHE_INVALIDATIONS_KEY, LOCAL_CACHE_INVALIDATION_SEQ_KEY
+from utils.redis_client import RedisClient
+
+# 记录一次 invalidation，返回它的序号
+# KEYS[1]: 序号的 key, KEYS[2]: invalidation 的 sorted set, ARGV[1]: cache key, ARGV[2]: 保留的数量
+PUBLISH_INVALIDATION_SCRIPT = """
+local seq = redis.call('INCR', KEYS[1])
+redis.call('ZADD', KEYS[2], seq, seq .. ':' .. ARGV[1])
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[2]) - 1)
+return seq
+"""
+
+
+class LocalObjectCache:
+    # 每个进程里的 LRU cache，放在 memcached 前面，同一个进程里重复的读取不需要访问网络
+    # 每个 entry 最多存 LOCAL_OBJECT_CACHE_TTL 秒
+    # 其他进程 invalidate 了某个 key 的时候，会在 redis 里记一条带序号的 invalidation
+    # 每个进程最多每 LOCAL_OBJECT_CACHE_SYNC_INTERVAL 秒去 redis 里拉一次新的 invalidations
+    # 如果落后太多，已经被 trim 掉的 invalidations 拿不到了，就清空整个 cache
+    # 存进去和取出来的都是 object 的浅拷贝，调用的地方给它加上的属性（比如 _cached_user_profile）
+    # 不会影响到 cache
+    _lock = threading.RLock()
+    _entries = OrderedDict()
+    _last_seq = None
+    _last_synced_at = 0
+    _script = None
+
+    @classmethod
+    def is_enabled(cls):
+        return settings.LOCAL_OBJECT_CACHE_ENABLED
+
+    @classmethod
+    def get(cls, key):
+        cls._sync()
+        with cls._lock:
+            entry = cls._entries.get(key)
+            if entry is None:
+                return None
+            obj, expire_at = entry
+            if expire_at < time.time():
+                del cls._entries[key]
+                return None
+            cls._entries.move_to_end(key)
+            return cls._copy(obj)
+
+    @classmethod
+    def _copy(cls, obj):
+        # model 的 _state.fields_cache 里有 foreign key 的 cache，浅拷贝会共用同一个 dict
+        obj = copy.copy(obj)
+        state = getattr(obj, '_state', None)
+        if state is not None:
+            obj._state = copy.copy(state)
+            obj._state.fields_cache = dict(state.fields_cache)
+        return obj
+
+    @classmethod
+    def get_many(cls, keys):
+        return {
+            key: obj
+            for key, obj in ((key, cls.get(key)) for key in keys)
+            if obj is not None
+        }
+
+    @classmethod
+    def set(cls, key, obj):
+        expire_at = time.time() + settings.LOCAL_OBJECT_CACHE_TTL
+        # 存一份浅拷贝，调用的地方之后给 obj 加上的属性不会进到 cache 里
+        obj = cls._copy(obj)
+        with cls._lock:
+            cls._entries[key] = (obj, expire_at)
+            cls._entries.move_to_end(key)
+            while len(cls._entries) > settings.LOCAL_OBJECT_CACHE_SIZE:
+                cls._entries.popitem(last=False)
+
+    @classmethod
+    def set_many(cls, key_to_obj):
+        for key, obj in key_to_obj.items():
+            cls.set(key, obj)
+
+    @classmethod
+    def invalidate(cls, key):
+        with cls._lock:
+            cls._entries.pop(key, None)
+        cls._publish_invalidation(key)
+
+    @classmethod
+    def _publish_invalidation(cls, key):
+        conn = RedisClient.get_connection()
+        if cls._script is None:
+            cls._script = conn.register_script(PUBLISH_INVALIDATION_SCRIPT)
+        cls._script(
+            keys=[LOCAL_CACHE_INVALIDATION_SEQ_KEY, LOCAL_CACHE_INVALIDATIONS_KEY],
+            args=[key, settings.LOCAL_OBJECT_CACHE_INVALIDATION_LOG_SIZE],
+            client=conn,
+        )
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._entries.clear()
+            cls._last_seq = None
+            cls._last_synced_at = 0
+
+    @classmethod
+    def _sync(cls):
+        now = time.time()
+        if now - cls._last_synced_at < settings.LOCAL_OBJECT_CACHE_SYNC_INTERVAL:
+            return
+        cls._last_synced_at = now
+
+        conn = RedisClient.get_connection()
+        if cls._last_seq is None:
+            # 第一次使用，cache 是空的，只需要记下当前的序号
+            with cls._lock:
+                cls._entries.clear()
+            cls._last_seq = int(conn.get(LOCAL_CACHE_INVALIDATION_SEQ_KEY) or 0)
+            return
+
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.get(LOCAL_CACHE_INVALIDATION_SEQ_KEY)
+        pipeline.zrange(LOCAL_CACHE_INVALIDATIONS_KEY, 0, 0, withscores=True)
+        pipeline.zrangebyscore(
+            LOCAL_CACHE_INVALIDATIONS_KEY,
+            '({}'.format(cls._last_seq),
+            '+inf',
+            withscores=True,
+        )
+        seq, oldest, invalidations = pipeline.execute()
+        if int(seq or 0) < cls._last_seq:
+            # redis 被清空过，之前的序号已经没有意义了
+            with cls._lock:
+                cls._entries.clear()
+            cls._last_seq = int(seq or 0)
+            return
+        if not invalidations:
+            return
+        with cls._lock:
+            if oldest and int(oldest[0][1]) > cls._last_seq + 1:
+                # 中间有一些 invalidations 已经被 trim 掉了
+                cls._entries.clear()
+            else:
+                for member, _ in invalidations:
+                    key = member.decode().split(':', 1)[1]
+                    cls._entries.pop(key, None)
+            cls._last_seq = int(invalidations[-1][1])
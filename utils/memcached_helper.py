@@ -1,29 +1,226 @@
+import time
+from functools import partial
+
 from django.conf import settings
 from django.core.cache import caches
+from utils.cache_metrics import CacheMetrics
+from utils.cache_versions import ModelCacheVersion
+from utils.local_cache import LocalObjectCache
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
+# 不存在的 object 在 cache 里存一个 tombstone，重复的读取不需要再访问数据库
+# object 被创建或者保存的时候 post_save 会把 tombstone 删掉
+TOMBSTONE = '__tombstone__'
+
 
 class MemcachedHelper:
 
     @classmethod
-    def get_key(cls, model_class, object_id):
-        return '{}:{}'.format(model_class.__name__, object_id)
+    def get_key(cls, model_class, object_id, version=None):
+        # key 里带上 model 的 schema version，参见 ModelCacheVersion
+        if version is None:
+            version = ModelCacheVersion.get_version(model_class)
+        return '{}:v{}:{}'.format(model_class.__name__, version, object_id)
+
+    @classmethod
+    def get_from_previous_versions(cls, model_class, object_ids, get_key):
+        # 滚动部署的时候，当前版本的 key 还没有被填上，从兼容的旧版本的 key 里读出来
+        # 转成当前版本之后写回当前版本的 key。get_key(object_id, version=None) 返回 cache key
+        # 返回 {object_id: object}
+        versions = ModelCacheVersion.get_compatible_versions(model_class)
+        if not versions or not object_ids:
+            return {}
+        keys = {
+            get_key(object_id, version): object_id
+            for version in versions
+            for object_id in object_ids
+        }
+        objects = {}
+        for key, obj in cache.get_many(list(keys)).items():
+            object_id = keys[key]
+            if object_id in objects:
+                continue
+            obj = ModelCacheVersion.upgrade(model_class, obj)
+            if obj is not None:
+                objects[object_id] = obj
+        cache.set_many({
+            get_key(object_id): obj
+            for object_id, obj in objects.items()
+        })
+        return objects
 
     @classmethod
     def get_object_through_cache(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
-        # cache hit
+        pattern = model_class.__name__
+        use_local_cache = LocalObjectCache.is_enabled()
+        if use_local_cache:
+            obj = LocalObjectCache.get(key)
+            if obj is not None:
+                CacheMetrics.record_hits(pattern)
+                return obj
         obj = cache.get(key)
+        if obj == TOMBSTONE:
+            CacheMetrics.record_tombstone_hits(pattern)
+            raise model_class.DoesNotExist(
+                '{} matching id {} does not exist.'.format(model_class.__name__, object_id),
+            )
+        # cache hit
         if obj:
+            CacheMetrics.record_hits(pattern)
+            if use_local_cache:
+                LocalObjectCache.set(key, obj)
             return obj
         # cache miss
-        obj = model_class.objects.get(id=object_id)
+        obj = cls.get_from_previous_versions(
+            model_class,
+            [object_id],
+            partial(cls.get_key, model_class),
+        ).get(object_id)
+        if obj is not None:
+            CacheMetrics.record_hits(pattern)
+            if use_local_cache:
+                LocalObjectCache.set(key, obj)
+            return obj
+        CacheMetrics.record_misses(pattern)
+        started_at = time.time()
+        try:
+            obj = model_class.objects.get(id=object_id)
+        except model_class.DoesNotExist:
+            cache.set(key, TOMBSTONE, settings.MEMCACHED_TOMBSTONE_TIMEOUT)
+            CacheMetrics.record_fill(pattern, time.time() - started_at)
+            raise
         # using default expire time
         cache.set(key, obj)
+        CacheMetrics.record_fill(
+            pattern,
+            time.time() - started_at,
+            CacheMetrics.get_pickled_size([obj]),
+        )
+        if use_local_cache:
+            LocalObjectCache.set(key, obj)
         return obj
 
+    @classmethod
+    def get_objects_through_cache(cls, model_class, object_ids):
+        # 用一次 get_many 取出所有的 objects，cache miss 的用一次 id__in 的 query 补上
+        # 返回 {object_id: object}，不存在的 object 不会出现在结果里
+        keys = {
+            cls.get_key(model_class, object_id): object_id
+            for object_id in object_ids
+        }
+        pattern = model_class.__name__
+        use_local_cache = LocalObjectCache.is_enabled()
+        objects = {}
+        if use_local_cache:
+            objects = {
+                keys[key]: obj
+                for key, obj in LocalObjectCache.get_many(keys).items()
+            }
+        cached_objects = cache.get_many([
+            key
+            for key, object_id in keys.items()
+            if object_id not in objects
+        ])
+        tombstone_ids = set(
+            keys[key]
+            for key, obj in cached_objects.items()
+            if obj == TOMBSTONE
+        )
+        cached_objects = {
+            key: obj
+            for key, obj in cached_objects.items()
+            if obj and obj != TOMBSTONE
+        }
+        objects.update({
+            keys[key]: obj
+            for key, obj in cached_objects.items()
+        })
+        if use_local_cache:
+            LocalObjectCache.set_many(cached_objects)
+        missing_ids = [
+            object_id
+            for object_id in keys.values()
+            if object_id not in objects and object_id not in tombstone_ids
+        ]
+        if tombstone_ids:
+            CacheMetrics.record_tombstone_hits(pattern, len(tombstone_ids))
+        if not missing_ids:
+            CacheMetrics.record_hits(pattern, len(keys) - len(tombstone_ids))
+            return objects
+
+        previous_objects = cls.get_from_previous_versions(
+            model_class,
+            missing_ids,
+            partial(cls.get_key, model_class),
+        )
+        if use_local_cache:
+            LocalObjectCache.set_many({
+                cls.get_key(model_class, object_id): obj
+                for object_id, obj in previous_objects.items()
+            })
+        objects.update(previous_objects)
+        missing_ids = [
+            object_id
+            for object_id in missing_ids
+            if object_id not in previous_objects
+        ]
+        CacheMetrics.record_hits(pattern, len(keys) - len(missing_ids) - len(tombstone_ids))
+        if not missing_ids:
+            return objects
+
+        CacheMetrics.record_misses(pattern, len(missing_ids))
+        started_at = time.time()
+        missing_objects = model_class.objects.in_bulk(missing_ids)
+        missing_key_to_obj = {
+            cls.get_key(model_class, object_id): obj
+            for object_id, obj in missing_objects.items()
+        }
+        cache.set_many(missing_key_to_obj)
+        cache.set_many({
+            cls.get_key(model_class, object_id): TOMBSTONE
+            for object_id in missing_ids
+            if object_id not in missing_objects
+        }, settings.MEMCACHED_TOMBSTONE_TIMEOUT)
+        CacheMetrics.record_fill(
+            pattern,
+            time.time() - started_at,
+            CacheMetrics.get_pickled_size(missing_objects.values()),
+        )
+        if use_local_cache:
+            LocalObjectCache.set_many(missing_key_to_obj)
+        objects.update(missing_objects)
+        return objects
+
+    @classmethod
+    def prefetch_objects_through_cache(cls, objects, model_class, id_attr, cached_attr):
+        # 批量取出 objects 关联的 model_class 的 object，放在每个 object 的 cached_attr 里
+        # 比如 (tweets, User, 'user_id', '_cached_user')，返回取到的关联 objects
+        objects = [
+            obj
+            for obj in objects
+            if obj is not None and not hasattr(obj, cached_attr)
+        ]
+        related_objects = cls.get_objects_through_cache(model_class, set(
+            getattr(obj, id_attr)
+            for obj in objects
+            if getattr(obj, id_attr) is not None
+        ))
+        for obj in objects:
+            related_object = related_objects.get(getattr(obj, id_attr))
+            if related_object is not None:
+                setattr(obj, cached_attr, related_object)
+        return list(related_objects.values())
+
     @classmethod
     def invalidate_cached_object(cls, model_class, object_id):
-        key = cls.get_key(model_class, object_id)
-        cache.delete(key)
\ No newline at end of file
+        # 滚动部署的时候新旧版本的进程都可能读到这个 object，所有版本的 key 都要删掉
+        keys = [
+            cls.get_key(model_class, object_id, version)
+            for version in ModelCacheVersion.get_all_versions(model_class)
+        ]
+        cache.delete_many(keys)
+        if LocalObjectCache.is_enabled():
+            for key in keys:
+                LocalObjectCache.invalidate(key)
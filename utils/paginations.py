@@ -2,6 +2,7 @@ from dateutil import parser
 from django.conf import settings
 from rest_framework.pagination import BasePagination
 from rest_framework.response import Response
+from utils.time_helpers import datetime_to_microseconds
 
 
 class EndlessPagination(BasePagination):
@@ -80,6 +81,32 @@ class EndlessPagination(BasePagination):
         # 如果进入这里，说明可能存在在数据库里没有 load 在 cache 里的数据，需要直接去数据库查询
         return None
 
+    def paginate_cached_sorted_set(self, load_objects_by_score, request):
+        # load_objects_by_score(max_score, min_score, count) 从以 created_at 为 score 的
+        # sorted set 里取数据，返回 (objects, oldest_score)，参见 RedisHelper.load_objects_by_score
+        # 每一页只需要从 redis 里取出并反序列化 page_size + 1 个 objects
+        if 'created_at__gt' in request.query_params:
+            created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
+            objects, _ = load_objects_by_score(
+                '+inf',
+                '({}'.format(datetime_to_microseconds(created_at__gt)),
+                None,
+            )
+            self.has_next_page = False
+            return objects
+
+        max_score = '+inf'
+        if 'created_at__lt' in request.query_params:
+            created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
+            max_score = '({}'.format(datetime_to_microseconds(created_at__lt))
+        objects, oldest_score = load_objects_by_score(max_score, '-inf', self.page_size + 1)
+        self.has_next_page = len(objects) > self.page_size
+        # 和 paginate_cached_list 一样，cache 里的数据不够一页并且 cache 已经存满的时候
+        # 数据库里可能还有更老的数据，返回 None 去数据库查询
+        if not self.has_next_page and oldest_score is not None:
+            return None
+        return objects[:self.page_size]
+
     def get_paginated_response(self, data):
         return Response({
             'has_next_page': self.has_next_page,
@@ -1,26 +1,244 @@
+import threading
+import time
+
 import redis
 from django.conf import settings
+from redis.client import Pipeline
+from redis.sentinel import Sentinel
 
 
-class RedisClient:
-    conn = None
+class RedisCommandStats:
+    # 每个进程里按照 (client name, command) 统计执行的次数、错误次数和耗时
+    # pipeline 整体记为一个 PIPELINE 命令
+    _lock = threading.Lock()
+    _stats = {}
 
     @classmethod
-    def get_connection(cls):
-        # use singleton, cls.conn is the same as RedisClient.conn
-        if cls.conn:
-            return cls.conn
-        cls.conn = redis.Redis(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            db=settings.REDIS_DB
+    def record(cls, client_name, command, seconds, failed=False):
+        with cls._lock:
+            stats = cls._stats.setdefault((client_name, command), {
+                'count': 0,
+                'errors': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+            })
+            milliseconds = seconds * 1000
+            stats['count'] += 1
+            stats['errors'] += int(failed)
+            stats['total_ms'] += milliseconds
+            stats['max_ms'] = max(stats['max_ms'], milliseconds)
+
+    @classmethod
+    def get_stats(cls):
+        with cls._lock:
+            return {
+                '{}.{}'.format(client_name, command): dict(stats)
+                for (client_name, command), stats in cls._stats.items()
+            }
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._stats = {}
+
+
+class InstrumentedPipeline(Pipeline):
+    client_name = None
+
+    def execute(self, raise_on_error=True):
+        start = time.time()
+        failed = False
+        try:
+            return super(InstrumentedPipeline, self).execute(raise_on_error)
+        except redis.RedisError:
+            failed = True
+            raise
+        finally:
+            RedisCommandStats.record(self.client_name, 'PIPELINE', time.time() - start, failed)
+
+
+class InstrumentedRedis(redis.Redis):
+    client_name = None
+
+    def execute_command(self, *args, **options):
+        start = time.time()
+        failed = False
+        try:
+            return super(InstrumentedRedis, self).execute_command(*args, **options)
+        except redis.RedisError:
+            failed = True
+            raise
+        finally:
+            RedisCommandStats.record(self.client_name, args[0], time.time() - start, failed)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipeline = InstrumentedPipeline(
+            self.connection_pool,
+            self.response_callbacks,
+            transaction,
+            shard_hint,
         )
-        return cls.conn
+        pipeline.client_name = self.client_name
+        return pipeline
+
+
+class RedisClient:
+    # 不同用途的数据使用不同的 logical client，可以在 settings.REDIS_CLIENTS 里配置到
+    # 不同的 db 甚至不同的 redis 上:
+    #   cache: timeline 等可以随时从数据库 rebuild 的 cache
+    #   counters: likes_count, comments_count 等计数
+    #   broker: fanout 进度等异步任务的状态
+    # 所有 client 都有连接池大小、连接/读写超时和 health check 的限制，redis 变慢的时候
+    # web 进程不会被一直卡住
+    CACHE = 'cache'
+    COUNTERS = 'counters'
+    BROKER = 'broker'
+
+    _clients = {}
+    # 没有配置 replica 的时候创建 read only client 会再调用 get_connection
+    _lock = threading.RLock()
+
+    @classmethod
+    def _get_config(cls, name):
+        config = {
+            'HOST': settings.REDIS_HOST,
+            'PORT': settings.REDIS_PORT,
+            'DB': settings.REDIS_DB,
+            'MAX_CONNECTIONS': settings.REDIS_MAX_CONNECTIONS,
+            'POOL_TIMEOUT': settings.REDIS_POOL_TIMEOUT,
+            'SOCKET_CONNECT_TIMEOUT': settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+            'SOCKET_TIMEOUT': settings.REDIS_SOCKET_TIMEOUT,
+            'HEALTH_CHECK_INTERVAL': settings.REDIS_HEALTH_CHECK_INTERVAL,
+            'SENTINELS': settings.REDIS_SENTINELS,
+            'SENTINEL_SERVICE_NAME': settings.REDIS_SENTINEL_SERVICE_NAME,
+            'REPLICA_HOST': None,
+            'REPLICA_PORT': None,
+        }
+        config.update(settings.REDIS_CLIENTS.get(name, {}))
+        return config
+
+    @classmethod
+    def _get_connection_kwargs(cls, config):
+        return {
+            'db': config['DB'],
+            'socket_connect_timeout': config['SOCKET_CONNECT_TIMEOUT'],
+            'socket_timeout': config['SOCKET_TIMEOUT'],
+            'socket_keepalive': True,
+            'retry_on_timeout': True,
+            'health_check_interval': config['HEALTH_CHECK_INTERVAL'],
+        }
+
+    @classmethod
+    def _create_client(cls, name, read_only):
+        config = cls._get_config(name)
+        connection_kwargs = cls._get_connection_kwargs(config)
+        # 用 client_name 区分统计数据，replica 的统计单独记录
+        client_name = '{}.replica'.format(name) if read_only else name
+
+        if config['SENTINELS']:
+            sentinel = Sentinel(
+                config['SENTINELS'],
+                socket_connect_timeout=config['SOCKET_CONNECT_TIMEOUT'],
+                socket_timeout=config['SOCKET_TIMEOUT'],
+            )
+            # master 切换之后 sentinel 的连接池会自动连到新的 master 上
+            get_client = sentinel.slave_for if read_only else sentinel.master_for
+            client = get_client(
+                config['SENTINEL_SERVICE_NAME'],
+                redis_class=InstrumentedRedis,
+                max_connections=config['MAX_CONNECTIONS'],
+                **connection_kwargs
+            )
+        else:
+            host, port = config['HOST'], config['PORT']
+            if read_only and config['REPLICA_HOST']:
+                host = config['REPLICA_HOST']
+                port = config['REPLICA_PORT'] or port
+            elif read_only:
+                # 没有配置 replica 的时候读写都使用同一个 client
+                return cls.get_connection(name)
+            # 连接用完的时候最多等待 POOL_TIMEOUT 秒，而不是无限的创建新连接
+            pool = redis.BlockingConnectionPool(
+                host=host,
+                port=port,
+                max_connections=config['MAX_CONNECTIONS'],
+                timeout=config['POOL_TIMEOUT'],
+                **connection_kwargs
+            )
+            client = InstrumentedRedis(connection_pool=pool)
+        client.client_name = client_name
+        return client
+
+    @classmethod
+    def get_connection(cls, name=CACHE, read_only=False):
+        # use singleton, 每个 logical client 在每个进程里只创建一次
+        key = (name, read_only)
+        client = cls._clients.get(key)
+        if client is not None:
+            return client
+        with cls._lock:
+            if key not in cls._clients:
+                cls._clients[key] = cls._create_client(name, read_only)
+            return cls._clients[key]
+
+    @classmethod
+    def set_connection(cls, conn, name=CACHE):
+        # 替换掉某个 logical client，比如 benchmark 的时候使用 fakeredis
+        cls._clients[(name, False)] = conn
+        cls._clients[(name, True)] = conn
+
+    @classmethod
+    def reset(cls):
+        # fork 出来的子进程不能和父进程共用连接，需要重新创建
+        # 不能在子进程里 disconnect，否则会把父进程正在使用的 socket 也关掉
+        with cls._lock:
+            cls._clients = {}
+
+    @classmethod
+    def get_pool_stats(cls):
+        # 每个 logical client 的连接池使用情况
+        stats = {}
+        for client in list(cls._clients.values()):
+            pool = client.connection_pool
+            client_name = getattr(client, 'client_name', None) or repr(client)
+            if client_name in stats:
+                continue
+            in_use = getattr(pool, '_in_use_connections', None)
+            created = getattr(pool, '_created_connections', None)
+            if in_use is None and hasattr(pool, '_connections'):
+                # BlockingConnectionPool 的 _connections 是所有已经创建的连接
+                created = len(pool._connections)
+                in_use = created - sum(1 for conn in pool.pool.queue if conn is not None)
+            else:
+                in_use = len(in_use) if in_use is not None else None
+            stats[client_name] = {
+                'max_connections': pool.max_connections,
+                'created_connections': created,
+                'in_use_connections': in_use,
+                'utilization': (
+                    round(in_use / pool.max_connections, 3)
+                    if in_use is not None and pool.max_connections else None
+                ),
+            }
+        return stats
+
+    @classmethod
+    def get_stats(cls):
+        return {
+            'pools': cls.get_pool_stats(),
+            'commands': RedisCommandStats.get_stats(),
+        }
 
     @classmethod
     def clear(cls):
         # clear all keys in redis, for testing purpose
         if not settings.TESTING:
             raise Exception("You can not flush redis in roduction environment")
-        conn = cls.get_connection()
-        conn.flushdb()
+        flushed = set()
+        for name in (cls.CACHE, cls.COUNTERS, cls.BROKER):
+            config = cls._get_config(name)
+            target = (config['HOST'], config['PORT'], config['DB'])
+            if target in flushed:
+                continue
+            flushed.add(target)
+            cls.get_connection(name).flushdb()
@@ -1,83 +1,950 @@
+import time
+import uuid
+import weakref
+
 from django.conf import settings
+from django.db.models import Case, F, IntegerField, When
+from django.utils.module_loading import import_string
+from redis.exceptions import LockError, WatchError
 
+from twitter.cache import (
+    COUNT_DELTAS_PATTERN,
+    DIRTY_COUNTS_PATTERN,
+    INFLIGHT_COUNT_DELTAS_PATTERN,
+    INFLIGHT_COUNTS_PATTERN,
+    TIMELINE_LAST_READ_KEY,
+)
+from utils.cache_metrics import CacheMetrics
 from utils.redis_client import RedisClient
-from utils.redis_serializer import DjangoModelSerializer
+from utils.redis_serializer import UnknownSchemaVersion
+from utils.time_helpers import datetime_to_microseconds
+
+# 等待其他进程 rebuild cache 的时候，每次检查 key 是否已经写好之间的间隔，单位是秒
+REBUILD_POLL_INTERVAL = 0.05
+
+# key 存在才 push，push 之后 trim 到最大长度并刷新过期时间，在 redis 里原子的执行
+# key 不存在的时候返回 0，由调用的地方决定是否从数据库里 load
+# KEYS[1]: key, ARGV[1]: serialized data, ARGV[2]: 最大长度, ARGV[3]: 过期时间
+PUSH_TO_LIST_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('LPUSH', KEYS[1], ARGV[1])
+redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+# 计数的 key 存在才 INCRBY 并刷新过期时间，不存在的时候返回 nil
+# 不存在的 key 由 get_count 从数据库 load，直接 INCR 会得到一个从 0 开始的错误的计数
+# key 不存在的时候改变 refill dirty key，正在从数据库 load 的 get_count 会放弃写回
+# KEYS[1]: 计数的 key, KEYS[2]: refill dirty key
+# ARGV[1]: delta, ARGV[2]: 过期时间, ARGV[3]: refill dirty key 的过期时间
+INCR_COUNT_IF_EXISTS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('INCR', KEYS[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+    return false
+end
+local count = redis.call('INCRBY', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return count
+"""
+
+# write behind 模式下记录一次计数的变化
+# 计数的 key 存在才 INCRBY，不存在的时候由 get_count 从数据库加上还没有 flush 的 delta 得到，
+# 和 INCR_COUNT_IF_EXISTS_SCRIPT 一样改变 refill dirty key
+# KEYS[1]: 计数的 key, KEYS[2]: dirty set, KEYS[3]: delta hash, KEYS[4]: refill dirty key
+# ARGV[1]: object id, ARGV[2]: delta, ARGV[3]: 计数的 key 的过期时间
+# ARGV[4]: refill dirty key 的过期时间
+RECORD_COUNT_DELTA_SCRIPT = """
+redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('HINCRBY', KEYS[3], ARGV[1], ARGV[2])
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    local count = redis.call('INCRBY', KEYS[1], ARGV[2])
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    return count
+end
+redis.call('INCR', KEYS[4])
+redis.call('EXPIRE', KEYS[4], ARGV[4])
+return false
+"""
+
+# 下面三个 script 的 KEYS 都是:
+#   KEYS[1]: dirty set, KEYS[2]: inflight sorted set,
+#   KEYS[3..2+n]: 每个 attr 的 delta hash, KEYS[3+n..2+2n]: 每个 attr 的 inflight hash
+
+# 从 dirty set 里取出最多 ARGV[1] 个 object id，把它们的 delta 挪到 inflight hash 里
+# 数据库 commit 之前 delta 一直留在 redis 里，get_count 会把 inflight 的 delta 也加上
+# 返回 [[object id, delta1, delta2, ...], ...]
+# ARGV[1]: batch size, ARGV[2]: 当前的 timestamp, ARGV[3]: attr 的数量 n
+POP_COUNT_DELTAS_SCRIPT = """
+local n = tonumber(ARGV[3])
+local object_ids = redis.call('SPOP', KEYS[1], ARGV[1])
+local result = {}
+for _, object_id in ipairs(object_ids) do
+    local row = {object_id}
+    for i = 1, n do
+        local delta = redis.call('HGET', KEYS[2 + i], object_id)
+        if delta then
+            redis.call('HDEL', KEYS[2 + i], object_id)
+            redis.call('HINCRBY', KEYS[2 + n + i], object_id, delta)
+        end
+        table.insert(row, delta or '0')
+    end
+    redis.call('ZADD', KEYS[2], ARGV[2], object_id)
+    table.insert(result, row)
+end
+return result
+"""
+
+# 数据库 commit 之后从 inflight hash 里减掉这一批的 delta，ARGV[2] 为 '1' 的时候表示数据库
+# 写失败了，把 delta 还给 delta hash 并重新标记为 dirty。inflight 的 delta 都清空了的 object
+# 从 inflight sorted set 里删掉（同一个 object 可能同时有多批在 flush）
+# ARGV[1]: attr 的数量 n, ARGV[2]: 是否还回去, ARGV[3..]: object id, delta1, ..., deltan, ...
+ACK_COUNT_DELTAS_SCRIPT = """
+local n = tonumber(ARGV[1])
+local restore = ARGV[2] == '1'
+for j = 3, #ARGV, n + 1 do
+    local object_id = ARGV[j]
+    local remaining = false
+    for i = 1, n do
+        local delta = tonumber(ARGV[j + i])
+        local inflight = tonumber(redis.call('HGET', KEYS[2 + n + i], object_id))
+        if inflight then
+            if delta ~= 0 then
+                inflight = redis.call('HINCRBY', KEYS[2 + n + i], object_id, -delta)
+                if restore then
+                    redis.call('HINCRBY', KEYS[2 + i], object_id, delta)
+                    redis.call('SADD', KEYS[1], object_id)
+                end
+            end
+            if inflight == 0 then
+                redis.call('HDEL', KEYS[2 + n + i], object_id)
+            else
+                remaining = true
+            end
+        end
+    end
+    if not remaining then
+        redis.call('ZREM', KEYS[2], object_id)
+    end
+end
+return 1
+"""
+
+# flush 的进程在 commit 之前挂掉了，ARGV[2] 之前开始 flush 的 inflight delta 全部还给 delta hash
+# 返回还回去的 object 数量。ARGV[1]: attr 的数量 n, ARGV[2]: timestamp
+RECOVER_COUNT_DELTAS_SCRIPT = """
+local n = tonumber(ARGV[1])
+local object_ids = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[2])
+for _, object_id in ipairs(object_ids) do
+    for i = 1, n do
+        local inflight = redis.call('HGET', KEYS[2 + n + i], object_id)
+        if inflight then
+            redis.call('HINCRBY', KEYS[2 + i], object_id, inflight)
+            redis.call('HDEL', KEYS[2 + n + i], object_id)
+        end
+    end
+    redis.call('SADD', KEYS[1], object_id)
+    redis.call('ZREM', KEYS[2], object_id)
+end
+return #object_ids
+"""
+
+# 和 PUSH_TO_LIST_SCRIPT 一样，用于 sorted set，ARGV[4] 是 score
+PUSH_TO_SORTED_SET_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[4], ARGV[1])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[2]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
 
 
 class RedisHelper:
+    # {connection: {script: Script}}，每个 connection 只需要 register 一次
+    # Script 用 EVALSHA 执行，redis 里没有这个 script 的时候会自动 SCRIPT LOAD
+    _scripts = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def _get_script(cls, conn, script):
+        scripts = cls._scripts.setdefault(conn, {})
+        if script not in scripts:
+            scripts[script] = conn.register_script(script)
+        return scripts[script]
+
+    @classmethod
+    def _push_to_list(cls, client, script, key, serialized_data):
+        # client 可以是 connection 也可以是 pipeline
+        return script(
+            keys=[key],
+            args=[serialized_data, settings.REDIS_LIST_LENGTH_LIMIT, settings.REDIS_KEY_EXPIRE_TIME],
+            client=client,
+        )
+
+    @classmethod
+    def _push_to_sorted_set(cls, client, script, key, serialized_data, score):
+        return script(
+            keys=[key],
+            args=[
+                serialized_data,
+                settings.REDIS_LIST_LENGTH_LIMIT,
+                settings.REDIS_KEY_EXPIRE_TIME,
+                score,
+            ],
+            client=client,
+        )
 
     @classmethod
-    def _load_objects_to_cache(cls, key, objects):
+    def get_serializer(cls, serializer=None):
+        # 没有指定 serializer 的时候使用 settings.REDIS_SERIALIZER
+        # 所有 serializer 都能解码其他 serializer 的格式，切换的时候不需要清空 redis
+        if serializer is not None:
+            return serializer
+        return import_string(settings.REDIS_SERIALIZER)
+
+    @classmethod
+    def _load_objects_to_cache(cls, key, objects, serializer=None):
+        serializer = cls.get_serializer(serializer)
+        return cls._rebuild_key(
+            key,
+            objects,
+            serializer,
+            lambda pipeline, tmp_key, objects, serialized_list: pipeline.rpush(
+                tmp_key,
+                *serialized_list,
+            ),
+        )
+
+    @classmethod
+    def _rebuild_key(cls, key, objects, serializer, write_to_tmp_key):
+        # 先写到一个临时的 key 里再 RENAME 过去，RENAME 是原子的并且会覆盖已有的 key
+        # 多个进程同时 rebuild 的时候，最后的 key 是其中某一次完整的结果，不会有重复的数据
+        # 也不会读到写了一半的 key
+        # WATCH 住 key，如果查询数据库的过程中有新的数据 push 进来，放弃这次 rebuild，
+        # 否则 RENAME 会把刚 push 进来的数据覆盖掉。key 不存在的时候 push 不会写 key，
+        # 而是改变 rebuild dirty key，参见 _rebuild_after_push_miss
+        # 返回从数据库里 load 的 objects，放弃 rebuild 的时候也一样返回
+        started_at = time.time()
+        conn = RedisClient.get_connection()
+        with conn.pipeline() as pipeline:
+            pipeline.watch(key, cls._get_rebuild_dirty_key(key))
+            # objects 应该传入 lazy 的 queryset，在 WATCH 之后才真正的去数据库查询
+            objects = list(objects[:settings.REDIS_LIST_LENGTH_LIMIT])
+            serialized_list = [serializer.serialize(obj) for obj in objects]
+            pipeline.multi()
+            # 新建的 key 也记一下读取时间，否则不会被 RedisMemoryBudget 按照冷热淘汰
+            pipeline.zadd(TIMELINE_LAST_READ_KEY, {key: time.time()}, nx=True)
+            if serialized_list:
+                tmp_key = cls._get_tmp_key(key)
+                write_to_tmp_key(pipeline, tmp_key, objects, serialized_list)
+                pipeline.expire(tmp_key, settings.REDIS_KEY_EXPIRE_TIME)
+                pipeline.rename(tmp_key, key)
+            else:
+                # 数据库里已经没有数据了，旧的 cache 也不能再用
+                pipeline.delete(key)
+            try:
+                pipeline.execute()
+            except WatchError:
+                return objects
+        CacheMetrics.record_fill(
+            CacheMetrics.get_pattern(key),
+            time.time() - started_at,
+            sum(len(serialized_data) for serialized_data in serialized_list),
+        )
+        return objects
+
+    @classmethod
+    def _get_tmp_key(cls, key):
+        return '{}:tmp:{}'.format(key, uuid.uuid4().hex)
+
+    @classmethod
+    def _get_rebuild_dirty_key(cls, key):
+        return '{}:rebuild_dirty'.format(key)
+
+    @classmethod
+    def _rebuild_after_push_miss(cls, key, load_to_cache):
+        # push 的时候 key 不存在，和 load_objects 一样只有拿到锁的进程从数据库 rebuild
+        # 拿不到锁说明另一个进程正在 rebuild，它可能在这个 object 写进来之前就查询了数据库，
+        # 改变 rebuild dirty key 让它放弃这次 rebuild，下次读取的时候再重新 load
+        lock = cls._get_rebuild_lock(key)
+        if lock.acquire(blocking=False):
+            try:
+                load_to_cache()
+            finally:
+                cls._release_rebuild_lock(lock)
+            return
+        dirty_key = cls._get_rebuild_dirty_key(key)
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.incr(dirty_key)
+        pipeline.expire(dirty_key, settings.REDIS_REBUILD_LOCK_TIMEOUT)
+        pipeline.execute()
+
+    @classmethod
+    def _get_rebuild_lock(cls, key):
+        # 同一个 key 同时只有一个进程去数据库 rebuild，timeout 防止进程挂掉之后锁一直不释放
         conn = RedisClient.get_connection()
+        return conn.lock(
+            '{}:rebuild_lock'.format(key),
+            timeout=settings.REDIS_REBUILD_LOCK_TIMEOUT,
+        )
 
-        serialized_list = []
-        for obj in objects[:settings.REDIS_LIST_LENGTH_LIMIT]:
-            serialized_data = DjangoModelSerializer.serialize(obj)
-            serialized_list.append(serialized_data)
+    @classmethod
+    def _release_rebuild_lock(cls, lock):
+        try:
+            lock.release()
+        except LockError:
+            # rebuild 的时间超过了 timeout，锁已经过期了
+            pass
 
+    @classmethod
+    def _wait_for_rebuild(cls, key):
+        # 其他进程正在 rebuild，等它写完再从 cache 里读，等不到就直接去数据库查询
+        conn = RedisClient.get_connection()
+        deadline = time.time() + settings.REDIS_REBUILD_WAIT_TIME
+        while time.time() < deadline:
+            time.sleep(REBUILD_POLL_INTERVAL)
+            if conn.exists(key):
+                return True
+        return False
+
+    @classmethod
+    def _refresh_if_expiring(cls, key, ttl, load_to_cache):
+        # serve stale while revalidate: 快要过期的 key 由拿到锁的那一个请求去 rebuild
+        # 其他的请求继续使用旧的数据，不会在 key 过期的瞬间一起去数据库查询
+        # ttl 为 -1 表示没有过期时间，-2 表示 key 不存在
+        if ttl < 0 or ttl >= settings.REDIS_STALE_REFRESH_TIME:
+            return
+        lock = cls._get_rebuild_lock(key)
+        if not lock.acquire(blocking=False):
+            return
+        try:
+            load_to_cache()
+        finally:
+            cls._release_rebuild_lock(lock)
+
+    @classmethod
+    def _deserialize_or_invalidate(cls, conn, key, serialized_list, serializer):
+        # 编码用的 schema 已经不在 redis 里了，这个 key 里的数据再也没有办法解码
+        # 删掉 key 并返回 None，调用的地方当成 cache miss，从数据库里 rebuild
+        try:
+            return [
+                serializer.deserialize(serialized_data)
+                for serialized_data in serialized_list
+            ]
+        except UnknownSchemaVersion:
+            conn.delete(key)
+            return None
+
+    @classmethod
+    def load_objects(cls, key, queryset, serializer=None):
+        conn = RedisClient.get_connection()
+        serializer = cls.get_serializer(serializer)
+
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.lrange(key, 0, -1)
+        pipeline.ttl(key)
+        # 记录最后一次读取的时间，参见 RedisMemoryBudget，和读取在同一个 round trip 里
+        pipeline.zadd(TIMELINE_LAST_READ_KEY, {key: time.time()})
+        serialized_list, ttl, _ = pipeline.execute()
+        pattern = CacheMetrics.get_pattern(key)
         if serialized_list:
-            # the following is like conn.rpush(key, 1,2,3)
-            # every rpush is a redis server request
-            conn.rpush(key, *serialized_list)
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+            objects = cls._deserialize_or_invalidate(conn, key, serialized_list, serializer)
+            if objects is not None:
+                CacheMetrics.record_hits(pattern)
+                cls._refresh_if_expiring(
+                    key,
+                    ttl,
+                    lambda: cls._load_objects_to_cache(key, queryset, serializer),
+                )
+                return objects
+
+        CacheMetrics.record_misses(pattern)
+        lock = cls._get_rebuild_lock(key)
+        if lock.acquire(blocking=False):
+            try:
+                return cls._load_objects_to_cache(key, queryset, serializer)
+            finally:
+                cls._release_rebuild_lock(lock)
+
+        if cls._wait_for_rebuild(key):
+            objects = cls._deserialize_or_invalidate(conn, key, conn.lrange(key, 0, -1), serializer)
+            if objects is not None:
+                return objects
+        CacheMetrics.record_db_fallback(pattern)
+        return list(queryset)
+
+    @classmethod
+    def push_object(cls, key, obj, queryset, serializer=None):
+        conn = RedisClient.get_connection()
+        serializer = cls.get_serializer(serializer)
+        # 先检测在不在， 不然expire之后，直接push，会丢数据
+        # 检测和 push 在同一个 script 里执行，中间 key 不会过期，也只需要一次 round trip
+        # 因为是最新的tweet, 应该放在左边第一个
+        script = cls._get_script(conn, PUSH_TO_LIST_SCRIPT)
+        if cls._push_to_list(conn, script, key, serializer.serialize(obj)):
+            return
+        # 如果 key 不存在，直接从数据库里 load
+        # 就不走单个 push 的方式加到 cache 里了
+        cls._rebuild_after_push_miss(
+            key,
+            lambda: cls._load_objects_to_cache(key, queryset, serializer),
+        )
+
+    @classmethod
+    def push_objects_bulk(cls, key_to_obj, serializer=None):
+        # 一次 pipeline 把整批 objects push 到各自的 list 里，只需要一次 round trip
+        # 和 push_object 一样，key 不存在的时候不能直接 push，否则会得到一个只有一个元素
+        # 的 list，看起来像是完整的 cache 从而丢数据。不存在的 key 会在下次读取的时候从数据库里 load
+        if not key_to_obj:
+            return
+        serializer = cls.get_serializer(serializer)
+        conn = RedisClient.get_connection()
+        script = cls._get_script(conn, PUSH_TO_LIST_SCRIPT)
+        pipeline = conn.pipeline(transaction=False)
+        for key, obj in key_to_obj.items():
+            cls._push_to_list(pipeline, script, key, serializer.serialize(obj))
+        pipeline.execute()
+
+    @classmethod
+    def merge_objects(cls, key, objects, sort_key, unique_key=None, serializer=None):
+        # 把 objects 按照 sort_key 倒序合并到已有的 list 里，整个 list 在一个 transaction
+        # 里一次写回去，而不是一个一个的插入。用 WATCH 保证读和写之间如果有其他的 push
+        # 不会被覆盖掉，被修改了就重试
+        # 和 push_object 一样，key 不存在就不写，下次读取的时候会从数据库里 load
+        conn = RedisClient.get_connection()
+        serializer = cls.get_serializer(serializer)
+        with conn.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(key)
+                    if not pipeline.exists(key):
+                        return
+                    cached_objects = cls._deserialize_or_invalidate(
+                        conn,
+                        key,
+                        pipeline.lrange(key, 0, -1),
+                        serializer,
+                    )
+                    if cached_objects is None:
+                        # key 已经被删掉了，下次读取的时候会从数据库里 load
+                        return
+                    if unique_key is not None:
+                        cached_keys = set(unique_key(obj) for obj in cached_objects)
+                        objects = [
+                            obj
+                            for obj in objects
+                            if unique_key(obj) not in cached_keys
+                        ]
+                    merged_objects = sorted(
+                        cached_objects + list(objects),
+                        key=sort_key,
+                        reverse=True,
+                    )[:settings.REDIS_LIST_LENGTH_LIMIT]
+
+                    pipeline.multi()
+                    pipeline.delete(key)
+                    pipeline.rpush(key, *[
+                        serializer.serialize(obj)
+                        for obj in merged_objects
+                    ])
+                    pipeline.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+                    pipeline.execute()
+                    return
+                except WatchError:
+                    continue
 
     @classmethod
-    def load_objects(cls, key, queryset):
+    def remove_objects_bulk(cls, keys, should_remove, serializer=None):
+        # 把所有 list 里满足 should_remove 的 objects 删掉
+        # 一次 pipeline 读出所有的 list，再一次 pipeline 用 LREM 删掉对应的数据
+        # 不管有多少个 key 都只需要两次 round trip
+        if not keys:
+            return
+        serializer = cls.get_serializer(serializer)
         conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        for key in keys:
+            pipeline.lrange(key, 0, -1)
+        serialized_lists = pipeline.execute()
 
-        if conn.exists(key):
-            serialized_list = conn.lrange(key, 0, -1)
-            objects = []
+        pipeline = conn.pipeline(transaction=False)
+        for key, serialized_list in zip(keys, serialized_lists):
             for serialized_data in serialized_list:
-                deserialized_obj = DjangoModelSerializer.deserialize(serialized_data)
-                objects.append(deserialized_obj)
-            return objects
+                try:
+                    obj = serializer.deserialize(serialized_data)
+                except UnknownSchemaVersion:
+                    # 和 _deserialize_or_invalidate 一样，解码不了的 key 直接删掉
+                    pipeline.delete(key)
+                    break
+                if should_remove(obj):
+                    pipeline.lrem(key, 0, serialized_data)
+        pipeline.execute()
 
-        cls._load_objects_to_cache(key, queryset)
+    @classmethod
+    def get_created_at_score(cls, obj):
+        # sorted set 的 score 是 double，微秒级的 timestamp 小于 2^53，不会丢精度
+        return datetime_to_microseconds(obj.created_at)
 
+    @classmethod
+    def _load_objects_to_sorted_set(cls, key, objects, serializer=None):
+        serializer = cls.get_serializer(serializer)
 
-        return list(queryset)
+        def write_to_tmp_key(pipeline, tmp_key, objects, serialized_list):
+            pipeline.zadd(tmp_key, {
+                serialized_data: cls.get_created_at_score(obj)
+                for serialized_data, obj in zip(serialized_list, objects)
+            })
 
+        return cls._rebuild_key(key, objects, serializer, write_to_tmp_key)
 
     @classmethod
-    def push_object(cls, key, obj, queryset):
+    def _read_sorted_set(cls, key, max_score, min_score, count):
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.zrevrangebyscore(
+            key,
+            max_score,
+            min_score,
+            start=0 if count is not None else None,
+            num=count,
+        )
+        pipeline.zcard(key)
+        pipeline.zrange(key, 0, 0, withscores=True)
+        pipeline.ttl(key)
+        pipeline.zadd(TIMELINE_LAST_READ_KEY, {key: time.time()})
+        return pipeline.execute()[:4]
+
+    @classmethod
+    def _filter_by_score(cls, objects, max_score, min_score, count):
+        # 拿不到 rebuild 的锁也等不到 cache 的时候，在数据库查询的结果上做和
+        # ZREVRANGEBYSCORE 一样的过滤
+        def in_range(score, bound, is_max):
+            bound = str(bound)
+            exclusive = bound.startswith('(')
+            bound = float(bound.lstrip('('))
+            if is_max:
+                return score < bound if exclusive else score <= bound
+            return score > bound if exclusive else score >= bound
+
+        objects = [
+            obj
+            for obj in objects
+            if in_range(cls.get_created_at_score(obj), max_score, True)
+            and in_range(cls.get_created_at_score(obj), min_score, False)
+        ]
+        if count is not None:
+            objects = objects[:count]
+        return objects
+
+    @classmethod
+    def load_objects_by_score(
+        cls,
+        key,
+        queryset,
+        max_score='+inf',
+        min_score='-inf',
+        count=None,
+        serializer=None,
+    ):
+        # 从以 created_at 为 score 的 sorted set 里按照 score 倒序取出 [min_score, max_score]
+        # 之间的最多 count 个 objects，只需要反序列化需要的那一页，而不是整个 list
+        # 开区间的 score 用 '(' 开头，比如 '(1600000000000000'
+        # 返回 (objects, oldest_score)，oldest_score 是 cache 里最老的一条的 score，
+        # cache 里已经是所有数据的时候为 None，比它更老的数据需要去数据库里查询
+        serializer = cls.get_serializer(serializer)
+        serialized_list, cached_count, oldest, ttl = cls._read_sorted_set(
+            key,
+            max_score,
+            min_score,
+            count,
+        )
+        pattern = CacheMetrics.get_pattern(key)
+        conn = RedisClient.get_connection()
+        objects = None
+        if cached_count:
+            objects = cls._deserialize_or_invalidate(conn, key, serialized_list, serializer)
+        if objects is not None:
+            CacheMetrics.record_hits(pattern)
+            cls._refresh_if_expiring(
+                key,
+                ttl,
+                lambda: cls._load_objects_to_sorted_set(key, queryset, serializer),
+            )
+        else:
+            # key 不存在或者解码不了，只有拿到锁的进程从数据库里 load，其他进程等它 load 完
+            CacheMetrics.record_misses(pattern)
+            lock = cls._get_rebuild_lock(key)
+            if lock.acquire(blocking=False):
+                try:
+                    objects = cls._load_objects_to_sorted_set(key, queryset, serializer)
+                finally:
+                    cls._release_rebuild_lock(lock)
+                oldest_score = None
+                if len(objects) >= settings.REDIS_LIST_LENGTH_LIMIT:
+                    oldest_score = cls.get_created_at_score(objects[-1])
+                return cls._filter_by_score(objects, max_score, min_score, count), oldest_score
+            if not cls._wait_for_rebuild(key):
+                CacheMetrics.record_db_fallback(pattern)
+                return cls._filter_by_score(list(queryset), max_score, min_score, count), None
+            serialized_list, cached_count, oldest, _ = cls._read_sorted_set(
+                key,
+                max_score,
+                min_score,
+                count,
+            )
+            objects = cls._deserialize_or_invalidate(conn, key, serialized_list, serializer)
+            if objects is None:
+                CacheMetrics.record_db_fallback(pattern)
+                return cls._filter_by_score(list(queryset), max_score, min_score, count), None
+
+        if cached_count < settings.REDIS_LIST_LENGTH_LIMIT or not oldest:
+            return objects, None
+        return objects, oldest[0][1]
+
+    @classmethod
+    def _trim_sorted_set(cls, pipeline, key):
+        # 只保留 score 最大的 REDIS_LIST_LENGTH_LIMIT 个
+        pipeline.zremrangebyrank(key, 0, -settings.REDIS_LIST_LENGTH_LIMIT - 1)
+
+    @classmethod
+    def push_object_to_sorted_set(cls, key, obj, queryset, serializer=None):
+        conn = RedisClient.get_connection()
+        serializer = cls.get_serializer(serializer)
+        # 和 push_object 一样，key 不存在的时候直接从数据库里 load
+        script = cls._get_script(conn, PUSH_TO_SORTED_SET_SCRIPT)
+        if cls._push_to_sorted_set(
+            conn,
+            script,
+            key,
+            serializer.serialize(obj),
+            cls.get_created_at_score(obj),
+        ):
+            return
+        cls._rebuild_after_push_miss(
+            key,
+            lambda: cls._load_objects_to_sorted_set(key, queryset, serializer),
+        )
+
+    @classmethod
+    def push_objects_to_sorted_sets_bulk(cls, key_to_obj, serializer=None):
+        # 和 push_objects_bulk 一样，一次 pipeline 只 push 到已经存在的 key 里
+        if not key_to_obj:
+            return
+        serializer = cls.get_serializer(serializer)
+        conn = RedisClient.get_connection()
+        script = cls._get_script(conn, PUSH_TO_SORTED_SET_SCRIPT)
+        pipeline = conn.pipeline(transaction=False)
+        for key, obj in key_to_obj.items():
+            cls._push_to_sorted_set(
+                pipeline,
+                script,
+                key,
+                serializer.serialize(obj),
+                cls.get_created_at_score(obj),
+            )
+        pipeline.execute()
+
+    @classmethod
+    def merge_objects_to_sorted_set(cls, key, objects, unique_key=None, serializer=None):
+        # sorted set 本身是有序的，merge 只需要 ZADD，不需要把整个 list 读出来重写
+        # 需要按照 unique_key 去重的时候才读一次已有的数据
+        serializer = cls.get_serializer(serializer)
         conn = RedisClient.get_connection()
-        # 先检测在不在， 不然expire之后，直接push，会丢数据
         if not conn.exists(key):
-            # 如果 key 不存在，直接从数据库里 load
-            # 就不走单个 push 的方式加到 cache 里了
-            cls._load_objects_to_cache(key, queryset)
             return
-        serialized_data = DjangoModelSerializer.serialize(obj)
-        #因为是最新的tweet, 应该放在左边第一个
-        conn.lpush(key, serialized_data)
-        conn.ltrim(key, 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
+        if unique_key is not None:
+            cached_objects = cls._deserialize_or_invalidate(
+                conn,
+                key,
+                conn.zrange(key, 0, -1),
+                serializer,
+            )
+            if cached_objects is None:
+                return
+            cached_keys = set(unique_key(obj) for obj in cached_objects)
+            objects = [
+                obj
+                for obj in objects
+                if unique_key(obj) not in cached_keys
+            ]
+        if not objects:
+            return
+        pipeline = conn.pipeline()
+        pipeline.zadd(key, {
+            serializer.serialize(obj): cls.get_created_at_score(obj)
+            for obj in objects
+        })
+        cls._trim_sorted_set(pipeline, key)
+        pipeline.execute()
+
+    @classmethod
+    def remove_objects_from_sorted_sets_bulk(cls, keys, should_remove, serializer=None):
+        # 和 remove_objects_bulk 一样，两次 round trip
+        if not keys:
+            return
+        serializer = cls.get_serializer(serializer)
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        for key in keys:
+            pipeline.zrange(key, 0, -1)
+        serialized_lists = pipeline.execute()
+
+        pipeline = conn.pipeline(transaction=False)
+        for key, serialized_list in zip(keys, serialized_lists):
+            try:
+                removed = [
+                    serialized_data
+                    for serialized_data in serialized_list
+                    if should_remove(serializer.deserialize(serialized_data))
+                ]
+            except UnknownSchemaVersion:
+                pipeline.delete(key)
+                continue
+            if removed:
+                pipeline.zrem(key, *removed)
+        pipeline.execute()
+
+    @classmethod
+    def invalidate_keys(cls, keys):
+        if not keys:
+            return
+        conn = RedisClient.get_connection()
+        conn.delete(*keys)
 
     @classmethod
     def get_count_key(cls, obj, attr):
         return '{}.{}:{}'.format(obj.__class__.__name__, attr, obj.id)
 
     @classmethod
-    def incr_count(cls, obj, attr):
-        conn = RedisClient.get_connection()
+    def _get_count_refill_dirty_key(cls, count_key):
+        return '{}:refill_dirty'.format(count_key)
+
+    @classmethod
+    def _incr_count_if_exists(cls, obj, attr, delta):
+        # 计数的 key 有 REDIS_COUNTER_EXPIRE_TIME 的过期时间，过期之后由 get_count 从数据库 load
+        conn = RedisClient.get_connection(RedisClient.COUNTERS)
+        script = cls._get_script(conn, INCR_COUNT_IF_EXISTS_SCRIPT)
         key = cls.get_count_key(obj, attr)
-        return conn.incr(key)
+        return script(
+            keys=[key, cls._get_count_refill_dirty_key(key)],
+            args=[delta, settings.REDIS_COUNTER_EXPIRE_TIME, settings.REDIS_REBUILD_LOCK_TIMEOUT],
+            client=conn,
+        )
+
+    @classmethod
+    def incr_count(cls, obj, attr):
+        return cls._incr_count_if_exists(obj, attr, 1)
 
     @classmethod
     def decr_count(cls, obj, attr):
-        conn = RedisClient.get_connection()
-        key = cls.get_count_key(obj, attr)
-        return conn.decr(key)
+        return cls._incr_count_if_exists(obj, attr, -1)
 
     @classmethod
     def get_count(cls, obj, attr):
-        conn = RedisClient.get_connection()
+        conn = RedisClient.get_connection(RedisClient.COUNTERS)
         key = cls.get_count_key(obj, attr)
         count = conn.get(key)
         if count is not None:
             return int(count)
 
-        obj.refresh_from_db()
-        count = getattr(obj, attr)
-        conn.set(key, count)
+        # 和 _rebuild_key 一样在查询数据库之前 WATCH 住 key 和 refill dirty key，
+        # 查询数据库的过程中有计数的变化的话 incr 是 no-op，写回去的就是一个过期的值，
+        # 所以放弃写回，下次读取的时候再从数据库 load
+        with conn.pipeline() as pipeline:
+            pipeline.watch(key, cls._get_count_refill_dirty_key(key))
+            count = pipeline.get(key)
+            if count is not None:
+                return int(count)
+            obj.refresh_from_db()
+            count = getattr(obj, attr) + cls._get_pending_delta(conn, obj.__class__, obj.id, attr)
+            pipeline.multi()
+            pipeline.set(key, count, ex=settings.REDIS_COUNTER_EXPIRE_TIME)
+            try:
+                pipeline.execute()
+            except WatchError:
+                pass
         return count
+
+    @classmethod
+    def _get_pending_delta(cls, conn, model_class, object_id, attr):
+        # write behind 模式下数据库里的值还没有加上的 delta，包括还没有 flush 的和正在 flush 的
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.hget(cls._get_count_delta_key(model_class, attr), object_id)
+        pipeline.hget(cls._get_inflight_count_delta_key(model_class, attr), object_id)
+        return sum(int(delta or 0) for delta in pipeline.execute())
+
+    @classmethod
+    def get_counts(cls, objects, attrs):
+        # 一页 objects 的计数一次 MGET 取出来，cache 里没有的用一次 id__in 查询补上
+        # 不管一页有多少个 objects，都只需要固定次数的 redis 和数据库的 round trip
+        # 返回 {object id: {attr: count}}
+        objects = [obj for obj in objects if obj is not None]
+        if not objects:
+            return {}
+        model_class = objects[0].__class__
+        object_ids = list(set(obj.id for obj in objects))
+        conn = RedisClient.get_connection(RedisClient.COUNTERS)
+        keys = [
+            (object_id, attr, cls.get_count_key(model_class(id=object_id), attr))
+            for object_id in object_ids
+            for attr in attrs
+        ]
+        values = conn.mget([key for _, _, key in keys])
+
+        counts = {object_id: {} for object_id in object_ids}
+        missing = []
+        for (object_id, attr, key), value in zip(keys, values):
+            if value is None:
+                missing.append((object_id, attr, key))
+            else:
+                counts[object_id][attr] = int(value)
+        if not missing:
+            return counts
+
+        missing_ids = list(set(object_id for object_id, _, _ in missing))
+        with conn.pipeline() as pipeline:
+            # 和 get_count 一样，查询数据库的过程中有计数的变化，或者另一个进程已经写过这些 key，
+            # 就放弃这一批的写回
+            pipeline.watch(*[
+                watched_key
+                for _, _, key in missing
+                for watched_key in (key, cls._get_count_refill_dirty_key(key))
+            ])
+            rows = {
+                row['id']: row
+                for row in model_class.objects.filter(id__in=missing_ids).values('id', *attrs)
+            }
+            # write behind 模式下还没有 flush 到数据库的 delta
+            delta_pipeline = conn.pipeline(transaction=False)
+            for object_id, attr, _ in missing:
+                delta_pipeline.hget(cls._get_count_delta_key(model_class, attr), object_id)
+                delta_pipeline.hget(
+                    cls._get_inflight_count_delta_key(model_class, attr),
+                    object_id,
+                )
+            results = delta_pipeline.execute()
+            pending_deltas = [
+                int(delta or 0) + int(inflight_delta or 0)
+                for delta, inflight_delta in zip(results[::2], results[1::2])
+            ]
+
+            pipeline.multi()
+            for (object_id, attr, key), pending_delta in zip(missing, pending_deltas):
+                if object_id not in rows:
+                    continue
+                count = (rows[object_id][attr] or 0) + int(pending_delta or 0)
+                counts[object_id][attr] = count
+                pipeline.set(key, count, ex=settings.REDIS_COUNTER_EXPIRE_TIME)
+            try:
+                pipeline.execute()
+            except WatchError:
+                pass
+        return counts
+
+    @classmethod
+    def _get_dirty_count_key(cls, model_class):
+        return DIRTY_COUNTS_PATTERN.format(model=model_class.__name__)
+
+    @classmethod
+    def _get_count_delta_key(cls, model_class, attr):
+        return COUNT_DELTAS_PATTERN.format(model=model_class.__name__, attr=attr)
+
+    @classmethod
+    def record_count_delta(cls, obj, attr, delta):
+        # write behind: redis 是计数的 source of truth，数据库里的值由定时任务批量的 flush
+        # 一次 round trip 更新计数，记录 delta 并把 object 标记为 dirty
+        conn = RedisClient.get_connection(RedisClient.COUNTERS)
+        script = cls._get_script(conn, RECORD_COUNT_DELTA_SCRIPT)
+        key = cls.get_count_key(obj, attr)
+        return script(
+            keys=[
+                key,
+                cls._get_dirty_count_key(obj.__class__),
+                cls._get_count_delta_key(obj.__class__, attr),
+                cls._get_count_refill_dirty_key(key),
+            ],
+            args=[
+                obj.id,
+                delta,
+                settings.REDIS_COUNTER_EXPIRE_TIME,
+                settings.REDIS_REBUILD_LOCK_TIMEOUT,
+            ],
+            client=conn,
+        )
+
+    @classmethod
+    def _get_inflight_count_delta_key(cls, model_class, attr):
+        return INFLIGHT_COUNT_DELTAS_PATTERN.format(model=model_class.__name__, attr=attr)
+
+    @classmethod
+    def _get_count_delta_script_keys(cls, model_class, attrs):
+        return (
+            [
+                cls._get_dirty_count_key(model_class),
+                INFLIGHT_COUNTS_PATTERN.format(model=model_class.__name__),
+            ]
+            + [cls._get_count_delta_key(model_class, attr) for attr in attrs]
+            + [cls._get_inflight_count_delta_key(model_class, attr) for attr in attrs]
+        )
+
+    @classmethod
+    def flush_count_deltas(cls, model_class, attrs, batch_size):
+        # 取出最多 batch_size 个 dirty objects 的 delta，用一条 CASE WHEN 的 UPDATE 语句
+        # 写回数据库。返回 flush 的 object 数量，0 表示没有需要 flush 的数据了
+        # delta 在数据库 commit 之前一直留在 inflight hash 里，get_count 在这期间 rebuild
+        # 计数的时候不会少算，进程在 commit 之前挂掉的话由 recover_count_deltas 还回去
+        conn = RedisClient.get_connection(RedisClient.COUNTERS)
+        keys = cls._get_count_delta_script_keys(model_class, attrs)
+        script = cls._get_script(conn, POP_COUNT_DELTAS_SCRIPT)
+        rows = script(keys=keys, args=[batch_size, time.time(), len(attrs)], client=conn)
+        if not rows:
+            return 0
+
+        deltas = {
+            int(row[0]): [int(delta) for delta in row[1:]]
+            for row in rows
+        }
+        updates = {}
+        for index, attr in enumerate(attrs):
+            whens = [
+                When(id=object_id, then=F(attr) + object_deltas[index])
+                for object_id, object_deltas in deltas.items()
+                if object_deltas[index]
+            ]
+            if whens:
+                updates[attr] = Case(*whens, default=F(attr), output_field=IntegerField())
+
+        ack_args = [len(attrs), 0]
+        for object_id, object_deltas in deltas.items():
+            ack_args.append(object_id)
+            ack_args.extend(object_deltas)
+        script = cls._get_script(conn, ACK_COUNT_DELTAS_SCRIPT)
+        try:
+            if updates:
+                model_class.objects.filter(id__in=list(deltas.keys())).update(**updates)
+        except Exception:
+            # 写数据库失败的时候把 delta 还回去，下次 flush 的时候重试
+            ack_args[1] = 1
+            script(keys=keys, args=ack_args, client=conn)
+            raise
+        script(keys=keys, args=ack_args, client=conn)
+        return len(deltas)
+
+    @classmethod
+    def recover_count_deltas(cls, model_class, attrs, timeout):
+        # 超过 timeout 秒还没有 commit 的 inflight delta 说明 flush 的进程已经挂掉了
+        # 把它们还给 delta hash，下次 flush 的时候重新写回数据库，返回还回去的 object 数量
+        # 如果那个进程其实已经 commit 了，这些 delta 会被重复写一次，所以 timeout 要大于
+        # flush 任务的 time_limit
+        conn = RedisClient.get_connection(RedisClient.COUNTERS)
+        script = cls._get_script(conn, RECOVER_COUNT_DELTAS_SCRIPT)
+        return script(
+            keys=cls._get_count_delta_script_keys(model_class, attrs),
+            args=[len(attrs), time.time() - timeout],
+            client=conn,
+        )
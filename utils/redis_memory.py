@@ -0,0 +1,148 @@
+import logging
+import time
+
+import redis
+from django.conf import settings
+from twitter.cache import TIMELINE_LAST_READ_KEY, USER_LAST_ACTIVE_KEY
+from utils.cache_metrics import CacheMetrics
+from utils.redis_client import RedisClient
+
+# 每次淘汰的 timeline 数量，以及超过内存预算的时候最多淘汰的批数
+EVICTION_BATCH_SIZE = 500
+MAX_EVICTION_BATCHES = 100
+
+logger = logging.getLogger(__name__)
+
+
+class RedisMemoryBudget:
+    # timeline 的 key 每次被读取的时候都会在 TIMELINE_LAST_READ_KEY 里记下读取的时间
+    # evict_cold_timelines 先删掉超过 REDIS_TIMELINE_IDLE_TIME 没有被读过的 timelines，
+    # 如果 redis 的内存依然超过 REDIS_MEMORY_BUDGET，再按照最后读取的时间从旧到新继续删
+    # 被删掉的 timeline 下次读取的时候会从数据库 rebuild，所以 redis 的内存只和活跃用户
+    # 的数量有关，而不是和所有用户的数量有关
+
+    @classmethod
+    def _evict(cls, conn, keys):
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.delete(*keys)
+        pipeline.zrem(TIMELINE_LAST_READ_KEY, *keys)
+        pipeline.execute()
+
+    @classmethod
+    def _get_used_memory(cls, conn):
+        # fakeredis 以及一些托管的 redis 不支持 INFO，返回 None
+        try:
+            return conn.info('memory')['used_memory']
+        except redis.ResponseError:
+            return None
+
+    @classmethod
+    def evict_cold_timelines(cls, now=None):
+        # 返回被淘汰的 timeline 数量
+        conn = RedisClient.get_connection()
+        if now is None:
+            now = time.time()
+        evicted = 0
+        idle_before = now - settings.REDIS_TIMELINE_IDLE_TIME
+        while True:
+            keys = conn.zrangebyscore(
+                TIMELINE_LAST_READ_KEY,
+                '-inf',
+                idle_before,
+                start=0,
+                num=EVICTION_BATCH_SIZE,
+            )
+            if not keys:
+                break
+            cls._evict(conn, keys)
+            evicted += len(keys)
+
+        budget = settings.REDIS_MEMORY_BUDGET
+        if not budget:
+            return evicted
+        for _ in range(MAX_EVICTION_BATCHES):
+            used_memory = cls._get_used_memory(conn)
+            if used_memory is None:
+                logger.warning('INFO memory is not supported, skip evicting timelines by REDIS_MEMORY_BUDGET')
+                break
+            if used_memory <= budget:
+                break
+            keys = conn.zrange(TIMELINE_LAST_READ_KEY, 0, EVICTION_BATCH_SIZE - 1)
+            if not keys:
+                break
+            cls._evict(conn, keys)
+            evicted += len(keys)
+        return evicted
+
+    @classmethod
+    def sample_key_sizes(cls, conn, samples):
+        # 用 RANDOMKEY 随机取 samples 个 key，按照 key pattern 统计 MEMORY USAGE
+        # 每个 pattern 的 key 数量按照它在样本里的比例估计，不需要 SCAN 整个 keyspace
+        # 不支持 MEMORY USAGE 的时候只估计 key 的数量，bytes 都是 None
+        pipeline = conn.pipeline(transaction=False)
+        for _ in range(samples):
+            pipeline.randomkey()
+        pipeline.dbsize()
+        results = pipeline.execute()
+        keys, total_keys = [key for key in results[:-1] if key is not None], results[-1]
+        if not keys:
+            return {}
+
+        pipeline = conn.pipeline(transaction=False)
+        for key in keys:
+            pipeline.memory_usage(key)
+        sizes = pipeline.execute(raise_on_error=False)
+        supported = not any(isinstance(size, redis.ResponseError) for size in sizes)
+        patterns = {}
+        for key, size in zip(keys, sizes):
+            stats = patterns.setdefault(CacheMetrics.get_pattern(key.decode()), {
+                'sampled_keys': 0,
+                'sampled_bytes': 0 if supported else None,
+            })
+            stats['sampled_keys'] += 1
+            if supported:
+                # 取样之后过期了的 key 是 None
+                stats['sampled_bytes'] += size or 0
+        for stats in patterns.values():
+            stats['estimated_keys'] = round(total_keys * stats['sampled_keys'] / len(keys))
+            if not supported:
+                stats['avg_bytes'] = stats['estimated_bytes'] = None
+                continue
+            stats['avg_bytes'] = round(stats['sampled_bytes'] / stats['sampled_keys'])
+            stats['estimated_bytes'] = stats['avg_bytes'] * stats['estimated_keys']
+        return patterns
+
+    @classmethod
+    def get_report(cls, samples=1000):
+        # 每个 logical client 的内存使用情况，以及平摊到每个活跃用户的内存
+        # used_memory 是整个 redis 实例的，几个 logical client 在同一个实例上的时候是同一个值
+        conn = RedisClient.get_connection()
+        active_users = conn.zcount(
+            USER_LAST_ACTIVE_KEY,
+            time.time() - settings.REDIS_KEY_EXPIRE_TIME,
+            '+inf',
+        )
+        report = {
+            'active_users': active_users,
+            'budget': settings.REDIS_MEMORY_BUDGET,
+            'tracked_timelines': conn.zcard(TIMELINE_LAST_READ_KEY),
+            'clients': {},
+        }
+        for name in (RedisClient.CACHE, RedisClient.COUNTERS):
+            client_conn = RedisClient.get_connection(name)
+            used_memory = cls._get_used_memory(client_conn)
+            patterns = cls.sample_key_sizes(client_conn, samples)
+            for stats in patterns.values():
+                stats['bytes_per_active_user'] = (
+                    round(stats['estimated_bytes'] / active_users)
+                    if active_users and stats['estimated_bytes'] is not None else None
+                )
+            report['clients'][name] = {
+                'used_memory': used_memory,
+                'bytes_per_active_user': (
+                    round(used_memory / active_users)
+                    if active_users and used_memory is not None else None
+                ),
+                'patterns': patterns,
+            }
+        return report
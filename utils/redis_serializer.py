@@ -1,5 +1,20 @@
+import datetime
+import hashlib
+import json
+import time
+
+from django.apps import apps
+from django.conf import settings
 from django.core import serializers
+from django.db import DEFAULT_DB_ALIAS
 from utils.json_encoder import JSONEncoder
+from utils.redis_client import RedisClient
+from utils.time_helpers import datetime_to_microseconds, microseconds_to_datetime
+
+
+class UnknownSchemaVersion(ValueError):
+    # 编码用的 schema 已经不在 redis 里了（被淘汰或者 redis 被 flush 了），数据没有办法解码
+    pass
 
 
 class DjangoModelSerializer:
@@ -12,6 +27,151 @@ class DjangoModelSerializer:
 
     @classmethod
     def deserialize(cls, serialized_data):
+        # cache 里可能已经是 CompactModelSerializer 的格式了，切换回来的时候不需要清空 redis
+        if CompactModelSerializer.is_compact(serialized_data):
+            return CompactModelSerializer.deserialize(serialized_data)
         # 需要加 .object 来得到原始的 model 类型的 object 数据，要不然得到的数据并不是一个
         # ORM 的 object，而是一个 DeserializedObject 的类型
-        return list(serializers.deserialize('json', serialized_data))[0].object
\ No newline at end of file
+        return list(serializers.deserialize('json', serialized_data))[0].object
+
+
+class ModelSchema:
+    # 一个 model 的所有 concrete fields 以及每个 field 的编码/解码方式
+    # version 由 field 的名字和类型计算出来，model 的 fields 改变之后 version 也会改变
+
+    def __init__(self, model_class, field_names=None):
+        fields = model_class._meta.concrete_fields
+        if field_names is not None:
+            fields_by_name = {field.attname: field for field in fields}
+            fields = [fields_by_name.get(field_name) for field_name in field_names]
+        self.model_class = model_class
+        self.field_names = [
+            field.attname if field is not None else None
+            for field in fields
+        ]
+        self.encoders = [self._get_encoder(field) for field in fields]
+        self.decoders = [self._get_decoder(field) for field in fields]
+        self.version = hashlib.md5(','.join(
+            '{}:{}'.format(field.attname, field.get_internal_type())
+            for field in fields
+            if field is not None
+        ).encode()).hexdigest()[:8]
+
+    def _get_encoder(self, field):
+        internal_type = field.get_internal_type() if field is not None else None
+        if internal_type == 'DateTimeField':
+            return datetime_to_microseconds
+        if internal_type == 'DateField':
+            return datetime.date.toordinal
+        if internal_type in ('DecimalField', 'UUIDField', 'FileField', 'ImageField'):
+            return str
+        return None
+
+    def _get_decoder(self, field):
+        internal_type = field.get_internal_type() if field is not None else None
+        if internal_type == 'DateTimeField':
+            return microseconds_to_datetime
+        if internal_type == 'DateField':
+            return datetime.date.fromordinal
+        if internal_type in ('DecimalField', 'UUIDField'):
+            return field.to_python
+        return None
+
+    def encode(self, instance):
+        values = []
+        for field_name, encoder in zip(self.field_names, self.encoders):
+            value = getattr(instance, field_name)
+            if value is not None and encoder is not None:
+                value = encoder(value)
+            values.append(value)
+        return values
+
+    def decode(self, values):
+        field_names, decoded_values = [], []
+        for field_name, decoder, value in zip(self.field_names, self.decoders, values):
+            # 旧的 schema 里有但是现在已经删掉了的 field
+            if field_name is None:
+                continue
+            if value is not None and decoder is not None:
+                value = decoder(value)
+            field_names.append(field_name)
+            decoded_values.append(value)
+        # 旧的 schema 里没有的 field 会被当做 deferred field，第一次访问的时候从数据库里 load
+        return self.model_class.from_db(DEFAULT_DB_ALIAS, field_names, decoded_values)
+
+
+class CompactModelSerializer:
+    # 比 DjangoModelSerializer 快很多也小很多的格式:
+    #   HEADER + json([app_label.model_name, schema version, [field values]])
+    # field values 按照 schema 的顺序排列，不存 field 的名字。每个 schema version 的 field
+    # 名字会存在 redis 里，model 改变之后旧版本的数据依然可以被解码，不需要清空 redis
+    # 以 '[' 开头的数据是 DjangoModelSerializer 的格式，也可以直接解码
+    HEADER = b'\x01'
+    SCHEMA_KEY_PATTERN = 'codec_schema:{label}:{version}'
+
+    # process 里的 cache，{model_class: ModelSchema} 和 {(label, version): ModelSchema}
+    _current_schemas = {}
+    _schemas_by_version = {}
+    # {model_class: 最后一次把当前的 schema 写进 redis 的时间}
+    _registered_at = {}
+
+    @classmethod
+    def is_compact(cls, serialized_data):
+        if isinstance(serialized_data, str):
+            return serialized_data[:1] == cls.HEADER.decode()
+        return serialized_data[:1] == cls.HEADER
+
+    @classmethod
+    def get_schema(cls, model_class):
+        schema = cls._current_schemas.get(model_class)
+        registered_at = cls._registered_at.get(model_class, 0)
+        if schema is not None and time.time() - registered_at < settings.CACHE_VERSION_REFRESH_INTERVAL:
+            return schema
+        if schema is None:
+            schema = ModelSchema(model_class)
+        label = model_class._meta.label_lower
+        # 把这个版本的 field 名字记下来，给以后 model 改变之后的进程解码用
+        # 每 CACHE_VERSION_REFRESH_INTERVAL 秒重新写一次，redis 被清空之后也会重新记上
+        conn = RedisClient.get_connection()
+        conn.set(
+            cls.SCHEMA_KEY_PATTERN.format(label=label, version=schema.version),
+            json.dumps(schema.field_names),
+            nx=True,
+        )
+        cls._current_schemas[model_class] = schema
+        cls._schemas_by_version[(label, schema.version)] = schema
+        cls._registered_at[model_class] = time.time()
+        return schema
+
+    @classmethod
+    def _get_schema_by_version(cls, label, version):
+        schema = cls._schemas_by_version.get((label, version))
+        if schema is not None:
+            return schema
+        model_class = apps.get_model(label)
+        current_schema = cls.get_schema(model_class)
+        if current_schema.version == version:
+            return current_schema
+        conn = RedisClient.get_connection()
+        field_names = conn.get(cls.SCHEMA_KEY_PATTERN.format(label=label, version=version))
+        if field_names is None:
+            raise UnknownSchemaVersion('unknown schema version {} of {}'.format(version, label))
+        schema = ModelSchema(model_class, json.loads(field_names))
+        cls._schemas_by_version[(label, version)] = schema
+        return schema
+
+    @classmethod
+    def serialize(cls, instance):
+        schema = cls.get_schema(instance.__class__)
+        return cls.HEADER + json.dumps(
+            [instance._meta.label_lower, schema.version, schema.encode(instance)],
+            separators=(',', ':'),
+            ensure_ascii=False,
+        ).encode('utf-8')
+
+    @classmethod
+    def deserialize(cls, serialized_data):
+        if not cls.is_compact(serialized_data):
+            return DjangoModelSerializer.deserialize(serialized_data)
+        label, version, values = json.loads(serialized_data[1:])
+        return cls._get_schema_by_version(label, version).decode(values)
@@ -0,0 +1,13 @@
+from django.db import models
+from rest_framework import serializers
+
+
+class PrefetchListSerializer(serializers.ListSerializer):
+    # many=True 的时候，在序列化一页 objects 之前调用 child serializer 的
+    # prefetch_for_page(objects, context)，把每个 object 都需要的数据批量的取出来
+    # 避免每个 object 一个一个的去 cache 或者数据库里取
+
+    def to_representation(self, data):
+        objects = list(data.all() if isinstance(data, models.Manager) else data)
+        self.child.prefetch_for_page(objects, self.context)
+        return super(PrefetchListSerializer, self).to_representation(objects)
@@ -1,5 +1,21 @@
+import json
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.test import override_settings
 from testing.testcase import TestCase
-from utils.redis_client import RedisClient
+from tweets.models import Tweet
+from twitter.cache import CACHE_VERSIONS_PATTERN, TIMELINE_LAST_READ_KEY
+from utils.cache_metrics import CacheMetrics
+from utils.cache_versions import ModelCacheVersion
+from utils.local_cache import LocalObjectCache
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient, RedisCommandStats
+from utils.redis_helper import RedisHelper
+from utils.redis_memory import RedisMemoryBudget
+from utils.redis_serializer import CompactModelSerializer
 
 class UtilsTests(TestCase):
 
@@ -15,4 +31,339 @@ class UtilsTests(TestCase):
 
         RedisClient.clear()
         cached_list = conn.lrange('redis_key', 0, -1)
-        self.assertEqual(cached_list, [])
\ No newline at end of file
+        self.assertEqual(cached_list, [])
+
+    def test_redis_client_stats(self):
+        RedisCommandStats.reset()
+        conn = RedisClient.get_connection()
+        conn.set('redis_key', 1)
+        pipeline = conn.pipeline()
+        pipeline.get('redis_key')
+        pipeline.execute()
+
+        stats = RedisClient.get_stats()
+        self.assertEqual(stats['commands']['cache.SET']['count'], 1)
+        self.assertEqual(stats['commands']['cache.PIPELINE']['count'], 1)
+        self.assertEqual(stats['pools']['cache']['max_connections'], settings.REDIS_MAX_CONNECTIONS)
+        self.assertGreaterEqual(stats['pools']['cache']['in_use_connections'], 0)
+
+    def test_push_objects_bulk(self):
+        alice = self.create_user('alice')
+        tweet1 = self.create_tweet(alice)
+        RedisClient.clear()
+        conn = RedisClient.get_connection()
+
+        queryset = Tweet.objects.filter(id=tweet1.id)
+        RedisHelper.load_objects('existing_key', queryset)
+        tweet2 = self.create_tweet(alice)
+        RedisHelper.push_objects_bulk({
+            'existing_key': tweet2,
+            'missing_key': tweet2,
+        })
+
+        # missing key should not be created with a partial list
+        self.assertEqual(conn.exists('missing_key'), False)
+        objects = RedisHelper.load_objects('existing_key', queryset)
+        self.assertEqual([t.id for t in objects], [tweet2.id, tweet1.id])
+
+    def test_rebuild_cache_without_duplicates(self):
+        alice = self.create_user('alice')
+        tweets = [self.create_tweet(alice) for _ in range(3)]
+        RedisClient.clear()
+        conn = RedisClient.get_connection()
+        queryset = Tweet.objects.filter(user=alice).order_by('-created_at')
+
+        # rebuild 两次之后 list 里也不会有重复的数据
+        RedisHelper._load_objects_to_cache('tweets_key', queryset)
+        RedisHelper._load_objects_to_cache('tweets_key', queryset)
+        self.assertEqual(conn.llen('tweets_key'), 3)
+
+        # 快要过期的 key 被读到的时候会提前 rebuild
+        conn.expire('tweets_key', 10)
+        objects = RedisHelper.load_objects('tweets_key', queryset)
+        self.assertEqual([t.id for t in objects], [t.id for t in tweets[::-1]])
+        self.assertGreater(conn.ttl('tweets_key'), 10)
+        self.assertEqual(conn.llen('tweets_key'), 3)
+
+        # 其他进程正在 rebuild 的时候不会重复的去 rebuild
+        conn.delete('tweets_key')
+        lock = RedisHelper._get_rebuild_lock('tweets_key')
+        lock.acquire(blocking=False)
+        objects = RedisHelper.load_objects('tweets_key', queryset)
+        self.assertEqual(len(objects), 3)
+        self.assertEqual(conn.exists('tweets_key'), False)
+        lock.release()
+
+    def test_push_object_during_rebuild(self):
+        alice = self.create_user('alice')
+        self.create_tweet(alice)
+        RedisClient.clear()
+        conn = RedisClient.get_connection()
+        queryset = Tweet.objects.filter(user=alice).order_by('-created_at')
+
+        class PushDuringQuery:
+            # 在 rebuild WATCH 之后、查询数据库的时候有一条新的 tweet 被 push
+            def __getitem__(self, index):
+                objects = list(queryset[index])
+                new_tweet = Tweet.objects.create(user=alice, content='new tweet')
+                RedisHelper.push_object('tweets_key', new_tweet, queryset)
+                return objects
+
+        # 另一个进程拿着锁在 rebuild，push 不会自己去 rebuild，而是让那次 rebuild 作废
+        lock = RedisHelper._get_rebuild_lock('tweets_key')
+        lock.acquire(blocking=False)
+        objects = RedisHelper._load_objects_to_cache('tweets_key', PushDuringQuery())
+        lock.release()
+        self.assertEqual(len(objects), 1)
+        self.assertFalse(conn.exists('tweets_key'))
+
+        # 下次读取的时候重新 load，新的 tweet 不会丢
+        objects = RedisHelper.load_objects('tweets_key', queryset)
+        self.assertEqual(len(objects), 2)
+        self.assertEqual(conn.llen('tweets_key'), 2)
+
+    def test_load_objects_with_unknown_schema_version(self):
+        alice = self.create_user('alice')
+        tweets = [self.create_tweet(alice) for _ in range(2)]
+        conn = RedisClient.get_connection()
+        queryset = Tweet.objects.filter(user=alice).order_by('-created_at')
+        # schema 的记录被淘汰之后，旧版本的进程写进去的数据没有办法解码
+        unknown_data = CompactModelSerializer.HEADER + json.dumps(
+            ['tweets.tweet', 'unknown', []],
+        ).encode('utf-8')
+        conn.rpush('tweets_key', unknown_data)
+
+        # 当成 cache miss，从数据库 rebuild
+        objects = RedisHelper.load_objects('tweets_key', queryset)
+        self.assertEqual([t.id for t in objects], [t.id for t in tweets[::-1]])
+        self.assertEqual(conn.llen('tweets_key'), 2)
+        self.assertNotIn(unknown_data, conn.lrange('tweets_key', 0, -1))
+
+        conn.zadd('tweets_zset_key', {unknown_data: 0})
+        objects, _ = RedisHelper.load_objects_by_score('tweets_zset_key', queryset)
+        self.assertEqual([t.id for t in objects], [t.id for t in tweets[::-1]])
+        self.assertEqual(conn.zcard('tweets_zset_key'), 2)
+
+    def test_push_object(self):
+        alice = self.create_user('alice')
+        tweet1 = self.create_tweet(alice)
+        RedisClient.clear()
+        conn = RedisClient.get_connection()
+        queryset = Tweet.objects.filter(user=alice).order_by('-created_at')
+
+        # key 不存在的时候从数据库里 load
+        tweet2 = self.create_tweet(alice)
+        RedisHelper.push_object('tweets_key', tweet2, queryset)
+        self.assertEqual(conn.llen('tweets_key'), 2)
+
+        # key 存在的时候 push 到最前面并刷新过期时间
+        conn.expire('tweets_key', 10)
+        tweet3 = self.create_tweet(alice)
+        RedisHelper.push_object('tweets_key', tweet3, queryset)
+        self.assertGreater(conn.ttl('tweets_key'), 10)
+        objects = RedisHelper.load_objects('tweets_key', queryset)
+        self.assertEqual([t.id for t in objects], [tweet3.id, tweet2.id, tweet1.id])
+
+    @override_settings(LOCAL_OBJECT_CACHE_ENABLED=True, LOCAL_OBJECT_CACHE_SYNC_INTERVAL=0)
+    def test_local_object_cache(self):
+        alice = self.create_user('alice')
+        LocalObjectCache.clear()
+        MemcachedHelper.get_object_through_cache(User, alice.id)
+
+        # 同一个进程里再次读取不需要访问 memcached 和数据库
+        caches['testing'].clear()
+        with self.assertNumQueries(0):
+            user = MemcachedHelper.get_object_through_cache(User, alice.id)
+        self.assertEqual(user.username, 'alice')
+
+        # 其他进程 invalidate 之后，下一次同步的时候会被删掉
+        LocalObjectCache._publish_invalidation(MemcachedHelper.get_key(User, alice.id))
+        User.objects.filter(id=alice.id).update(username='alice2')
+        user = MemcachedHelper.get_object_through_cache(User, alice.id)
+        self.assertEqual(user.username, 'alice2')
+
+    @override_settings(LOCAL_OBJECT_CACHE_ENABLED=True)
+    def test_local_object_cache_returns_copies(self):
+        alice = self.create_user('alice')
+        LocalObjectCache.clear()
+        # 第一次读取的时候填进 LRU 的 object 和返回的 object 不是同一个
+        user = MemcachedHelper.get_object_through_cache(User, alice.id)
+        user._cached_user_profile = 'stale profile'
+        users = MemcachedHelper.get_objects_through_cache(User, [alice.id])
+        users[alice.id].tag = 'tag'
+
+        user = MemcachedHelper.get_object_through_cache(User, alice.id)
+        self.assertFalse(hasattr(user, '_cached_user_profile'))
+        self.assertFalse(hasattr(user, 'tag'))
+
+    def test_prefetch_objects_through_cache(self):
+        alice = self.create_user('alice')
+        bob = self.create_user('bob')
+        tweets = [self.create_tweet(alice), self.create_tweet(bob), self.create_tweet(alice)]
+        tweets = list(Tweet.objects.filter(id__in=[t.id for t in tweets]))
+
+        # cache miss 的 users 用一次 query 取出来
+        with self.assertNumQueries(1):
+            users = MemcachedHelper.prefetch_objects_through_cache(
+                tweets, User, 'user_id', '_cached_user',
+            )
+        self.assertEqual(set(user.id for user in users), {alice.id, bob.id})
+        with self.assertNumQueries(0):
+            for tweet in tweets:
+                self.assertEqual(tweet.cached_user.id, tweet.user_id)
+
+        # 全部 cache hit 的时候不需要访问数据库
+        tweets = list(Tweet.objects.filter(id__in=[t.id for t in tweets]))
+        with self.assertNumQueries(0):
+            MemcachedHelper.prefetch_objects_through_cache(
+                tweets, User, 'user_id', '_cached_user',
+            )
+
+    def test_cache_missing_objects(self):
+        alice = self.create_user('alice')
+        missing_id = alice.id + 100
+
+        with self.assertRaises(User.DoesNotExist):
+            MemcachedHelper.get_object_through_cache(User, missing_id)
+        # tombstone 还在的时候不需要访问数据库
+        with self.assertNumQueries(0):
+            with self.assertRaises(User.DoesNotExist):
+                MemcachedHelper.get_object_through_cache(User, missing_id)
+            users = MemcachedHelper.get_objects_through_cache(User, [missing_id])
+        self.assertEqual(users, {})
+
+        # 批量读取的时候也会给不存在的 object 存 tombstone
+        with self.assertNumQueries(1):
+            users = MemcachedHelper.get_objects_through_cache(User, [alice.id, missing_id + 1])
+        self.assertEqual(list(users), [alice.id])
+        with self.assertNumQueries(0):
+            MemcachedHelper.get_objects_through_cache(User, [alice.id, missing_id + 1])
+
+        # object 被创建之后 post_save 会把 tombstone 删掉
+        bob = User.objects.create(id=missing_id, username='bob')
+        user = MemcachedHelper.get_object_through_cache(User, missing_id)
+        self.assertEqual(user.id, bob.id)
+
+    def test_cache_versions(self):
+        alice = self.create_user('alice')
+        cache = caches['testing']
+        # 模拟滚动部署的时候旧版本的进程，它的 User 多一个 nickname field
+        old_fields = ModelCacheVersion.get_fields(User) + ['nickname:CharField']
+        RedisClient.get_connection().hset(
+            CACHE_VERSIONS_PATTERN.format(model='auth.user'),
+            'oldversion',
+            json.dumps(old_fields),
+        )
+        ModelCacheVersion.clear()
+        old_user = User.objects.get(id=alice.id)
+        old_user.nickname = 'ali'
+        old_key = MemcachedHelper.get_key(User, alice.id, 'oldversion')
+        cache.set(old_key, old_user)
+
+        # 当前版本的 key 不存在的时候从旧版本的 key 里读出来
+        with self.assertNumQueries(0):
+            user = MemcachedHelper.get_object_through_cache(User, alice.id)
+        self.assertEqual(user.username, 'alice')
+        self.assertFalse(hasattr(user, 'nickname'))
+        self.assertIsNotNone(cache.get(MemcachedHelper.get_key(User, alice.id)))
+
+        # invalidate 的时候所有版本的 key 都会被删掉
+        MemcachedHelper.invalidate_cached_object(User, alice.id)
+        self.assertIsNone(cache.get(old_key))
+        self.assertIsNone(cache.get(MemcachedHelper.get_key(User, alice.id)))
+
+    @override_settings(CACHE_METRICS_FLUSH_INTERVAL=3600)
+    def test_cache_metrics(self):
+        alice = self.create_user('alice')
+        CacheMetrics.flush()
+        CacheMetrics.reset_global_stats()
+
+        MemcachedHelper.get_object_through_cache(User, alice.id)
+        MemcachedHelper.get_objects_through_cache(User, [alice.id])
+        RedisHelper.load_objects('tweets_key', Tweet.objects.filter(user=alice))
+        stats = CacheMetrics.get_stats()
+        self.assertEqual(stats['User']['hits'], 1)
+        self.assertEqual(stats['User']['misses'], 1)
+        self.assertEqual(stats['User']['fills'], 1)
+        self.assertGreater(stats['User']['fill_bytes'], 0)
+        self.assertEqual(stats['tweets_key']['misses'], 1)
+
+        # 读到 tombstone 不算 hit，单独计数
+        missing_id = alice.id + 100
+        with self.assertRaises(User.DoesNotExist):
+            MemcachedHelper.get_object_through_cache(User, missing_id)
+        with self.assertRaises(User.DoesNotExist):
+            MemcachedHelper.get_object_through_cache(User, missing_id)
+        MemcachedHelper.get_objects_through_cache(User, [alice.id, missing_id])
+        stats = CacheMetrics.get_stats()
+        self.assertEqual(stats['User']['hits'], 2)
+        self.assertEqual(stats['User']['misses'], 2)
+        self.assertEqual(stats['User']['tombstone_hits'], 2)
+
+        # flush 之后所有进程的数据汇总在 redis 里
+        CacheMetrics.flush()
+        self.assertEqual(CacheMetrics.get_stats(), {})
+        stats = CacheMetrics.get_global_stats()
+        self.assertEqual(stats['User']['hit_rate'], 0.3333)
+        self.assertEqual(stats['tweets_key']['hits'], 0)
+
+    def test_evict_cold_timelines(self):
+        alice = self.create_user('alice')
+        self.create_tweet(alice)
+        queryset = Tweet.objects.filter(user=alice).order_by('-created_at')
+        RedisHelper.load_objects('cold_key', queryset)
+        RedisHelper.load_objects('hot_key', queryset)
+        conn = RedisClient.get_connection()
+        # cold_key 很久没有被读过了
+        conn.zadd(TIMELINE_LAST_READ_KEY, {'cold_key': 0})
+
+        self.assertEqual(RedisMemoryBudget.evict_cold_timelines(), 1)
+        self.assertFalse(conn.exists('cold_key'))
+        self.assertTrue(conn.exists('hot_key'))
+        self.assertIsNone(conn.zscore(TIMELINE_LAST_READ_KEY, 'cold_key'))
+
+        # 不支持 INFO 的时候跳过按照内存预算的淘汰
+        with override_settings(REDIS_MEMORY_BUDGET=1):
+            with mock.patch.object(RedisMemoryBudget, '_get_used_memory', return_value=None):
+                self.assertEqual(RedisMemoryBudget.evict_cold_timelines(), 0)
+        self.assertTrue(conn.exists('hot_key'))
+
+        # 超过内存预算的时候按照最后读取的时间淘汰
+        with override_settings(REDIS_MEMORY_BUDGET=1):
+            with mock.patch.object(RedisMemoryBudget, '_get_used_memory', return_value=2):
+                self.assertEqual(RedisMemoryBudget.evict_cold_timelines(), 1)
+        self.assertFalse(conn.exists('hot_key'))
+
+    def test_count_expire(self):
+        alice = self.create_user('alice')
+        tweet = self.create_tweet(alice)
+        conn = RedisClient.get_connection(RedisClient.COUNTERS)
+        key = RedisHelper.get_count_key(tweet, 'likes_count')
+
+        # key 不存在的时候不会 INCR 出一个错误的计数
+        self.assertIsNone(RedisHelper.incr_count(tweet, 'likes_count'))
+        self.assertFalse(conn.exists(key))
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 0)
+        self.assertGreater(conn.ttl(key), 0)
+        self.assertEqual(RedisHelper.incr_count(tweet, 'likes_count'), 1)
+
+    def test_count_refill_with_concurrent_incr(self):
+        alice = self.create_user('alice')
+        tweet = self.create_tweet(alice)
+        conn = RedisClient.get_connection(RedisClient.COUNTERS)
+        key = RedisHelper.get_count_key(tweet, 'likes_count')
+        refresh_from_db = Tweet.refresh_from_db
+
+        # get_count 查询了数据库之后、写回 cache 之前另一个进程点了赞，
+        # 这时候 key 还不存在，incr 是 no-op，不能把查询到的旧值写回去
+        def like_during_refill(obj, *args, **kwargs):
+            refresh_from_db(obj, *args, **kwargs)
+            Tweet.objects.filter(id=obj.id).update(likes_count=1)
+            self.assertIsNone(RedisHelper.incr_count(obj, 'likes_count'))
+
+        with mock.patch.object(Tweet, 'refresh_from_db', autospec=True) as refresh:
+            refresh.side_effect = like_during_refill
+            self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 0)
+        self.assertFalse(conn.exists(key))
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 1)
+        self.assertEqual(RedisHelper.incr_count(tweet, 'likes_count'), 2)
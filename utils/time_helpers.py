@@ -1,8 +1,18 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
 
 def utc_now():
     return datetime.now().replace(tzinfo=pytz.utc)
 
 
+def datetime_to_microseconds(dt):
+    # 不用 dt.timestamp()，float 的精度不够保存到微秒
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+
+def microseconds_to_datetime(microseconds):
+    return EPOCH + timedelta(microseconds=microseconds)